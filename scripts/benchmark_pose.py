@@ -0,0 +1,223 @@
+import argparse
+import time
+import numpy as np
+import rospy
+import yaml
+
+from sensor_msgs.msg import CameraInfo
+from opendr.engine.target import Pose
+
+from engage.frame import Frame
+from engage.pose_helper import HRIPoseManager
+
+# Benchmark of HRIPoseManager.process_poses, the post-processing that turns OpenDR poses and a
+# depth image into bodies, without a camera, a GPU or a ROS master. Poses are either synthetic
+# people swaying in a row or replayed from a recording, and every publisher is replaced
+# by one that drops its messages (after they have been built).
+
+class NullPublisher:
+    # Stands in for rospy.Publisher, reporting a subscriber so that every message is still built
+    def __init__(self,*args,**kwargs):
+        self.published = 0
+
+    def publish(self,msg):
+        self.published += 1
+
+    def get_num_connections(self):
+        return 1
+
+    def unregister(self):
+        pass
+
+
+# Pixel offsets of each keypoint from the hips of a person about 250 pixels tall, in OpenDR's order
+skeleton_template = np.array([
+    [0,-120],   # nose
+    [0,-90],    # neck
+    [-30,-90],  # r_sho
+    [-40,-50],  # r_elb
+    [-45,-10],  # r_wri
+    [30,-90],   # l_sho
+    [40,-50],   # l_elb
+    [45,-10],   # l_wri
+    [-20,0],    # r_hip
+    [-20,60],   # r_knee
+    [-20,120],  # r_ank
+    [20,0],     # l_hip
+    [20,60],    # l_knee
+    [20,120],   # l_ank
+    [-8,-128],  # r_eye
+    [8,-128],   # l_eye
+    [-15,-125], # r_ear
+    [15,-125],  # l_ear
+],dtype=float)
+
+class SyntheticReplay:
+    '''
+    People standing in a row and swaying from side to side, seen by a 640x480 RGB-D camera.
+    Each frame a few keypoints go missing at random, like they do with real detections.
+    '''
+    def __init__(self,num_bodies,num_frames,width=640,height=480,rate=20,missing=0.1,seed=0):
+        self.num_bodies = num_bodies
+        self.num_frames = num_frames
+        self.width = width
+        self.height = height
+        self.rate = rate
+        self.missing = missing
+        self.rng = np.random.default_rng(seed)
+        self.colour = np.zeros((height,width,3),dtype=np.uint8)
+        # A floor sloping away from the camera, in millimetres
+        rows = np.linspace(3000,2000,height)[:,np.newaxis]
+        self.depth = np.repeat(rows,width,axis=1).astype(np.uint16)
+        self.centres = (np.arange(num_bodies)+0.5) / num_bodies * width
+        self.phases = self.rng.uniform(0,2*np.pi,num_bodies)
+
+    def frames(self):
+        for n in range(self.num_frames):
+            t = n / self.rate
+            keypoints = np.empty((self.num_bodies,len(skeleton_template),2))
+            keypoints[...,0] = self.centres[:,np.newaxis] + 20*np.sin(t + self.phases)[:,np.newaxis] + skeleton_template[:,0]
+            keypoints[...,1] = self.height/2 + skeleton_template[:,1]
+            keypoints += self.rng.normal(0,1,keypoints.shape)
+            keypoints[self.rng.random(keypoints.shape[:2]) < self.missing] = -1
+            depth = self.depth + self.rng.integers(0,20,self.depth.shape,dtype=np.uint16)
+            yield t,keypoints,depth,self.colour
+
+
+class RecordedReplay:
+    '''
+    Poses and depth images saved in an npz file with arrays times (T,), keypoints (T,N,18,2),
+    using -1 for missing keypoints and for bodies absent from a frame, and depth (T,H,W) in
+    millimetres. An optional ids (T,N) array gives OpenDR's pose ids.
+    '''
+    def __init__(self,path):
+        data = np.load(path)
+        self.times = data["times"]
+        self.keypoints = data["keypoints"]
+        self.depth = data["depth"]
+        self.ids = data["ids"] if "ids" in data else None
+        self.num_frames = len(self.times)
+        self.num_bodies = self.keypoints.shape[1]
+        self.height,self.width = self.depth.shape[1:3]
+        self.colour = np.zeros((self.height,self.width,3),dtype=np.uint8)
+
+    def frames(self):
+        for n in range(self.num_frames):
+            yield self.times[n],self.keypoints[n],self.depth[n],self.colour
+
+
+def make_poses(keypoints,ids=None):
+    poses = []
+    for i in range(len(keypoints)):
+        if (keypoints[i] == -1).all():
+            # Body absent from this frame
+            continue
+        pose = Pose(keypoints[i].astype(np.int32),15)
+        pose.id = i if ids is None else int(ids[i])
+        poses.append(pose)
+    return poses
+
+def camera_info(width,height,focal_length=600):
+    info = CameraInfo()
+    info.width = width
+    info.height = height
+    info.K = [focal_length,0,width/2,0,focal_length,height/2,0,0,1]
+    info.P = [focal_length,0,width/2,0,0,focal_length,height/2,0,0,0,1,0]
+    return info
+
+def benchmark(replay,window,smoother,body_workers=0,worker_type="thread",warmup=10):
+    # Mean time per frame of each post-processing step, and of the whole of process_poses.
+    # window None keeps the manager's default
+    settings = {} if window is None else {"window":window}
+    manager = HRIPoseManager(
+        visualise=True,
+        smoothing=smoother != "none",
+        smoother=smoother if smoother != "none" else "one_euro",
+        body_workers=body_workers,
+        worker_type=worker_type,
+        time_steps=True,
+        camera_frame="camera",
+        world_frame="world",
+        **settings)
+    info = camera_info(replay.width,replay.height)
+    manager.update_camera_model(info,info)
+
+    totals = []
+    for n,(t,keypoints,depth,colour) in enumerate(replay.frames()):
+        ids = replay.ids[n] if getattr(replay,"ids",None) is not None else None
+        poses = make_poses(keypoints,ids)
+        frame = Frame(rospy.Time.from_sec(t),colour,depth)
+        start = time.perf_counter()
+        manager.process_poses(poses,frame)
+        manager.visualise_bodies()
+        if n == warmup - 1:
+            # Leave the warm-up frames out of the timings
+            manager.step_timer.statistics()
+        elif n >= warmup:
+            totals.append(time.perf_counter() - start)
+    steps = dict(manager.step_timer.statistics())
+    steps["total"] = float(np.mean(totals)) if len(totals) > 0 else 0
+    manager.close()
+    return steps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bodies", help="Comma separated numbers of synthetic bodies to benchmark",
+                        type=str, default="1,5,10,20")
+    parser.add_argument("--windows", help="Comma separated history window sizes (frames) to benchmark, with the lowess smoother",
+                        type=str, default="10,40")
+    parser.add_argument("--frames", help="Number of synthetic frames per benchmark",
+                        type=int, default=200)
+    parser.add_argument("--input", help="npz recording to replay instead of synthetic bodies",
+                        type=str, default=None)
+    parser.add_argument("--smoother", help="Smoother to benchmark: none, exponential, one_euro, kalman or lowess",
+                        type=str, default="one_euro")
+    parser.add_argument("--body_workers", help="Number of threads bodies are updated on, 0 for serial",
+                        type=int, default=0)
+    parser.add_argument("--worker_type", help="thread or process",
+                        type=str, default="thread")
+    parser.add_argument("--output", help="If given, the results are also written to this YAML file",
+                        type=str, default=None)
+    args = parser.parse_args()
+
+    # Stub out every publisher before anything creates one
+    rospy.Publisher = NullPublisher
+    # Wall clock time, without a node
+    rospy.rostime.set_rostime_initialized(True)
+
+    if args.input is not None:
+        body_counts = [None]
+    else:
+        body_counts = [int(n) for n in args.bodies.split(",")]
+    windows = [int(w) for w in args.windows.split(",")]
+    if args.smoother != "lowess":
+        # Only the LOWESS smoother keeps a window of history, the others would time the same thing for each
+        print("--windows only applies to the lowess smoother, timing {} once".format(args.smoother))
+        windows = [None]
+
+    results = []
+    columns = None
+    for num_bodies in body_counts:
+        for window in windows:
+            if args.input is not None:
+                replay = RecordedReplay(args.input)
+            else:
+                replay = SyntheticReplay(num_bodies,args.frames)
+            steps = benchmark(replay,window,args.smoother,args.body_workers,args.worker_type)
+            if columns is None:
+                columns = list(steps.keys())
+                print(("{:>8} {:>8}" + " {:>12}"*len(columns)).format("bodies","window",*columns))
+            print(("{:>8} {:>8}" + " {:>12.3f}"*len(columns)).format(
+                replay.num_bodies,window if window is not None else "-",*[steps.get(column,0)*1000 for column in columns]))
+            results.append({"bodies":replay.num_bodies,"window":window,"step_times":steps})
+    print("Times are milliseconds per frame")
+
+    if args.output is not None:
+        with open(args.output,"w") as f:
+            yaml.safe_dump({
+                "smoother":args.smoother,
+                "body_workers":args.body_workers,
+                "worker_type":args.worker_type,
+                "results":results,
+            },f,sort_keys=False)
@@ -0,0 +1,147 @@
+import argparse
+import os
+import time
+import numpy as np
+import cv2
+import rospkg
+
+from opendr.engine.data import Image as OpenDRImage
+
+from engage.pose_model import create_pose_estimator,resolve_device,save_profile,synthetic_image
+
+# One-shot benchmark of pose inference on this machine. Every combination of stride, refinement
+# stages and input height is timed, and the best one that runs within the target frame time is
+# written to a pose profile, which pose.launch loads.
+
+class PoseCalibration:
+    def __init__(self,
+                 model_path,
+                 device="auto",
+                 backend="pytorch",
+                 threads=0,
+                 strides=[False,True],
+                 refinement_stages=[2,1,0],
+                 heights=[256,224,192,160,128],
+                 warmup=3,
+                 iterations=10,
+                 image=None):
+        self.model_path = model_path
+        self.device = resolve_device(device)
+        self.backend = backend
+        self.threads = threads if threads > 0 else os.cpu_count()
+        self.strides = strides
+        self.refinement_stages = refinement_stages
+        self.heights = heights
+        self.warmup = warmup
+        self.iterations = iterations
+        self.image = OpenDRImage(image)
+
+    def time_inference(self,pose_estimator):
+        for _ in range(self.warmup):
+            pose_estimator.infer(self.image)
+        times = []
+        for _ in range(self.iterations):
+            start = time.perf_counter()
+            pose_estimator.infer(self.image)
+            times.append(time.perf_counter() - start)
+        return float(np.median(times))
+
+    def run(self):
+        measurements = []
+        download = True
+        for use_stride in self.strides:
+            for stages in self.refinement_stages:
+                if self.backend == "onnx" and stages < 1:
+                    print("Skipping {} refinement stages, the onnx backend needs at least one".format(stages))
+                    continue
+                pose_estimator = None
+                for height in self.heights:
+                    if pose_estimator is None or self.backend == "onnx":
+                        # An ONNX export is fixed to its stages and input height, so each combination is exported again
+                        pose_estimator = create_pose_estimator(self.model_path,device=self.device,backend=self.backend,
+                                                               threads=self.threads,num_refinement_stages=stages,
+                                                               use_stride=use_stride,base_height=height,download=download)
+                        download = False
+                    pose_estimator.base_height = height
+                    frame_time = self.time_inference(pose_estimator)
+                    print("stride: {}, refinement stages: {}, height: {} - {:.1f} ms".format(
+                        use_stride,stages,height,frame_time*1000))
+                    measurements.append({
+                        "use_stride":use_stride,
+                        "num_refinement_stages":stages,
+                        "base_height":height,
+                        "frame_time":frame_time,
+                    })
+        return measurements
+
+    def select(self,measurements,target_frame_time):
+        # The most accurate setting within the target: highest input, then most refinement stages,
+        # then no stride. If nothing is fast enough, the fastest setting
+        within = [m for m in measurements if m["frame_time"] <= target_frame_time]
+        if len(within) == 0:
+            print("No setting runs within {:.1f} ms, using the fastest".format(target_frame_time*1000))
+            return min(measurements,key=lambda m: m["frame_time"])
+        return max(within,key=lambda m: (m["base_height"],m["num_refinement_stages"],not m["use_stride"]))
+
+    def profile(self,best):
+        return {
+            "device":self.device,
+            "backend":self.backend,
+            "threads":self.threads if self.device == "cpu" else 0,
+            "use_stride":best["use_stride"],
+            # Every setting was timed at full precision
+            "half_precision":False,
+            "num_refinement_stages":best["num_refinement_stages"],
+            "base_height":best["base_height"],
+        }
+
+
+if __name__ == "__main__":
+    rospack = rospkg.RosPack()
+    package_path = rospack.get_path('engage') + "/"
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path", help="Path to the openpose model",
+                        type=str, default=package_path)
+    parser.add_argument("--output", help="Where the pose profile is written",
+                        type=str, default=package_path+"config/pose_profile.yaml")
+    parser.add_argument("--device", help="Device to calibrate: auto (the GPU if there is one), cuda or cpu",
+                        type=str, default="auto")
+    parser.add_argument("--backend", help="How the pose network is run: pytorch or onnx",
+                        type=str, default="pytorch")
+    parser.add_argument("--threads", help="Number of threads CPU inference uses, 0 for one per core",
+                        type=int, default=0)
+    parser.add_argument("--target_frame_time", help="Inference time per frame in seconds the profile should stay within",
+                        type=float, default=0.05)
+    parser.add_argument("--image", help="Image to run inference on, ideally with people in it, otherwise a synthetic image is used",
+                        type=str, default=None)
+    parser.add_argument("--width", help="Width of the synthetic image",
+                        type=int, default=640)
+    parser.add_argument("--height", help="Height of the synthetic image",
+                        type=int, default=480)
+    parser.add_argument("--iterations", help="Number of timed inferences per setting",
+                        type=int, default=10)
+    args = parser.parse_args()
+
+    if args.image is not None:
+        image = cv2.imread(args.image)
+        if image is None:
+            raise ValueError("Could not read image {}".format(args.image))
+    else:
+        image = synthetic_image(args.width,args.height)
+
+    calibration = PoseCalibration(
+        args.model_path,
+        device=args.device,
+        backend=args.backend,
+        threads=args.threads,
+        iterations=args.iterations,
+        image=image,
+    )
+    measurements = calibration.run()
+    best = calibration.select(measurements,args.target_frame_time)
+    profile = calibration.profile(best)
+    save_profile(args.output,profile,measurements)
+    print("Best setting: stride: {}, refinement stages: {}, height: {} - {:.1f} ms".format(
+        best["use_stride"],best["num_refinement_stages"],best["base_height"],best["frame_time"]*1000))
+    print("Pose profile written to {}".format(args.output))
@@ -2,7 +2,7 @@ import rospy
 import argparse
 
 from message_filters import ApproximateTimeSynchronizer, Subscriber
-from engage.msg import EngagementValue,Group,EngagementLevel,MotionActivity,PoseArrayUncertain,HeuristicStateDecision,RobotStateDecision
+from engage.msg import EngagementMatrix,EngagementValue,Group,EngagementLevel,MotionActivity,PoseArrayUncertain,HeuristicStateDecision,RobotStateDecision
 from hri_msgs.msg import IdsList
 from geometry_msgs.msg import TwistStamped,Twist
 
@@ -16,29 +16,19 @@ from engage.decision_maker.simple_target_ari_controller import SimpleTargetARICo
 from engage.decision_maker.engage_state import EngageState
 from engage.decision_maker.decision_manager import DecisionManager
 from engage.srv import ToggleInteraction,ToggleInteractionResponse,ToggleInteractionRequest
+from engage.topic_pool import TopicHandles,HandlePool
+from engage.msg import TopicPoolStats
 
 class DecisionBody:
-    def __init__(self,id):
+    def __init__(self,id,handles=None):
         self.id = id
 
-        body_topic = "/humans/bodies/{}/".format(self.id)
-
-        # Subscribers
-        self.engagement_level_subscriber = Subscriber(body_topic+"engagement_status",EngagementLevel)
-        self.activity_subscriber = Subscriber(body_topic+"activity",MotionActivity)
-        self.position_subscriber = rospy.Subscriber("/humans/bodies/{}/poses".format(id),PoseArrayUncertain,self.update_position)
-        self.velocity_subscriber = rospy.Subscriber("/humans/bodies/{}/velocity".format(id),TwistStamped,self.update_velocity)
-
-        time_slop = 0.1
-        self.synch_sub = ApproximateTimeSynchronizer(
-            [
-                self.engagement_level_subscriber,
-                self.activity_subscriber,
-            ],
-            1,
-            time_slop,
-        )
-        self.synch_sub.registerCallback(self.update_body)
+        # Subscribers. Handles from a pool are released by the node, otherwise the body owns them
+        self.owns_handles = handles is None
+        if handles is None:
+            handles = DecisionBody.create_handles(id)
+        handles.owner = self
+        self.handles = handles
 
         # Attributes
         self.engagement_level = EngagementLevel.UNKNOWN
@@ -48,14 +38,36 @@ class DecisionBody:
         self.position = None
         self.velocity = None
 
+    @staticmethod
+    def create_handles(id):
+        handles = TopicHandles()
+        body_topic = "/humans/bodies/{}/".format(id)
+
+        engagement_level_subscriber = handles.subscriber(Subscriber(body_topic+"engagement_status",EngagementLevel))
+        activity_subscriber = handles.subscriber(Subscriber(body_topic+"activity",MotionActivity))
+        handles.subscriber(rospy.Subscriber(body_topic+"poses",PoseArrayUncertain,handles.forward("update_position")))
+        handles.subscriber(rospy.Subscriber(body_topic+"velocity",TwistStamped,handles.forward("update_velocity")))
+
+        time_slop = 0.1
+        handles.synch_sub = ApproximateTimeSynchronizer(
+            [
+                engagement_level_subscriber,
+                activity_subscriber,
+            ],
+            1,
+            time_slop,
+        )
+        handles.synch_sub.registerCallback(handles.forward("update_body"))
+        return handles
+
     def __del__(self):
         self.close()
     
     def close(self):
-        self.engagement_level_subscriber.sub.unregister()
-        self.activity_subscriber.sub.unregister()
-        self.position_subscriber.unregister()
-        self.velocity_subscriber.unregister()
+        if self.handles.owner is self:
+            self.handles.owner = None
+        if self.owns_handles:
+            self.handles.close()
 
 
     def update_body(self,engagement_level,activity):
@@ -79,9 +91,12 @@ class DecisionNode:
             world_frame="map",
             rate=20,
             robot_command=True,
+            handle_retire_time=10,
+            stats_period=1,
             wait_time=5,
             wait_deviation=1,
             reduced_action_space=False,
+            engagement_matrix=False,
             **kwargs
     ):
         # Rate
@@ -103,10 +118,17 @@ class DecisionNode:
 
         # Subscribers
         self.body_subscriber = rospy.Subscriber("/humans/bodies/tracked",IdsList,self.manage_bodies)
-        self.engagement_value_subscriber = rospy.Subscriber("/humans/interactions/engagements",EngagementValue,self.update_engagements)
+        # Engagements either come in one EngagementMatrix per frame, or one EngagementValue per pair
+        if engagement_matrix:
+            self.engagement_subscriber = rospy.Subscriber("/humans/interactions/engagement_matrix",EngagementMatrix,self.update_engagement_matrix,queue_size=1)
+        else:
+            self.engagement_subscriber = rospy.Subscriber("/humans/interactions/engagements",EngagementValue,self.update_engagements)
         self.group_subscriber = rospy.Subscriber("/humans/interactions/groups",Group,self.update_groups)
 
         # Publishers
+        self.stats_period = rospy.Duration(stats_period)
+        self.last_stats_time = None
+        self.pool_stats_publisher = rospy.Publisher("/hri_engage/topic_pools",TopicPoolStats,queue_size=10)
         self.decision_state_msg = DecisionManager.decision_state_msgs[decision_maker]
         self.decision_publisher = self.dm.decision.create_publisher(topic="/hri_engage/decisions",queue_size=1)
         self.decision_state_publisher = EngageState.create_publisher(self.decision_state_msg,topic="hri_engage/decision_states",queue_size=1)
@@ -118,6 +140,8 @@ class DecisionNode:
         self.body_time = None
         self.dec_time = None
         self.bodies = {}
+        # Per-body subscribers are kept for a while after a body leaves, in case it comes back
+        self.topic_pool = HandlePool("decision",retire_time=handle_retire_time)
         self.groups = {}
         self.group_confidences = {}
         self.distances = {}
@@ -148,7 +172,7 @@ class DecisionNode:
         # Add new ids
         ids_to_add = list(tracked_ids - managed_ids)
         for id in ids_to_add:
-            self.bodies[id] = DecisionBody(id)
+            self.bodies[id] = DecisionBody(id,self.topic_pool.acquire(id,lambda: DecisionBody.create_handles(id)))
             self.groups[id] = None
             self.group_confidences[id] = None
             self.distances[id] = None
@@ -163,6 +187,7 @@ class DecisionNode:
         ids_to_rem = list(managed_ids - tracked_ids)
         for id in ids_to_rem:
             self.bodies[id].close()
+            self.topic_pool.release(id)
             del self.bodies[id]
             del self.groups[id]
             del self.group_confidences[id]
@@ -170,6 +195,7 @@ class DecisionNode:
             del self.engagements[id]
             del self.mutual_gazes[id]
             del self.pose_confidences[id]
+        self.topic_pool.collect()
 
         # Make decision
         self.state = EngageState()
@@ -216,7 +242,19 @@ class DecisionNode:
             self.distances[id] = engagement_value.distance
             self.engagements[id] = engagement_value.engagement
             self.mutual_gazes[id] = engagement_value.mutual_gaze
-            
+
+    def update_engagement_matrix(self,matrix):
+        # Only the engagements with the robot are used, as from the per-pair messages
+        self.ev_time = matrix.header.stamp
+        robot_valid = bytes(matrix.robot_valid)
+        for i,id in enumerate(matrix.bodies):
+            if not robot_valid[i]:
+                continue
+            self.pose_confidences[id] = matrix.confidences[i]
+            self.distances[id] = matrix.robot_distances[i]
+            self.engagements[id] = matrix.robot_engagements[i]
+            self.mutual_gazes[id] = matrix.robot_mutual_gazes[i]
+
 
     def update_groups(self,group):
         self.g_time = group.header.stamp
@@ -230,8 +268,16 @@ class DecisionNode:
     UTIL
     '''
 
+    def publish_pool_stats(self):
+        now = rospy.Time.now()
+        if self.last_stats_time is not None and now - self.last_stats_time < self.stats_period:
+            return
+        self.last_stats_time = now
+        self.pool_stats_publisher.publish(self.topic_pool.message(now))
+
     def run(self):
         while not rospy.is_shutdown():
+            self.publish_pool_stats()
             self.rate.sleep()
 
 if __name__ == "__main__":
@@ -254,6 +300,8 @@ if __name__ == "__main__":
                         type=str, default="True")
     parser.add_argument("--language", help="Language of the robot, can be 'english' or 'catalan'",
                         type=str, default="english")
+    parser.add_argument("--engagement_matrix", help="If True, reads engagements from /humans/interactions/engagement_matrix instead of /humans/interactions/engagements",
+                        type=str, default="False")
     args = parser.parse_args(rospy.myargv()[1:])
 
     rospy.init_node("HRIDecide", anonymous=True)
@@ -265,6 +313,7 @@ if __name__ == "__main__":
         robot = False
     if args.reduced_action_space in false_strings:
         reduced_action_space = False
+    engagement_matrix = args.engagement_matrix not in false_strings
     
     decision_node = DecisionNode(
         decision_maker = args.decision_maker,
@@ -276,5 +325,6 @@ if __name__ == "__main__":
         z_offset = args.z_offset,
         reduced_action_space=reduced_action_space,
         language=args.language,
+        engagement_matrix=engagement_matrix,
         )
     decision_node.run()
\ No newline at end of file
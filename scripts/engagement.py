@@ -6,6 +6,7 @@ import tf
 from engage.engage_helper import HRIEngagementManager
 
 from hri_msgs.msg import IdsList
+from engage.msg import BodiesFrame,TopicPoolStats
 
 class EngagementNode:
     def __init__(
@@ -16,6 +17,12 @@ class EngagementNode:
             ignore_z=True,
             camera_frame="camera",
             world_frame="world",
+            bodies_frame=False,
+            vectorised=True,
+            spatial_index=False,
+            engagement_output="values",
+            lost_time=3,
+            stats_period=1,
             rate=20,
         ):
         # Rate
@@ -32,14 +39,27 @@ class EngagementNode:
         self.engagement_manager = HRIEngagementManager(
             engagement_threshold=engagement_threshold,
             max_mutual_gaze_angle=max_mutual_gaze_angle,
-            window_size=window_time*rate,
+            window_time=window_time,
             ignore_z=ignore_z,
+            bodies_frame=bodies_frame,
+            vectorised=vectorised,
+            spatial_index=spatial_index,
+            engagement_output=engagement_output,
+            lost_time=lost_time,
             camera_frame=camera_frame,
             world_frame=world_frame
             )
 
-        # Subscriber
-        self.body_subscriber = rospy.Subscriber("/humans/bodies/tracked",IdsList,self.body_callback)
+        # Subscriber, either one aggregated message per frame or the tracked ids with per-body topics
+        if bodies_frame:
+            self.body_subscriber = rospy.Subscriber("/hri_engage/bodies_frame",BodiesFrame,self.bodies_frame_callback,queue_size=1)
+        else:
+            self.body_subscriber = rospy.Subscriber("/humans/bodies/tracked",IdsList,self.body_callback)
+
+        # Registration statistics of the per-body topics
+        self.stats_period = rospy.Duration(stats_period)
+        self.last_stats_time = None
+        self.pool_stats_publisher = rospy.Publisher("/hri_engage/topic_pools",TopicPoolStats,queue_size=10)
 
         # Transform Listener
         self.listener = tf.TransformListener()
@@ -52,6 +72,18 @@ class EngagementNode:
         # Manage bodies
         self.engagement_manager.manage_bodies(self.time,body_list)
 
+        self.update_engagement()
+
+    def bodies_frame_callback(self,bodies_frame):
+        self.time = bodies_frame.header.stamp
+
+        # Manage bodies and fill them from the frame
+        self.engagement_manager.manage_bodies(self.time,bodies_frame.bodies)
+        self.engagement_manager.update_bodies_frame(bodies_frame)
+
+        self.update_engagement()
+
+    def update_engagement(self):
         # Calculate engagements
         distances,mutual_gazes,engagements = self.engagement_manager.calculate_engagement()
 
@@ -72,6 +104,13 @@ class EngagementNode:
 
         
 
+    def publish_pool_stats(self):
+        now = rospy.Time.now()
+        if self.last_stats_time is not None and now - self.last_stats_time < self.stats_period:
+            return
+        self.last_stats_time = now
+        self.pool_stats_publisher.publish(self.engagement_manager.topic_pool.message(now))
+
     def run(self):
         while not rospy.is_shutdown():
             
@@ -82,6 +121,7 @@ class EngagementNode:
             except (tf.LookupException, tf.ConnectivityException, tf.ExtrapolationException) as e:
                 pass
 
+            self.publish_pool_stats()
             self.rate.sleep()
 
 
@@ -95,14 +135,37 @@ if __name__ == "__main__":
                         type=str, default="camera")
     parser.add_argument("--world_frame", help="World Frame",
                         type=str, default="world")
+    parser.add_argument("--bodies_frame", help="If True, reads all bodies from /hri_engage/bodies_frame instead of subscribing to every body's topics",
+                        default="False")
+    parser.add_argument("--vectorised", help="If True, calculates the engagement of every pair at once with arrays instead of pair by pair",
+                        default="True")
+    parser.add_argument("--spatial_index", help="If True, only calculates the engagement of pairs of people close enough to pass the threshold, found with a KD-tree",
+                        default="False")
+    parser.add_argument("--engagement_output", help="How engagements are published: values (one EngagementValue per pair), matrix (one EngagementMatrix per frame) or both",
+                        type=str, default="values")
+    parser.add_argument("--window_time", help="Seconds over which engagement levels and motion activities are judged",
+                        type=float, default=1)
+    parser.add_argument("--lost_time", help="Seconds a body that is no longer tracked is kept for, with its histories, in case it comes back",
+                        type=float, default=3)
     args = parser.parse_args(rospy.myargv()[1:])
 
+    false_strings = ["False","false","f","F","0"]
+    bodies_frame = args.bodies_frame not in false_strings
+    vectorised = args.vectorised not in false_strings
+    spatial_index = args.spatial_index not in false_strings
+
     rospy.init_node("HRIEngage", anonymous=True)
     
     engage_node = EngagementNode(
         engagement_threshold=args.engagement_threshold,
         max_mutual_gaze_angle=args.max_angle,
+        window_time=args.window_time,
         camera_frame=args.camera_frame,
-        world_frame=args.world_frame
+        world_frame=args.world_frame,
+        bodies_frame=bodies_frame,
+        vectorised=vectorised,
+        spatial_index=spatial_index,
+        engagement_output=args.engagement_output,
+        lost_time=args.lost_time
         )
     engage_node.run()
@@ -1,22 +1,27 @@
 import rospy
 import argparse
-import numpy as np
-import cv2
 from cv_bridge import CvBridge
 import tf
 import os
 import rospkg
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from sensor_msgs.msg import Image, CameraInfo
+from sensor_msgs.msg import Image, CameraInfo, CompressedImage
 from geometry_msgs.msg import TransformStamped,Vector3,Quaternion
-from message_filters import ApproximateTimeSynchronizer, Subscriber
+from message_filters import ApproximateTimeSynchronizer, TimeSynchronizer, Subscriber
 
-from opendr.engine.data import Image as OpenDRImage
 from opendr.perception.pose_estimation import draw
-from opendr.perception.pose_estimation import LightweightOpenPoseLearner
 
 from engage.opendr_bridge import ROSBridge
 from engage.pose_helper import HRIPoseManager
+from engage.pipeline import LatestSlot,PipelineStage
+from engage.image_decoding import decode_compressed_rgbd
+from engage.frame import Frame
+from engage.inference_gate import ChangeDetector,KeyframeScheduler,KeypointPropagator,OperatingPointController
+from engage.pose_model import create_pose_estimator,load_profile,warm_up
+from engage.msg import PipelineStats,TopicPoolStats
 
 # This node in part adapts the OpenDR pose estimation node
 
@@ -31,66 +36,202 @@ class PoseEstimationNode:
             camera_frame="camera",
             world_frame="map",
             pose_image_topic=None,
-            device="cuda",
+            device="auto",
+            backend="pytorch",
+            threads=0,
             num_refinement_stages=2,
             use_stride=False,
             half_precision=False,
+            base_height=256,
             rate=20,
             smoothing=True,
+            smoother="one_euro",
             smoothing_time=1,
-            visualise=True
+            velocity_horizon=1,
+            visualise=True,
+            threaded=True,
+            aligned_depth=False,
+            compressed=False,
+            decode_workers=2,
+            body_topics=True,
+            bodies_frame=True,
+            batch_visualisation=False,
+            face_transforms=True,
+            change_detection=False,
+            change_threshold=0.01,
+            max_skip_time=1,
+            keyframe_interval=1,
+            latency_budget=0,
+            propagation="optical_flow",
+            adaptive=False,
+            target_frame_time=0.05,
+            warmup_iterations=3,
+            tracking=True,
+            max_match_distance=0.5,
+            lost_time=3,
+            body_workers=0,
+            worker_type="thread",
+            time_steps=False,
+            info_check_period=5,
+            stats_topic="/hri_engage/pose_pipeline",
+            stats_period=1
         ):
+        # Startup is timed up to the first poses, which is what a restart costs
+        self.start_time = time.perf_counter()
+        self.first_pose_time = None
+
         # Rate
         self.rate = rospy.Rate(rate)
 
 
-        # OpenDR pose estimator
-        self.pose_estimator = LightweightOpenPoseLearner(device=device, num_refinement_stages=num_refinement_stages,
-                                                         mobilenet_use_stride=use_stride,
-                                                         half_precision=half_precision)
-        
+        # OpenDR pose estimator, on the GPU when there is one, or on the CPU with a fixed number of threads.
+        # The cached model is checked against its checksums and only downloaded if it is missing or corrupt
         print("Checking for model directory in {}".format(model_path))
-        self.pose_estimator.download(path=model_path, verbose=True)
-        self.pose_estimator.load(model_path+"openpose_default")
+        self.pose_estimator = create_pose_estimator(model_path,device=device,backend=backend,threads=threads,
+                                                    num_refinement_stages=num_refinement_stages,
+                                                    use_stride=use_stride,half_precision=half_precision,
+                                                    base_height=base_height)
+        print("Running pose estimation on {} with the {} backend".format(self.pose_estimator.device,backend))
 
         self.opendr_bridge = ROSBridge()
 
-        # Camera information for projections
+        # Scale the input resolution and refinement stages to hold the target inference time
+        self.operating_point_controller = None
+        if adaptive:
+            self.operating_point_controller = OperatingPointController(
+                target_frame_time,
+                base_height=self.pose_estimator.base_height,
+                refinement_stages=num_refinement_stages)
+            self.operating_point_controller.attach(self.pose_estimator)
+            self.operating_point = self.operating_point_controller.operating_point()
+        else:
+            self.operating_point = (self.pose_estimator.base_height,num_refinement_stages)
+        load_time = time.perf_counter() - self.start_time
+
+        # Run a few inferences before subscribing, so the first real frame is not slowed by initialisation
+        warmup_time = 0
+        if warmup_iterations > 0:
+            warmup_time = warm_up(self.pose_estimator,warmup_iterations)
+        print("Pose model loaded in {:.2f} s, warmed up in {:.2f} s".format(load_time,warmup_time))
+
+        # Skip inference on frames that look the same as the last one inference ran on, reusing its poses
+        self.change_detector = None
+        if change_detection:
+            self.change_detector = ChangeDetector(changed_fraction=change_threshold,max_skip_time=max_skip_time)
+        # Only run inference every keyframe_interval frames, or as often as the latency budget allows,
+        # and move the last poses' keypoints onto the frames in between
+        self.keyframe_scheduler = KeyframeScheduler(keyframe_interval,latency_budget)
+        self.propagator = None
+        if keyframe_interval > 1 or latency_budget > 0:
+            self.propagator = KeypointPropagator(propagation)
+        self.last_poses = []
+        self.inferences = 0
+        self.skipped_inferences = 0
+        self.propagated_frames = 0
+
+        # Camera information for projections, read once and re-checked every info_check_period seconds
         self.rgb_info = None
         self.depth_info = None
+        self.rgb_info_topic = rgb_info_topic
+        self.depth_info_topic = depth_info_topic
+        self.info_check_period = rospy.Duration(info_check_period)
+        self.last_info_check = None
+        self.rgb_info_sub = None
+        self.depth_info_sub = None
+        self.camera_ready = False
+        self.info_lock = threading.Lock()
         self.camera_frame = camera_frame
         self.world_frame = world_frame
 
         # Pose Manager
         self.visualise = visualise
+        self.body_workers = body_workers
         self.pose_manager = HRIPoseManager(
             visualise=visualise,
             smoothing=smoothing,
+            smoother=smoother,
             window=smoothing_time*rate,
+            hold_time=smoothing_time,
+            velocity_horizon=velocity_horizon,
+            body_topics=body_topics,
+            bodies_frame=bodies_frame,
+            batch_visualisation=batch_visualisation,
+            face_transforms=face_transforms,
+            tracking=tracking,
+            max_match_distance=max_match_distance,
+            lost_time=lost_time,
+            body_workers=body_workers,
+            worker_type=worker_type,
+            time_steps=time_steps,
             camera_frame=camera_frame,
             world_frame=world_frame)
 
-        # Subscribers
-        self.rgb_image_sub = Subscriber(rgb_image_topic,Image)
-        self.rgb_info_sub = Subscriber(rgb_info_topic,CameraInfo)
-        self.depth_image_sub = Subscriber(depth_image_topic,Image)
-        self.depth_info_sub = Subscriber(depth_info_topic,CameraInfo)
-
-        time_slop = 1
-        self.synch_sub = ApproximateTimeSynchronizer(
-            [
-                self.rgb_image_sub,
-                self.rgb_info_sub,
-                self.depth_image_sub,
-                self.depth_info_sub
-            ],
-            10,
-            time_slop,
-        )
+        # Pipeline: a latest-frame-wins slot feeds the inference worker, whose results feed the post-processing worker
+        self.threaded = threaded
+        self.frame_slot = LatestSlot("frames",on_drop=self.drop_frame)
+        self.pose_slot = LatestSlot("poses")
+        self.stages = []
+        # With propagation, inference runs asynchronously on the newest keyframe while every frame
+        # is served from the last finished keyframe
+        self.asynchronous = threaded and self.propagator is not None
+        self.keyframe_slot = LatestSlot("keyframes")
+        self.propagation_lock = threading.Lock()
+        if self.asynchronous:
+            self.stages = [
+                PipelineStage("propagation",self.frame_slot,self.propagate_frame,self.pose_slot),
+                PipelineStage("inference",self.keyframe_slot,self.infer_keyframe),
+                PipelineStage("postprocess",self.pose_slot,self.process_frame),
+            ]
+        elif threaded:
+            self.stages = [
+                PipelineStage("inference",self.frame_slot,self.infer_frame,self.pose_slot),
+                PipelineStage("postprocess",self.pose_slot,self.process_frame),
+            ]
+
+        # Compressed images are decoded on a thread pool so decoding overlaps inference
+        self.compressed = compressed
+        self.decode_pool = None
+        if compressed:
+            self.decode_pool = ThreadPoolExecutor(max_workers=decode_workers,thread_name_prefix="decode")
+
+        # Subscribers, only the images are synchronised
+        self.subscribe_camera_info()
+        if compressed:
+            # Topics published by image_transport's compressed and compressedDepth plugins
+            self.rgb_image_sub = Subscriber(rgb_image_topic+"/compressed",CompressedImage)
+            self.depth_image_sub = Subscriber(depth_image_topic+"/compressedDepth",CompressedImage)
+        else:
+            self.rgb_image_sub = Subscriber(rgb_image_topic,Image)
+            self.depth_image_sub = Subscriber(depth_image_topic,Image)
+
+        if aligned_depth:
+            # Aligned depth shares the RGB timestamps, so exact matching is enough
+            self.synch_sub = TimeSynchronizer(
+                [
+                    self.rgb_image_sub,
+                    self.depth_image_sub
+                ],
+                10,
+            )
+        else:
+            time_slop = 1
+            self.synch_sub = ApproximateTimeSynchronizer(
+                [
+                    self.rgb_image_sub,
+                    self.depth_image_sub
+                ],
+                10,
+                time_slop,
+            )
         self.synch_sub.registerCallback(self.camera_callback)
         self.im_time = None
 
         # Publishers
+        self.stats_period = rospy.Duration(stats_period)
+        self.last_stats_time = None
+        self.last_inference_counts = (0,0,0)
+        self.stats_pub = rospy.Publisher(stats_topic,PipelineStats,queue_size=1)
+        self.pool_stats_pub = rospy.Publisher("/hri_engage/topic_pools",TopicPoolStats,queue_size=10)
         self.opendr_pose_image_pub = None
         if pose_image_topic is not None:
             self.opendr_pose_image_pub = rospy.Publisher(pose_image_topic,Image,queue_size=1)
@@ -101,50 +242,241 @@ class PoseEstimationNode:
         # OpenCV Bridge
         self.cv_bridge = CvBridge()
 
-    def camera_callback(self,rgb_img,rgb_info,depth_img,depth_info):
-        # Update time for synching
-        self.im_time = rgb_info.header.stamp
-
-        # Camera calibration
-        if self.rgb_info is None:
+        # Start the pipeline workers once everything they use exists
+        for stage in self.stages:
+            stage.start()
+        print("Pose node started in {:.2f} s".format(time.perf_counter() - self.start_time))
+
+    '''
+    Camera information
+    '''
+    def subscribe_camera_info(self):
+        # One-shot subscriptions, each unregisters itself after its first message. They are registered
+        # under the lock, so a latched message cannot reach its callback before the handle is stored
+        self.last_info_check = rospy.Time.now()
+        with self.info_lock:
+            if self.rgb_info_sub is None:
+                self.rgb_info_sub = rospy.Subscriber(self.rgb_info_topic,CameraInfo,self.rgb_info_callback,queue_size=1)
+            if self.depth_info_sub is None:
+                self.depth_info_sub = rospy.Subscriber(self.depth_info_topic,CameraInfo,self.depth_info_callback,queue_size=1)
+
+    def rgb_info_callback(self,rgb_info):
+        with self.info_lock:
+            subscriber,self.rgb_info_sub = self.rgb_info_sub,None
             self.rgb_info = rgb_info
+        if subscriber is not None:
+            subscriber.unregister()
+        self.update_camera_model()
+
+    def depth_info_callback(self,depth_info):
+        with self.info_lock:
+            subscriber,self.depth_info_sub = self.depth_info_sub,None
             self.depth_info = depth_info
-            self.pose_manager.update_camera_model(rgb_info,depth_info)        
+        if subscriber is not None:
+            subscriber.unregister()
+        self.update_camera_model()
+
+    def update_camera_model(self):
+        # The two info callbacks run on different threads
+        with self.info_lock:
+            if self.rgb_info is None or self.depth_info is None:
+                return
+            # Only rebuilds the projection if the intrinsics have changed
+            self.pose_manager.update_camera_model(self.rgb_info,self.depth_info)
+            self.camera_ready = True
+
+    '''
+    Frames
+    '''
+    def camera_callback(self,rgb_img,depth_img):
+        if not self.camera_ready:
+            rospy.logwarn_throttle(5,"Dropping frames until camera info is received on {} and {}".format(self.rgb_info_topic,self.depth_info_topic))
+            return
+
+        # Update time for synching
+        self.im_time = rgb_img.header.stamp
+
+        if self.compressed:
+            # Start decoding straight away, the result is collected by the inference step
+            images = self.decode_pool.submit(decode_compressed_rgbd,rgb_img,depth_img)
+        else:
+            images = (rgb_img,depth_img)
+
+        frame = (self.im_time,images)
+        if self.threaded:
+            # Replaces any frame the inference worker has not started on yet
+            self.frame_slot.put(frame)
+        else:
+            self.process_frame(self.infer_frame(frame))
+
+    def drop_frame(self,frame):
+        # Skip decoding frames that were replaced before inference reached them
+        time,images = frame
+        if self.compressed:
+            images.cancel()
+
+    def decode_frame(self,time,images):
+        # Decode once, every later step shares the views of the frame
+        if self.compressed:
+            bgr_image,depth_image = images.result()
+            return Frame(time,bgr_image,depth_image)
+        rgb_img,depth_img = images
+        return Frame.from_messages(time,rgb_img,depth_img)
+
+    def infer_frame(self,frame):
+        time,images = frame
 
         # OpenCV
-        rgb_image = cv2.cvtColor(self.cv_bridge.imgmsg_to_cv2(rgb_img), cv2.COLOR_BGR2RGB)
-        depth_image = self.cv_bridge.imgmsg_to_cv2(depth_img, "16UC1")
+        frame = self.decode_frame(time,images)
 
         # Get poses
-        poses = self.opendr_pose_estimation(rgb_img)
+        poses = self.opendr_pose_estimation(frame)
+
+        return poses,frame
+
+    def propagate_frame(self,frame):
+        time,images = frame
+
+        # OpenCV
+        frame = self.decode_frame(time,images)
+
+        if self.keyframe_scheduler.due():
+            if self.change_detector is None or self.change_detector.changed(frame):
+                # Replaces any keyframe the inference worker has not started on yet
+                self.keyframe_slot.put(frame)
+            else:
+                self.skipped_inferences += 1
+            self.keyframe_scheduler.keyframe()
+        else:
+            self.keyframe_scheduler.skip()
+
+        # Every frame follows the poses of the last finished keyframe
+        with self.propagation_lock:
+            poses = self.propagator.propagate(frame)
+            frame.operating_point = self.operating_point
+        self.propagated_frames += 1
+        frame.keyframe = False
+
+        self.publish_pose_image(frame,poses)
+        return poses,frame
+
+    def infer_keyframe(self,frame):
+        # OpenDR Image view of the frame
+        image = self.opendr_bridge.from_frame(frame)
+
+        # Run pose estimation
+        start = time.perf_counter()
+        poses = self.pose_estimator.infer(image)
+        latency = time.perf_counter() - start
+        self.keyframe_scheduler.record_latency(latency)
+        self.inferences += 1
+        operating_point = self.operating_point
+        if self.operating_point_controller is not None:
+            operating_point = self.operating_point_controller.operating_point()
+
+        # Later frames are propagated from this keyframe
+        with self.propagation_lock:
+            self.last_poses = poses
+            self.propagator.update_keyframe(frame,poses)
+            self.operating_point = operating_point
+        if self.operating_point_controller is not None:
+            self.operating_point_controller.record(latency)
+
+    def process_frame(self,result):
+        poses,frame = result
 
         # Process new poses
-        self.pose_manager.process_poses(poses,self.im_time,rgb_image,depth_image)
+        self.pose_manager.process_poses(poses,frame)
+        if self.first_pose_time is None and len(poses) > 0:
+            self.first_pose_time = time.perf_counter()
+            print("First poses {:.2f} s after start".format(self.first_pose_time - self.start_time))
 
         # Visualise
         if self.visualise:
-            for body in self.pose_manager.bodies:
-                self.pose_manager.bodies[body].visualise_pose()
+            self.pose_manager.visualise_bodies()
 
-    def opendr_pose_estimation(self,rgb_img):
+    def opendr_pose_estimation(self,frame):
         
-        # Convert sensor_msgs.msg.Image into OpenDR Image
-        image = self.opendr_bridge.from_ros_image(rgb_img, encoding='bgr8')
-
-        # Run pose estimation
-        poses = self.pose_estimator.infer(image)
+        # OpenDR Image view of the frame
+        image = self.opendr_bridge.from_frame(frame)
+
+        if self.propagator is not None and not self.keyframe_scheduler.due():
+            # Between keyframes, follow the last poses
+            poses = self.propagator.propagate(frame)
+            self.keyframe_scheduler.skip()
+            self.propagated_frames += 1
+            frame.keyframe = False
+        else:
+            if self.change_detector is None or self.change_detector.changed(frame):
+                # Run pose estimation
+                start = time.perf_counter()
+                poses = self.pose_estimator.infer(image)
+                latency = time.perf_counter() - start
+                self.keyframe_scheduler.keyframe(latency)
+                self.last_poses = poses
+                self.inferences += 1
+                if self.operating_point_controller is not None:
+                    self.operating_point = self.operating_point_controller.operating_point()
+                    self.operating_point_controller.record(latency)
+            else:
+                # The scene has not changed, the poses are lifted again with the new depth image
+                poses = self.last_poses
+                self.keyframe_scheduler.keyframe()
+                self.skipped_inferences += 1
+                frame.keyframe = False
+            if self.propagator is not None:
+                self.propagator.update_keyframe(frame,poses)
+        # Propagated and reused poses come from the last inference
+        frame.operating_point = self.operating_point
+
+        self.publish_pose_image(frame,poses)
+        # Return
+        return poses
 
-        # Publish pose image
-        if self.opendr_pose_image_pub is not None:
-            image = image.opencv()
+    def publish_pose_image(self,frame,poses):
+        if self.opendr_pose_image_pub is not None and self.opendr_pose_image_pub.get_num_connections() > 0:
+            image = frame.annotated()
             for pose in poses:
                 draw(image, pose)
-            image = self.opendr_bridge.to_ros_image(OpenDRImage(image), encoding='bgr8')
-            image.header.stamp = self.im_time
+            image = self.cv_bridge.cv2_to_imgmsg(image, encoding='bgr8')
+            image.header.stamp = frame.time
             self.opendr_pose_image_pub.publish(image)
-        # Return
-        return poses
 
+    def publish_stats(self):
+        now = rospy.Time.now()
+        if self.last_stats_time is not None and now - self.last_stats_time < self.stats_period:
+            return
+        self.last_stats_time = now
+
+        # Per-body topic registrations
+        self.pool_stats_pub.publish(self.pose_manager.topic_pool.message(now))
+
+        stats_msg = PipelineStats()
+        stats_msg.header.stamp = now
+        counts = (self.inferences,self.skipped_inferences,self.propagated_frames)
+        stats_msg.inferences = counts[0] - self.last_inference_counts[0]
+        stats_msg.skipped_inferences = counts[1] - self.last_inference_counts[1]
+        stats_msg.propagated_frames = counts[2] - self.last_inference_counts[2]
+        stats_msg.keyframe_interval = self.keyframe_scheduler.current_interval()
+        if self.operating_point_controller is not None:
+            stats_msg.base_height,stats_msg.refinement_stages = self.operating_point_controller.operating_point()
+        else:
+            stats_msg.base_height,stats_msg.refinement_stages = self.operating_point
+        self.last_inference_counts = counts
+        stats_msg.body_workers = self.body_workers
+        if self.pose_manager.step_timer is not None:
+            for step,step_time in self.pose_manager.step_timer.statistics():
+                stats_msg.body_steps.append(step)
+                stats_msg.body_step_times.append(step_time)
+        for stage in self.stages:
+            stats = stage.statistics()
+            stats_msg.stages.append(stats["name"])
+            stats_msg.queue_depths.append(stats["queue_depth"])
+            stats_msg.received.append(stats["received"])
+            stats_msg.dropped.append(stats["dropped"])
+            stats_msg.drop_rates.append(stats["drop_rate"])
+            stats_msg.processing_times.append(stats["processing_time"])
+        self.stats_pub.publish(stats_msg)
 
     def run(self):
         while not rospy.is_shutdown():
@@ -154,7 +486,17 @@ class PoseEstimationNode:
                 self.pose_manager.update_camera_transform(trans,rot)
             except (tf.LookupException, tf.ConnectivityException, tf.ExtrapolationException) as e:
                 pass
+            # Periodically re-read the camera info in case the intrinsics change
+            if rospy.Time.now() - self.last_info_check > self.info_check_period:
+                self.subscribe_camera_info()
+            # Report whether the pipeline is keeping up
+            self.publish_stats()
             self.rate.sleep()
+        for stage in self.stages:
+            stage.stop()
+        if self.decode_pool is not None:
+            self.decode_pool.shutdown(wait=False)
+        self.pose_manager.close()
 
 
 if __name__ == "__main__":
@@ -184,6 +526,64 @@ if __name__ == "__main__":
                         type=str, default=default_world_frame)
     parser.add_argument("--accelerate", help="Activates some acceleration features (e.g. reducing number of refinement steps)",
                         default="False")
+    parser.add_argument("--smoother", help="How poses and orientations are smoothed: none, exponential, one_euro, kalman or lowess",
+                        type=str, default="one_euro")
+    parser.add_argument("--velocity_horizon", help="Number of seconds of positions used to estimate velocities",
+                        type=float, default=1)
+    parser.add_argument("--threaded", help="If True, runs inference and post-processing on worker threads, dropping stale frames",
+                        default="True")
+    parser.add_argument("--aligned_depth", help="If True, the depth image is aligned to the RGB image and frames are matched by exact timestamp",
+                        default="False")
+    parser.add_argument("--compressed", help="If True, subscribes to the compressed and compressedDepth image_transport topics of the image topics",
+                        default="False")
+    parser.add_argument("--decode_workers", help="Number of threads decoding compressed images",
+                        type=int, default=2)
+    parser.add_argument("--body_topics", help="If True, publishes each body's poses, velocity, orientations and skeleton on its own /humans/bodies/<id>/ topics",
+                        default="True")
+    parser.add_argument("--bodies_frame", help="If True, publishes every body in a single BodiesFrame message on /hri_engage/bodies_frame",
+                        default="True")
+    parser.add_argument("--batch_visualisation", help="If True, publishes each frame's markers as one MarkerArray on /hri_engage/marker_array and the face transforms as one tf message",
+                        default="False")
+    parser.add_argument("--face_transforms", help="If True, broadcasts a <body_id>_face_tf frame for each body",
+                        default="True")
+    parser.add_argument("--change_detection", help="If True, only runs pose inference when the image has changed, otherwise the last poses are reused",
+                        default="False")
+    parser.add_argument("--change_threshold", help="Fraction of (downscaled) pixels that must change for inference to run",
+                        type=float, default=0.01)
+    parser.add_argument("--max_skip_time", help="Longest time in seconds inference can be skipped for when the image does not change",
+                        type=float, default=1)
+    parser.add_argument("--keyframe_interval", help="Runs pose inference at most every this many frames, propagating the keypoints in between",
+                        type=int, default=1)
+    parser.add_argument("--latency_budget", help="If above 0, target processing time per frame in seconds, inference is run less often if it takes longer than this",
+                        type=float, default=0)
+    parser.add_argument("--propagation", help="How keypoints are propagated between keyframes: optical_flow or constant_velocity",
+                        type=str, default="optical_flow")
+    parser.add_argument("--adaptive", help="If True, scales the network input size and refinement stages to keep inference near target_frame_time",
+                        default="False")
+    parser.add_argument("--target_frame_time", help="Inference time per frame in seconds that adaptive mode aims for",
+                        type=float, default=0.05)
+    parser.add_argument("--device", help="Device pose inference runs on: auto (the GPU if there is one), cuda or cpu",
+                        type=str, default="auto")
+    parser.add_argument("--backend", help="How the pose network is run: pytorch, or onnx (exported with OpenDR's optimize, mostly faster on the CPU)",
+                        type=str, default="pytorch")
+    parser.add_argument("--threads", help="If above 0, number of threads CPU inference uses",
+                        type=int, default=0)
+    parser.add_argument("--profile", help="Pose profile written by calibrate_pose.py, its settings replace accelerate, device, backend and threads. Ignored if the file does not exist",
+                        type=str, default="none")
+    parser.add_argument("--warmup_iterations", help="Number of inferences run on a synthetic image before subscribing to the camera",
+                        type=int, default=3)
+    parser.add_argument("--tracking", help="If True, matches poses to bodies by 3D position and velocity, and gives people who reappear within lost_time their old body id back",
+                        default="True")
+    parser.add_argument("--max_match_distance", help="Furthest in metres a pose can be from where a body was predicted to be and still be matched to it",
+                        type=float, default=0.5)
+    parser.add_argument("--lost_time", help="Number of seconds a body that has disappeared is kept for in case it comes back",
+                        type=float, default=3)
+    parser.add_argument("--body_workers", help="Number of threads bodies are updated on after inference, 0 to update them one after another",
+                        type=int, default=0)
+    parser.add_argument("--worker_type", help="thread, or process to also run the per-body fits of the lowess smoother in body_workers processes",
+                        type=str, default="thread")
+    parser.add_argument("--time_steps", help="If True, reports the mean time of each post-processing step on /hri_engage/pose_pipeline",
+                        default="False")
     args = parser.parse_args(rospy.myargv()[1:])
 
     false_strings = ["False","false","f","F","0"]
@@ -191,6 +591,18 @@ if __name__ == "__main__":
     if args.accelerate in false_strings:
         accelerate = False 
 
+    threaded = args.threaded not in false_strings
+    aligned_depth = args.aligned_depth not in false_strings
+    compressed = args.compressed not in false_strings
+    body_topics = args.body_topics not in false_strings
+    bodies_frame = args.bodies_frame not in false_strings
+    batch_visualisation = args.batch_visualisation not in false_strings
+    face_transforms = args.face_transforms not in false_strings
+    change_detection = args.change_detection not in false_strings
+    adaptive = args.adaptive not in false_strings
+    tracking = args.tracking not in false_strings
+    time_steps = args.time_steps not in false_strings
+
     if accelerate:
         use_stride=True
         half_precision=True
@@ -200,6 +612,22 @@ if __name__ == "__main__":
         half_precision=False
         num_refinement_stages=2   
 
+    settings = {
+        "device":args.device,
+        "backend":args.backend,
+        "threads":args.threads,
+        "use_stride":use_stride,
+        "half_precision":half_precision,
+        "num_refinement_stages":num_refinement_stages,
+        "base_height":256,
+    }
+    if args.profile != "none":
+        if os.path.exists(args.profile):
+            print("Loading pose profile {}".format(args.profile))
+            settings = load_profile(args.profile)
+        else:
+            print("No pose profile at {}, run calibrate_pose.py to create one".format(args.profile))
+
     rospy.init_node("HRIPose", anonymous=True)
 
     print("Listening for images on {}".format(args.rgb_image_topic))
@@ -213,8 +641,38 @@ if __name__ == "__main__":
         camera_frame=args.camera_frame,
         world_frame=args.world_frame,
         model_path=args.model_path,
-        use_stride=use_stride,
-        half_precision=half_precision,
-        num_refinement_stages=num_refinement_stages
+        device=settings["device"],
+        backend=settings["backend"],
+        threads=settings["threads"],
+        use_stride=settings["use_stride"],
+        half_precision=settings["half_precision"],
+        num_refinement_stages=settings["num_refinement_stages"],
+        base_height=settings["base_height"],
+        smoothing=args.smoother != "none",
+        smoother=args.smoother,
+        velocity_horizon=args.velocity_horizon,
+        threaded=threaded,
+        aligned_depth=aligned_depth,
+        compressed=compressed,
+        decode_workers=args.decode_workers,
+        body_topics=body_topics,
+        bodies_frame=bodies_frame,
+        batch_visualisation=batch_visualisation,
+        face_transforms=face_transforms,
+        change_detection=change_detection,
+        change_threshold=args.change_threshold,
+        max_skip_time=args.max_skip_time,
+        keyframe_interval=args.keyframe_interval,
+        latency_budget=args.latency_budget,
+        propagation=args.propagation,
+        adaptive=adaptive,
+        target_frame_time=args.target_frame_time,
+        warmup_iterations=args.warmup_iterations,
+        tracking=tracking,
+        max_match_distance=args.max_match_distance,
+        lost_time=args.lost_time,
+        body_workers=args.body_workers,
+        worker_type=args.worker_type,
+        time_steps=time_steps,
         )
     pose_node.run()
@@ -0,0 +1,135 @@
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from engage.utils import RandomID
+
+class BodyTrack:
+    def __init__(self,id,position,time):
+        self.id = id
+        self.position = position
+        self.velocity = np.zeros(3)
+        self.time = time
+        self.lost = False
+
+    def predict(self,time,max_prediction):
+        # Constant velocity, only extrapolated for max_prediction seconds
+        if self.position is None:
+            return np.full(3,np.nan)
+        return self.position + self.velocity * min(time - self.time,max_prediction)
+
+    def update(self,position,time,smoothing):
+        if position is not None and self.position is not None:
+            dt = time - self.time
+            if dt > 0:
+                velocity = (position - self.position) / dt
+                self.velocity += smoothing * (velocity - self.velocity)
+        if position is not None:
+            self.position = position
+        self.time = time
+        self.lost = False
+
+
+class BodyTracker:
+    '''
+    Gives detected poses stable body ids by matching them to tracked bodies in 3D.
+
+    Each frame, detections are matched to the predicted positions of the tracked bodies with
+    the Hungarian algorithm, first to the bodies that are still visible and then to recently
+    lost ones, so a person who reappears after an occlusion gets their old id (and body) back.
+    Bodies unseen for timeout seconds are lost, lost bodies are forgotten after lost_time.
+    '''
+    # Torso keypoints (neck, shoulders and hips), which move least with gestures
+    torso = [1,2,5,8,11]
+
+    def __init__(self,max_distance=0.5,lost_distance=1.0,timeout=0.1,lost_time=3,smoothing=0.5,max_prediction=0.5):
+        self.max_distance = max_distance
+        self.lost_distance = lost_distance
+        self.timeout = timeout
+        self.lost_time = lost_time
+        self.smoothing = smoothing
+        self.max_prediction = max_prediction
+        self.tracks = {}
+        # OpenDR pose id to body id, for detections without any depth
+        self.pose_ids = {}
+        self.next_id = 0
+
+        # Statistics
+        self.created = 0
+        self.revived = 0
+
+    def positions(self,poses_3D,poses_3D_valid):
+        # One point per detection, nan when it has no valid keypoint
+        torso_valid = poses_3D_valid[:,self.torso]
+        use_torso = torso_valid.any(axis=1)
+        mask = poses_3D_valid.copy()
+        mask[use_torso] = False
+        mask[np.ix_(use_torso,self.torso)] = torso_valid[use_torso]
+        counts = mask.sum(axis=1)
+        totals = (poses_3D * mask[...,np.newaxis]).sum(axis=1)
+        with np.errstate(invalid="ignore",divide="ignore"):
+            return totals / counts[:,np.newaxis]
+
+    def match(self,positions,detections,track_ids,time,max_distance):
+        # Hungarian assignment of detections to tracks, pairs further apart than max_distance are not matched
+        if len(detections) == 0 or len(track_ids) == 0:
+            return []
+        predicted = np.stack([self.tracks[id].predict(time,self.max_prediction) for id in track_ids])
+        cost = np.linalg.norm(positions[detections][:,np.newaxis] - predicted[np.newaxis],axis=-1)
+        gated = np.where(cost <= max_distance,cost,max_distance * 1e3)
+        rows,cols = linear_sum_assignment(gated)
+        return [(detections[r],track_ids[c]) for r,c in zip(rows,cols) if cost[r,c] <= max_distance]
+
+    def assign(self,poses,poses_3D,poses_3D_valid,time):
+        # Body id for each pose
+        positions = self.positions(poses_3D,poses_3D_valid)
+        located = [i for i in range(len(poses)) if not np.isnan(positions[i]).any()]
+        ids = [None]*len(poses)
+
+        # Visible bodies first, then lost ones
+        active = [id for id in self.tracks if not self.tracks[id].lost]
+        for i,id in self.match(positions,located,active,time,self.max_distance):
+            ids[i] = id
+        remaining = [i for i in located if ids[i] is None]
+        lost = [id for id in self.tracks if self.tracks[id].lost]
+        for i,id in self.match(positions,remaining,lost,time,self.lost_distance):
+            ids[i] = id
+            self.revived += 1
+
+        # Without depth, fall back to OpenDR's own tracking
+        taken = set(id for id in ids if id is not None)
+        for i,pose in enumerate(poses):
+            if ids[i] is None and i not in located:
+                id = self.pose_ids.get(pose.id)
+                if id in self.tracks and id not in taken:
+                    ids[i] = id
+                    taken.add(id)
+
+        pose_ids = {}
+        for i,pose in enumerate(poses):
+            position = positions[i] if i in located else None
+            if ids[i] is None:
+                ids[i] = RandomID.random_id(self.next_id)
+                self.next_id += 1
+                self.created += 1
+                self.tracks[ids[i]] = BodyTrack(ids[i],position,time)
+            else:
+                self.tracks[ids[i]].update(position,time,self.smoothing)
+            pose_ids[pose.id] = ids[i]
+        self.pose_ids = pose_ids
+        return ids
+
+    def lose(self,time):
+        # Ids of the visible bodies that have not been seen for timeout seconds
+        lost = []
+        for id,track in self.tracks.items():
+            if not track.lost and time - track.time > self.timeout:
+                track.lost = True
+                lost.append(id)
+        return lost
+
+    def expire(self,time):
+        # Ids of the lost bodies that have not come back within lost_time seconds
+        expired = [id for id,track in self.tracks.items() if track.lost and time - track.time > self.lost_time]
+        for id in expired:
+            del self.tracks[id]
+        return expired
@@ -1,14 +1,16 @@
 import numpy as np
 import rospy
 import tf
-import networkx as nx
-from collections import Counter
-
-from engage.utils import VectorHelper,RandomID
+from engage.utils import VectorHelper
+from engage import geometry
+from engage.history import RollingStatistics,RollingCounts
+from engage.groups import GroupTracker,connected_components
+from engage.neighbours import SparsePairs,neighbour_pairs
 from engage.pose_helper import HRIPoseBody
+from engage.topic_pool import TopicHandles,HandlePool
 
 from message_filters import ApproximateTimeSynchronizer, Subscriber
-from engage.msg import MotionActivity,Group,EngagementLevel,EngagementValue,PoseArrayUncertain
+from engage.msg import MotionActivity,Group,EngagementLevel,EngagementMatrix,EngagementValue,PoseArrayUncertain
 from geometry_msgs.msg import TwistStamped,Vector3Stamped
 
 
@@ -16,10 +18,12 @@ class HRIEngageBody:
     def __init__(self,
                  id,
                  time,
-                 window_size=20,
+                 window_time=1,
                  velocity_threshold=0.3,
                  face_cone=20,
                  velocity_angle=30,
+                 subscribe=True,
+                 handles=None,
                  camera_frame="camera",
                  world_frame="world"
                 ):
@@ -28,33 +32,20 @@ class HRIEngageBody:
         self.velocity_threshold=velocity_threshold
         self.face_cone=face_cone
         self.velocity_angle=velocity_angle
-        self.window_size = window_size
+        # Engagement and motion are judged over the last window_time seconds, whatever the rate
+        self.window_time = window_time
         self.camera_frame = camera_frame
         self.world_frame = world_frame
+        self.subscribe = subscribe
 
-        # Subscribers
-        body_topic = "/humans/bodies/{}/".format(self.id)
-        self.pose_sub = Subscriber(body_topic+"poses",PoseArrayUncertain)
-        self.vel_sub = Subscriber(body_topic+"velocity",TwistStamped)
-        self.body_or_sub = Subscriber(body_topic+"body_orientation",Vector3Stamped)
-        self.face_or_sub = Subscriber(body_topic+"face_orientation",Vector3Stamped)
-
-        time_slop = 1
-        self.synch_sub = ApproximateTimeSynchronizer(
-            [
-                self.pose_sub,
-                self.vel_sub,
-                self.body_or_sub,
-                self.face_or_sub
-            ],
-            10,
-            time_slop,
-        )
-        self.synch_sub.registerCallback(self.update_body)
-
-        # Publishers
-        self.engagement_publisher = rospy.Publisher(body_topic+"engagement_status",EngagementLevel,queue_size=1)
-        self.activity_publisher = rospy.Publisher(body_topic+"activity",MotionActivity,queue_size=1)
+        # Subscribers and publishers. Handles from a pool are released by the manager, otherwise the body owns them
+        self.owns_handles = handles is None
+        if handles is None:
+            handles = HRIEngageBody.create_handles(self.id,subscribe)
+        handles.owner = self
+        self.handles = handles
+        self.engagement_publisher = handles.publishers["engagement_status"]
+        self.activity_publisher = handles.publishers["activity"]
 
         # Low level variables
         self.pose = None
@@ -68,30 +59,54 @@ class HRIEngageBody:
         self.distance_to_robot = None
         self.mutual_gaze_robot = None
         self.engagement_robot = None
-        self.engagement_history = []
-        self.engagement_history_size = window_size
+        self.engagement_history = RollingStatistics(window_time)
         self.engagement_level = EngagementLevel.UNKNOWN
         self.engagement_confidence = 0
-        self.update_robot_engagement(0)
 
         # Motion
         self.motion = MotionActivity.NOTHING
         self.motion_confidence = 0
-        self.motion_history = []
-        self.motion_history_size = window_size
+        self.motion_history = RollingCounts(window_time)
 
     def __str__(self) -> str:
         return self.id
 
+    @staticmethod
+    def create_handles(id,subscribe=True):
+        handles = TopicHandles()
+        body_topic = "/humans/bodies/{}/".format(id)
+
+        # Subscribers, not needed when the manager reads the aggregated BodiesFrame
+        if subscribe:
+            pose_sub = handles.subscriber(Subscriber(body_topic+"poses",PoseArrayUncertain))
+            vel_sub = handles.subscriber(Subscriber(body_topic+"velocity",TwistStamped))
+            body_or_sub = handles.subscriber(Subscriber(body_topic+"body_orientation",Vector3Stamped))
+            face_or_sub = handles.subscriber(Subscriber(body_topic+"face_orientation",Vector3Stamped))
+
+            time_slop = 1
+            handles.synch_sub = ApproximateTimeSynchronizer(
+                [
+                    pose_sub,
+                    vel_sub,
+                    body_or_sub,
+                    face_or_sub
+                ],
+                10,
+                time_slop,
+            )
+            handles.synch_sub.registerCallback(handles.forward("update_body"))
+
+        # Publishers
+        handles.publisher("engagement_status",body_topic+"engagement_status",EngagementLevel)
+        handles.publisher("activity",body_topic+"activity",MotionActivity)
+        return handles
+
     def close(self):
-        # Unregister subscribers
-        self.pose_sub.sub.unregister()
-        self.vel_sub.sub.unregister()
-        self.body_or_sub.sub.unregister()
-        self.face_or_sub.sub.unregister()
-        # Unregister publishers
-        self.engagement_publisher.unregister()
-        self.activity_publisher.unregister()
+        # Unregister subscribers and publishers
+        if self.handles.owner is self:
+            self.handles.owner = None
+        if self.owns_handles:
+            self.handles.close()
 
     def update_body(self,pose_msg,vel_msg,body_or_msg,face_or_msg):
         # Update pose
@@ -104,12 +119,7 @@ class HRIEngageBody:
                 self.pose.append(None)
             else:
                 self.pose.append(VectorHelper.obj_to_vec(pt))
-        if self.pose[HRIPoseBody.joints["neck"]] is not None:
-            self.position = self.pose[HRIPoseBody.joints["neck"]]
-        elif self.pose[HRIPoseBody.joints["nose"]] is not None:
-            self.position = self.pose[HRIPoseBody.joints["nose"]]
-        else:
-            self.position = None
+        self.update_position()
 
         # Update velocity
         self.velocity = VectorHelper.obj_to_vec(vel_msg.twist.linear)
@@ -128,21 +138,38 @@ class HRIEngageBody:
         else:
             self.face_norm = VectorHelper.obj_to_vec(fnorm)
 
+    def update_body_from_frame(self,pose,pose_valid,pose_confidence,velocity,body_norm,face_norm):
+        # One body's rows of a BodiesFrame, with None for unknown vectors
+        self.pose = [pose[i].copy() if pose_valid[i] else None for i in range(len(pose))]
+        self.pose_confidence = pose_confidence
+        self.update_position()
+        # Unknown velocities are published as zero on the per-body topic
+        self.velocity = velocity if velocity is not None else np.zeros(3)
+        self.body_norm = body_norm
+        self.face_norm = face_norm
+
+    def update_position(self):
+        if self.pose[HRIPoseBody.joints["neck"]] is not None:
+            self.position = self.pose[HRIPoseBody.joints["neck"]]
+        elif self.pose[HRIPoseBody.joints["nose"]] is not None:
+            self.position = self.pose[HRIPoseBody.joints["nose"]]
+        else:
+            self.position = None
+
     def update_time(self,time):
         self.time = time
 
     def update_robot_engagement(self,engagement):
-        if len(self.engagement_history) < self.engagement_history_size:
+        time = self.time.to_sec()
+        if not self.engagement_history.full(time):
             # Not enough data
             if engagement != 0:
-                self.engagement_history.append(engagement)
+                self.engagement_history.append(time,engagement)
         else:
-            # Add new data point
-            self.engagement_history.append(engagement)
-            # Keep window size the same
-            self.engagement_history = self.engagement_history[-self.engagement_history_size:]
+            # Add new data point, older ones leave the window
+            self.engagement_history.append(time,engagement)
             # Average engagement
-            average_engagement = sum(self.engagement_history)/self.engagement_history_size
+            average_engagement = self.engagement_history.mean()
 
             # Update engagement level
             old_engagement = self.engagement_level
@@ -175,7 +202,7 @@ class HRIEngageBody:
                 elif average_engagement <= 0.0:
                     # Continued downward trend, disengage
                     self.engagement_level = EngagementLevel.DISENGAGED
-        variance = np.var(self.engagement_history)
+        variance = self.engagement_history.variance()
         self.engagement_confidence = 1-variance
 
     '''
@@ -194,14 +221,11 @@ class HRIEngageBody:
         else:
             curr_activity = MotionActivity.NOTHING
 
-        self.motion_history.append(curr_activity)
-        if len(self.motion_history) > self.motion_history_size:
-            self.motion_history = self.motion_history[-self.motion_history_size:]
-
-        if len(self.motion_history) == self.motion_history_size:
-            counted = Counter(self.motion_history).most_common(1)
-            self.motion = counted[-1][0]
-            self.motion_confidence = counted[-1][1]/self.motion_history_size
+        time = self.time.to_sec()
+        self.motion_history.append(time,curr_activity)
+        if self.motion_history.full(time):
+            # Majority activity over the window
+            self.motion,self.motion_confidence = self.motion_history.most_common()
 
     def walking_towards_robot(self,robot_position):
         return VectorHelper.facing_point(self.velocity,self.position,robot_position,self.velocity_angle)
@@ -230,27 +254,48 @@ class HRIEngageBody:
 
 
 class HRIEngagementManager:
+    engagement_outputs = ["values","matrix","both"]
+
     def __init__(self,
                  engagement_threshold=0.55,
                  max_mutual_gaze_angle=np.pi,
-                 window_size=20,
+                 window_time=1,
                  ignore_z=True,
                  velocity_threshold=0.3,
                  face_cone=20,
                  velocity_angle=30,
+                 bodies_frame=False,
+                 handle_retire_time=10,
+                 vectorised=True,
+                 spatial_index=False,
+                 engagement_output="values",
+                 lost_time=3,
                  camera_frame="camera",
                  world_frame="world"
                  ):
         # Parameters
         self.engagement_threshold = engagement_threshold
         self.max_mutual_gaze_angle = max_mutual_gaze_angle
-        self.window_size = window_size
+        self.window_time = window_time
         self.velocity_threshold=velocity_threshold
         self.face_cone=face_cone
         self.velocity_angle=velocity_angle
         self.camera_frame = camera_frame
         self.world_frame = world_frame
         self.ignore_z = ignore_z
+        # If True, body data comes from BodiesFrame messages instead of per-body subscribers
+        self.bodies_frame = bodies_frame
+        # If True, engagement is calculated for all pairs at once with arrays, rather than pair by pair
+        self.vectorised = vectorised
+        # If True, only pairs close enough to pass the engagement threshold are calculated, found with
+        # a KD-tree, and the results are stored sparsely
+        self.spatial_index = spatial_index
+        # Whether engagements are published as one EngagementValue per pair, one EngagementMatrix per frame, or both
+        if engagement_output not in HRIEngagementManager.engagement_outputs:
+            raise ValueError("Unknown engagement output '{}', expected one of {}".format(engagement_output,HRIEngagementManager.engagement_outputs))
+        self.engagement_output = engagement_output
+        # Seconds a body that leaves the tracked bodies is kept for, with its histories, in case it comes back
+        self.lost_time = lost_time
 
         # Time
         self.time = None
@@ -258,6 +303,16 @@ class HRIEngagementManager:
         # Managed dicts
         self.bodies = {}
         self.groups = {}
+        # Body id to (body, time it was lost). Lost bodies take no part in engagement or groups
+        self.lost_bodies = {}
+        # Group of each body and the robot, as arrays of the last calculate_groups
+        self.group_tracker = GroupTracker()
+        self.group_nodes = []
+        self.group_labels = np.zeros(0,dtype=int)
+        self.group_ids = []
+        self.group_sizes = np.zeros(0,dtype=int)
+        # Per-body topics are kept for a while after a body leaves, in case it comes back
+        self.topic_pool = HandlePool("engagement",retire_time=handle_retire_time)
 
         # Robot's position and orientation
         self.robot_position = [0,0,0]
@@ -265,6 +320,7 @@ class HRIEngagementManager:
 
         # Publishers
         self.engagement_value_publisher = rospy.Publisher("/humans/interactions/engagements",EngagementValue,queue_size=100)
+        self.engagement_matrix_publisher = rospy.Publisher("/humans/interactions/engagement_matrix",EngagementMatrix,queue_size=10)
         self.group_publisher = rospy.Publisher("/humans/interactions/groups",Group,queue_size=100)
 
         # Debug
@@ -296,17 +352,24 @@ class HRIEngagementManager:
         tracked_ids = set(ids)
         managed_ids = set(self.bodies.keys())
 
-        # Add new ids
+        # Add new ids, bringing back recently lost bodies with their histories
         ids_to_add = list(tracked_ids - managed_ids)
         for id in ids_to_add:
+            if id in self.lost_bodies:
+                self.bodies[id],_ = self.lost_bodies.pop(id)
+                self.groups[id] = None
+                continue
             self.num_bodies_added += 1
+            handles = self.topic_pool.acquire(id,lambda: HRIEngageBody.create_handles(id,not self.bodies_frame))
             self.bodies[id] = HRIEngageBody(
                 id,
                 time,
-                window_size=self.window_size,
+                window_time=self.window_time,
                 velocity_threshold=self.velocity_threshold,
                 velocity_angle=self.velocity_angle,
                 face_cone=self.face_cone,
+                subscribe=not self.bodies_frame,
+                handles=handles,
                 camera_frame=self.camera_frame,
                 world_frame=self.world_frame
                 )
@@ -314,22 +377,59 @@ class HRIEngagementManager:
         if "ROBOT" not in self.groups:
             self.groups["ROBOT"] = None
         
-        # Remove old bodies
+        # Bodies that leave are kept aside, the pose node's tracker may give the person the same id back
         ids_to_rem = list(managed_ids - tracked_ids)
         for id in ids_to_rem:
-            self.bodies[id].close()
-            del self.bodies[id]
+            self.lost_bodies[id] = (self.bodies.pop(id),time)
             del self.groups[id]
 
+        # Remove bodies that have been lost for too long
+        ids_to_expire = [id for id,(_,lost) in self.lost_bodies.items() if (time - lost).to_sec() > self.lost_time]
+        for id in ids_to_expire:
+            body,_ = self.lost_bodies.pop(id)
+            body.close()
+            self.topic_pool.release(id)
+        self.topic_pool.collect()
+
         # Update time
         for body in self.bodies:
             self.bodies[body].update_time(time)
 
+    def update_bodies_frame(self,frame):
+        # Unpack a BodiesFrame into the bodies, which must already be managed
+        num_bodies = len(frame.bodies)
+        num_keypoints = frame.num_keypoints
+        keypoints = np.array(frame.keypoints).reshape(num_bodies,num_keypoints,3)
+        keypoints_valid = np.frombuffer(bytes(frame.keypoints_valid),dtype=np.uint8).reshape(num_bodies,num_keypoints)
+
+        def vectors(values,valid):
+            values = np.array(values).reshape(num_bodies,3)
+            valid = np.frombuffer(bytes(valid),dtype=np.uint8)
+            return [values[i] if valid[i] else None for i in range(num_bodies)]
+
+        velocities = vectors(frame.velocities,frame.velocities_valid)
+        body_normals = vectors(frame.body_normals,frame.body_normals_valid)
+        face_normals = vectors(frame.face_normals,frame.face_normals_valid)
+        for i,id in enumerate(frame.bodies):
+            self.bodies[id].update_body_from_frame(
+                keypoints[i],
+                keypoints_valid[i],
+                frame.confidences[i],
+                velocities[i],
+                body_normals[i],
+                face_normals[i]
+            )
+
     '''
     Engagement
     '''
 
     def calculate_engagement(self):
+        if self.spatial_index:
+            return self.calculate_engagement_sparse()
+        if self.vectorised:
+            return self.calculate_engagement_arrays()
+
         body_keys = list(self.bodies.keys())
         num_bodies = len(body_keys)
         body_indices = {body_keys[i]:i for i in range(num_bodies)}
@@ -350,7 +450,7 @@ class HRIEngagementManager:
             TODO: Maybe try use face and switch to body if faces can't be used?
             '''
             if pair[1] == "ROBOT":
-                distance = VectorHelper.distance(body_a.position,robot_position)
+                distance = VectorHelper.distance(self.ground(body_a.position),self.ground(robot_position))
                 _,_,mutual_gaze = self.mutual_gaze(body_a.position,robot_position,body_a.face_norm,robot_orientation)
                 engagement = self.engagement(distance,mutual_gaze)
 
@@ -364,7 +464,7 @@ class HRIEngagementManager:
                     body_a.update_robot_engagement(-1)
             else:
                 body_b = self.bodies[pair[1]]
-                distance = VectorHelper.distance(body_a.position,body_b.position)
+                distance = VectorHelper.distance(self.ground(body_a.position),self.ground(body_b.position))
                 _,_,mutual_gaze = self.mutual_gaze(body_a.position,body_b.position,body_a.body_norm,body_b.body_norm)
                 engagement = self.engagement(distance,mutual_gaze)
 
@@ -375,12 +475,105 @@ class HRIEngagementManager:
         return distances,mutual_gazes,engagements
 
 
-    def mutual_gaze(self,pos_a,pos_b,or_a,or_b):
-        vecs = [pos_a,pos_b,or_a,or_b]
+    def calculate_engagement_arrays(self):
+        # The same results as the pair by pair calculation, for every pair at once
+        bodies = list(self.bodies.values())
+        num_bodies = len(bodies)
+        positions,positions_valid = self.body_vectors(bodies,"position")
+        body_norms,body_norms_valid = self.body_vectors(bodies,"body_norm")
+
+        # Between people, using their body orientations. Only the upper triangle is filled, like before
+        upper = np.triu(np.ones((num_bodies,num_bodies),dtype=bool),k=1)
+        located = positions_valid[:,np.newaxis] & positions_valid[np.newaxis]
+        oriented = located & body_norms_valid[:,np.newaxis] & body_norms_valid[np.newaxis]
+        # gazes[i,j] is how directly i faces j
+        gazes = geometry.gaze_scores(positions,body_norms,positions,self.max_mutual_gaze_angle)
+        distances = np.where(located,geometry.distances(positions[:,np.newaxis],positions[np.newaxis]),np.nan)
+        mutual_gazes = np.where(oriented,gazes*gazes.T,np.nan)
+        engagements = self.engagement_values(distances,mutual_gazes)
+        distances = np.where(upper,distances,0)
+        mutual_gazes = np.where(upper,mutual_gazes,0)
+        engagements = np.where(upper,engagements,0)
+
+        self.calculate_robot_engagement(bodies,positions,positions_valid)
+        return distances,mutual_gazes,engagements
+
+    def calculate_engagement_sparse(self):
+        # Like calculate_engagement_arrays, for only the pairs within reach of the threshold
+        bodies = list(self.bodies.values())
+        num_bodies = len(bodies)
+        positions,positions_valid = self.body_vectors(bodies,"position")
+        body_norms,body_norms_valid = self.body_vectors(bodies,"body_norm")
+
+        rows,cols = neighbour_pairs(positions,positions_valid,self.reachable_distance())
+        distances = geometry.distances(positions[rows],positions[cols])
+        oriented = body_norms_valid[rows] & body_norms_valid[cols]
+        gazes_ab = geometry.pair_gaze_scores(positions[rows],body_norms[rows],positions[cols],self.max_mutual_gaze_angle)
+        gazes_ba = geometry.pair_gaze_scores(positions[cols],body_norms[cols],positions[rows],self.max_mutual_gaze_angle)
+        mutual_gazes = np.where(oriented,gazes_ab*gazes_ba,np.nan)
+        engagements = self.engagement_values(distances,mutual_gazes)
+
+        self.calculate_robot_engagement(bodies,positions,positions_valid)
+        return (SparsePairs(num_bodies,rows,cols,distances),
+                SparsePairs(num_bodies,rows,cols,mutual_gazes),
+                SparsePairs(num_bodies,rows,cols,engagements))
+
+    def reachable_distance(self):
+        # Mutual gaze is at most 1, so people further apart than this can not pass the threshold
+        if self.engagement_threshold <= 0:
+            return np.inf
+        return 1 / self.engagement_threshold
+
+    def calculate_robot_engagement(self,bodies,positions,positions_valid):
+        # With the robot, using people's face orientations
+        face_norms,face_norms_valid = self.body_vectors(bodies,"face_norm")
+        robot_position = self.ground(self.robot_position)[np.newaxis]
+        robot_orientation = self.ground(self.robot_orientation)[np.newaxis]
+        robot_distances = geometry.distances(positions,robot_position)
+        robot_gazes = geometry.gaze_scores(positions,face_norms,robot_position,self.max_mutual_gaze_angle)[:,0]
+        gazes_at_robot = geometry.gaze_scores(robot_position,robot_orientation,positions,self.max_mutual_gaze_angle)[0]
+        robot_mutual_gazes = np.where(positions_valid & face_norms_valid,robot_gazes*gazes_at_robot,np.nan)
+        robot_engagements = self.engagement_values(np.where(positions_valid,robot_distances,np.nan),robot_mutual_gazes)
+        for i,body in enumerate(bodies):
+            body.distance_to_robot = float(robot_distances[i]) if positions_valid[i] else None
+            body.mutual_gaze_robot = float(robot_mutual_gazes[i]) if not np.isnan(robot_mutual_gazes[i]) else None
+            body.engagement_robot = float(robot_engagements[i])
+            if robot_engagements[i] > self.engagement_threshold:
+                body.update_robot_engagement(1)
+            else:
+                body.update_robot_engagement(-1)
+
+    def body_vectors(self,bodies,name):
+        # (N,3) array of a vector attribute of each body, in the ground plane when ignoring z, and its mask
+        values = np.zeros((len(bodies),3))
+        valid = np.zeros(len(bodies),dtype=bool)
+        for i,body in enumerate(bodies):
+            vector = getattr(body,name)
+            if vector is not None:
+                values[i] = vector
+                valid[i] = True
+        if self.ignore_z:
+            values[:,2] = 0
+        return values,valid
+
+    def ground(self,vector):
+        # Copy of the vector, in the ground plane when ignoring z
+        if vector is None:
+            return None
+        vector = np.array(vector,dtype=float)
         if self.ignore_z:
-            for i in range(len(vecs)):
-                if vecs[i] is not None:
-                    vecs[i][2] = 0
+            vector[2] = 0
+        return vector
+
+    def engagement_values(self,distances,mutual_gazes):
+        # Array version of engagement, nan marks a missing distance or mutual gaze
+        known = np.isfinite(distances) & (distances != 0) & np.isfinite(mutual_gazes)
+        with np.errstate(invalid="ignore",divide="ignore"):
+            return np.where(known,np.minimum(1,mutual_gazes/distances),0)
+
+    def mutual_gaze(self,pos_a,pos_b,or_a,or_b):
+        # Copies, zeroing z in place used to flatten the bodies' own positions and orientations
+        vecs = [self.ground(vec) for vec in [pos_a,pos_b,or_a,or_b]]
 
         if vecs[0] is None or vecs[1] is None:
             return None,None,None
@@ -425,89 +618,84 @@ class HRIEngagementManager:
     Groups
     '''
     def calculate_groups(self,engagements):
-        self.create_group_graph(engagements)
-        group_sizes = self.divide_into_groups()
-        group_confidences = self.group_confidences(group_sizes,engagements)
-        return group_confidences
+        # Connected components of the engagement graph, with the robot as the last node
+        self.group_nodes = list(self.bodies.keys()) + ["ROBOT"]
+        rows,cols = self.group_edges(engagements)
+        self.group_labels = connected_components(len(self.group_nodes),rows,cols)
+        self.group_ids = self.group_tracker.update(self.group_nodes,self.group_labels)
+        self.group_sizes = np.bincount(self.group_labels,minlength=len(self.group_ids))
+        for i,id in enumerate(self.group_nodes):
+            self.groups[id] = self.group_ids[self.group_labels[i]]
+        return self.group_confidences(engagements)
+
+    def group_edges(self,engagements):
+        # Pairs engaged with each other, and engaged bodies with the robot
+        if isinstance(engagements,SparsePairs):
+            rows,cols = engagements.above(self.engagement_threshold)
+        else:
+            rows,cols = np.nonzero(np.triu(engagements > self.engagement_threshold,k=1))
+        engaged = [i for i,body in enumerate(self.bodies.values()) if body.engagement_level == EngagementLevel.ENGAGED]
+        robot = len(self.bodies)
+        return np.concatenate([rows,engaged]).astype(int),np.concatenate([cols,[robot]*len(engaged)]).astype(int)
 
     def create_group_graph(self,engagements):
-        self.group_graph = nx.Graph()
+        # The engagement graph as a networkx graph, for offline analysis
+        import networkx as nx
+        if isinstance(engagements,SparsePairs):
+            engagements = engagements.dense()
+        group_graph = nx.Graph()
         body_keys = list(self.bodies.keys())
-        self.group_graph.add_nodes_from(body_keys)
-        self.group_graph.add_node("ROBOT")
+        group_graph.add_nodes_from(body_keys)
+        group_graph.add_node("ROBOT")
         for i in range(len(body_keys)):
             # Check for other bodies
             for j in range(i+1,len(body_keys)):
                 if engagements[i,j] > self.engagement_threshold:
-                    self.group_graph.add_edge(body_keys[i],body_keys[j],weight=engagements[i,j])
+                    group_graph.add_edge(body_keys[i],body_keys[j],weight=engagements[i,j])
             # Check for robot
             if self.bodies[body_keys[i]].engagement_level == EngagementLevel.ENGAGED:
-                self.group_graph.add_edge(body_keys[i],"ROBOT",weight=self.bodies[body_keys[i]].engagement_confidence)
-
-    def divide_into_groups(self):
-        sub_graphs = [self.group_graph.subgraph(c) for c in nx.connected_components(self.group_graph)]
-        used_g_ids = []
-        group_sizes = {}
-        curr_group_id = 100000
-        for sg in sub_graphs:
-            sg_list = list(sg)
-            existing_groups = [self.groups[id] for id in sg.nodes]
-            pruned_list = [g for g in existing_groups if g is not None]
-            if pruned_list == []:
-                # Nobody in the group already had a group, make a new one
-                g_id = RandomID.random_id(curr_group_id)
-                curr_group_id += 1
-            else:
-                if pruned_list[0] in used_g_ids:
-                    # Old group name already in use (e.g. 1 group split into 2), must create new one
-                    g_id = RandomID.random_id(curr_group_id)
-                    curr_group_id += 1
-                else:
-                    g_id = pruned_list[0]
-            used_g_ids.append(g_id)
-            for id in sg.nodes:
-                self.groups[id] = g_id
-
-            group_sizes[g_id] = len(sg_list)
-        return group_sizes
-    
-    def group_confidences(self,group_sizes,engagements):
-        # Group confidences
-        group_confidences = {}
-        body_keys = list(self.bodies.keys())
-        robot_engagements = [0]
-        for i in range(len(body_keys)):
-            body = self.bodies[body_keys[i]]
-            max_engagement = max(max(engagements[i,:]),max(engagements[:,i]),body.engagement_robot)
-            robot_engagements.append(body.engagement_robot)
-            if group_sizes[self.groups[body.id]] == 1:
-                # Only the one individual
-                group_confidences[body.id] = 1 - max_engagement
-            else:
-                # Part of a group
-                group_confidences[body.id] = max_engagement
-        
-        # Robot group confidence
-        max_robot_engagement = max(robot_engagements)
-        if group_sizes[self.groups["ROBOT"]] == 1:
-            group_confidences["ROBOT"] = 1 - max_robot_engagement
+                group_graph.add_edge(body_keys[i],"ROBOT",weight=self.bodies[body_keys[i]].engagement_confidence)
+        return group_graph
+
+    def group_confidences(self,engagements):
+        # Confidence of each node of the last calculate_groups: for people alone, that they are not
+        # engaged with anyone, otherwise their strongest engagement
+        robot_engagements = np.array([body.engagement_robot if body.engagement_robot is not None else 0
+                                      for body in self.bodies.values()],dtype=float)
+        if isinstance(engagements,SparsePairs):
+            max_engagements = np.maximum(engagements.node_max(),robot_engagements)
+            max_robot_engagement = max([0] + robot_engagements.tolist())
+        elif len(robot_engagements) > 0:
+            max_engagements = np.maximum(np.maximum(engagements.max(axis=1),engagements.max(axis=0)),robot_engagements)
+            max_robot_engagement = max(0,robot_engagements.max())
         else:
-            group_confidences["ROBOT"] = max_robot_engagement
-
-        return group_confidences
+            max_engagements = robot_engagements
+            max_robot_engagement = 0
+        max_engagements = np.append(max_engagements,max_robot_engagement)
+        alone = self.group_sizes[self.group_labels] == 1
+        return np.where(alone,1 - max_engagements,max_engagements)
 
     '''
     Publishing
     '''
 
     def publish_engagements(self,distances,mutual_gazes,engagements):
+        # Engagement levels
+        for body in self.bodies.values():
+            body.publish_engagement()
+
+        if self.engagement_output in ["values","both"]:
+            self.publish_engagement_values(distances,mutual_gazes,engagements)
+        if self.engagement_output in ["matrix","both"]:
+            self.publish_engagement_matrix(distances,mutual_gazes,engagements)
+
+    def publish_engagement_values(self,distances,mutual_gazes,engagements):
         body_keys = list(self.bodies.keys())
+        # Sparse results only hold the pairs of located bodies within reach of the threshold
+        sparse = isinstance(engagements,SparsePairs)
         for i in range(len(body_keys)):
             body1 = self.bodies[body_keys[i]]
 
-            # Publish engagement level
-            body1.publish_engagement()
-
             if body1.position is None:
                 continue
 
@@ -525,39 +713,76 @@ class HRIEngagementManager:
             robot_eng.confidence_b = 1
             self.engagement_value_publisher.publish(robot_eng)
 
-
+            if sparse:
+                continue
             for j in range(i+1,len(body_keys)):
                 body2 = self.bodies[body_keys[j]]
 
                 if body2.position is None:
                     continue
 
-                eng_ij = EngagementValue()
-                eng_ij.person_a = body1.id
-                eng_ij.person_b = body2.id
-                if distances[i,j] is not None:
-                    eng_ij.distance = distances[i,j]
-                if mutual_gazes[i,j] is not None:
-                    eng_ij.mutual_gaze = mutual_gazes[i,j]
-                if engagements[i,j] is not None:
-                    eng_ij.engagement = engagements[i,j]
-                eng_ij.header.stamp = self.time
-                eng_ij.confidence_a = body1.pose_confidence
-                eng_ij.confidence_b = body2.pose_confidence
-                self.engagement_value_publisher.publish(eng_ij)
+                self.publish_pair_engagement(body1,body2,distances[i,j],mutual_gazes[i,j],engagements[i,j])
+
+        if sparse:
+            for k in range(len(engagements)):
+                body1 = self.bodies[body_keys[engagements.rows[k]]]
+                body2 = self.bodies[body_keys[engagements.cols[k]]]
+                self.publish_pair_engagement(body1,body2,distances.values[k],mutual_gazes.values[k],engagements.values[k])
+
+    def publish_engagement_matrix(self,distances,mutual_gazes,engagements):
+        bodies = list(self.bodies.values())
+        located = np.array([body.position is not None for body in bodies],dtype=bool)
+        if isinstance(engagements,SparsePairs):
+            rows,cols = engagements.rows,engagements.cols
+            distances,mutual_gazes,engagements = distances.values,mutual_gazes.values,engagements.values
+        else:
+            # Every pair of located bodies, as the per-pair messages
+            rows,cols = np.nonzero(np.triu(located[:,np.newaxis] & located[np.newaxis],k=1))
+            distances,mutual_gazes,engagements = distances[rows,cols],mutual_gazes[rows,cols],engagements[rows,cols]
+
+        def robot_values(name):
+            return [getattr(body,name) if getattr(body,name) is not None else 0 for body in bodies]
+
+        matrix = EngagementMatrix()
+        matrix.header.stamp = self.time
+        matrix.bodies = [body.id for body in bodies]
+        matrix.confidences = [body.pose_confidence for body in bodies]
+        matrix.robot_distances = robot_values("distance_to_robot")
+        matrix.robot_mutual_gazes = robot_values("mutual_gaze_robot")
+        matrix.robot_engagements = robot_values("engagement_robot")
+        matrix.robot_valid = located.astype(np.uint8).tobytes()
+        matrix.rows = rows.tolist()
+        matrix.cols = cols.tolist()
+        matrix.distances = np.asarray(distances,dtype=float).tolist()
+        matrix.mutual_gazes = np.asarray(mutual_gazes,dtype=float).tolist()
+        matrix.engagements = np.asarray(engagements,dtype=float).tolist()
+        self.engagement_matrix_publisher.publish(matrix)
+
+    def publish_pair_engagement(self,body1,body2,distance,mutual_gaze,engagement):
+        eng_ij = EngagementValue()
+        eng_ij.person_a = body1.id
+        eng_ij.person_b = body2.id
+        if distance is not None:
+            eng_ij.distance = distance
+        if mutual_gaze is not None:
+            eng_ij.mutual_gaze = mutual_gaze
+        if engagement is not None:
+            eng_ij.engagement = engagement
+        eng_ij.header.stamp = self.time
+        eng_ij.confidence_a = body1.pose_confidence
+        eng_ij.confidence_b = body2.pose_confidence
+        self.engagement_value_publisher.publish(eng_ij)
 
             
     def publish_groups(self,group_confidences):
-        groups = list(set(self.groups.values()))
-        for group in groups:
-            if group is None:
-                continue
-            members = [id for id,g in self.groups.items() if g==group]
-            confidences = [group_confidences[id] for id in members]
+        # Members of each group, from the nodes sorted by group
+        order = np.argsort(self.group_labels,kind="stable")
+        members = np.split(order,np.cumsum(self.group_sizes)[:-1])
+        for g,group in enumerate(self.group_ids):
             group_msg = Group()
             group_msg.group_id = group
-            group_msg.members = members
-            group_msg.confidences = confidences
+            group_msg.members = [self.group_nodes[i] for i in members[g]]
+            group_msg.confidences = group_confidences[members[g]].tolist()
             group_msg.header.stamp = self.time
             self.group_publisher.publish(group_msg)
 
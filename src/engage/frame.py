@@ -0,0 +1,84 @@
+import numpy as np
+import cv2
+
+from opendr.engine.data import Image as OpenDRImage
+
+# Number of channels and element type of the image encodings we expect from cameras
+encodings = {
+    "rgb8":(3,np.uint8),
+    "bgr8":(3,np.uint8),
+    "mono8":(1,np.uint8),
+    "16UC1":(1,np.uint16),
+    "mono16":(1,np.uint16),
+}
+
+def message_array(msg):
+    # View of a sensor_msgs/Image buffer as an (height,width,channels) array, without copying
+    channels,dtype = encodings[msg.encoding]
+    dtype = np.dtype(dtype).newbyteorder(">" if msg.is_bigendian else "<")
+    buffer = np.frombuffer(msg.data,dtype=np.uint8)
+    # Rows may be padded, so drop anything past the last pixel before reinterpreting
+    rows = buffer[:msg.height*msg.step].reshape(msg.height,msg.step)[:,:msg.width*channels*dtype.itemsize]
+    return rows.view(dtype).reshape(msg.height,msg.width,channels)
+
+
+class Frame:
+    '''
+    A synchronised colour and depth frame, decoded once and shared by everything that uses it.
+
+    Images from messages are views of the message buffers. Colour conversions and the OpenDR
+    image are made the first time they are asked for and then reused. All the views are read
+    only, use annotated() to get an image that can be drawn on.
+    '''
+    def __init__(self,time,colour,depth,encoding="bgr8"):
+        self.time = time
+        self.colour = colour
+        self.depth = depth
+        self.encoding = encoding
+        # False when the poses for this frame were propagated or reused rather than inferred on it
+        self.keyframe = True
+        # Input height and refinement stages of the inference that produced the poses
+        self.operating_point = None
+        self._bgr = None
+        self._rgb = None
+        self._opendr = None
+
+    @classmethod
+    def from_messages(cls,time,rgb_msg,depth_msg):
+        colour = message_array(rgb_msg)
+        depth = message_array(depth_msg)[...,0]
+        return cls(time,colour,depth,rgb_msg.encoding)
+
+    @property
+    def shape(self):
+        return self.colour.shape[:2]
+
+    @property
+    def bgr(self):
+        if self._bgr is None:
+            if self.encoding == "bgr8":
+                self._bgr = self.colour
+            elif self.encoding == "rgb8":
+                self._bgr = cv2.cvtColor(self.colour,cv2.COLOR_RGB2BGR)
+            else:
+                self._bgr = cv2.cvtColor(self.colour,cv2.COLOR_GRAY2BGR)
+        return self._bgr
+
+    @property
+    def rgb(self):
+        if self._rgb is None:
+            if self.encoding == "rgb8":
+                self._rgb = self.colour
+            else:
+                self._rgb = cv2.cvtColor(self.bgr,cv2.COLOR_BGR2RGB)
+        return self._rgb
+
+    def opendr(self):
+        # OpenDR images are CHW views of the BGR image
+        if self._opendr is None:
+            self._opendr = OpenDRImage(self.bgr)
+        return self._opendr
+
+    def annotated(self):
+        # Writable copy of the BGR image for drawing on
+        return self.bgr.copy()
@@ -0,0 +1,68 @@
+import numpy as np
+
+# Array versions of the engage.utils.VectorHelper operations, for every body at once.
+# Keypoints are (N,18,3) arrays in OpenDR's joint order with an (N,18) validity mask,
+# and results come with a mask instead of None for bodies they cannot be computed for.
+
+NOSE = 0
+R_SHO = 2
+L_SHO = 5
+R_HIP = 8
+L_HIP = 11
+R_EYE = 14
+L_EYE = 15
+
+def normalise(vectors,axis=-1):
+    # Unit vectors along axis, zero vectors are left as they are
+    norms = np.linalg.norm(vectors,axis=axis,keepdims=True)
+    return np.divide(vectors,norms,out=np.array(vectors,dtype=float),where=norms != 0)
+
+def normals(a,b,c):
+    # Unit normals of the triangles (a,b,c), as VectorHelper.get_normal([a,b,c])
+    return normalise(np.cross(b - a,c - a))
+
+def distances(a,b):
+    return np.linalg.norm(a - b,axis=-1)
+
+def angles_between(a,b):
+    cosines = np.sum(a*b,axis=-1) / (np.linalg.norm(a,axis=-1)*np.linalg.norm(b,axis=-1))
+    return np.arccos(np.clip(cosines,-1,1))
+
+def pair_gaze_scores(origins,directions,targets,max_angle):
+    '''
+    How directly each gaze, from origins along directions, points at the matching target:
+    1 straight at it, falling to 0 at max_angle away. Arrays broadcast against each other, and
+    the score is 0 where the angle is undefined (e.g. a target at the origin), as the scalar
+    version does.
+    '''
+    with np.errstate(invalid="ignore",divide="ignore"):
+        scores = 1 - angles_between(directions,targets - origins)/max_angle
+    return np.where(scores > 0,scores,0)
+
+def gaze_scores(origins,directions,targets,max_angle):
+    # (N,M) scores of each of N gazes at each of M targets
+    return pair_gaze_scores(origins[:,np.newaxis],directions[:,np.newaxis],targets[np.newaxis],max_angle)
+
+def hip_midpoints(keypoints,valid):
+    midpoints = (keypoints[:,L_HIP] + keypoints[:,R_HIP]) / 2
+    return midpoints,valid[:,L_HIP] & valid[:,R_HIP]
+
+def body_normals(keypoints,valid):
+    '''
+    Torso normals from the shoulders and the hip midpoint, or the shoulders and the nose when
+    a hip is missing (with the opposite winding). Both shoulders are required.
+    '''
+    shoulders = valid[:,R_SHO] & valid[:,L_SHO]
+    waists,waists_valid = hip_midpoints(keypoints,valid)
+    use_waist = waists_valid[:,np.newaxis]
+    third = np.where(use_waist,waists,keypoints[:,NOSE])
+    result = normals(keypoints[:,R_SHO],keypoints[:,L_SHO],third)
+    result = np.where(use_waist,-result,result)
+    return result,shoulders & (waists_valid | valid[:,NOSE])
+
+def face_normals(keypoints,valid):
+    # Face normals from the eyes and the nose, with the nose moved to the eyes' mean depth (x)
+    nose = keypoints[:,NOSE].copy()
+    nose[:,0] = (keypoints[:,R_EYE,0] + keypoints[:,L_EYE,0]) / 2
+    result = -normals(keypoints[:,R_EYE],keypoints[:,L_EYE],nose)
+    return result,valid[:,R_EYE] & valid[:,L_EYE] & valid[:,NOSE]
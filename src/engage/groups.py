@@ -0,0 +1,68 @@
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from engage.utils import RandomID
+
+def find(parent,i):
+    # Root of i, halving the path on the way
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+def connected_components(num_nodes,rows,cols):
+    '''
+    Connected components of an undirected graph with num_nodes nodes and the edges (rows[k],cols[k]),
+    with union-find. Returns an array with each node's component, numbered from 0 in order of
+    each component's first node.
+    '''
+    parent = list(range(num_nodes))
+    for a,b in zip(np.asarray(rows).tolist(),np.asarray(cols).tolist()):
+        root_a = find(parent,a)
+        root_b = find(parent,b)
+        if root_a != root_b:
+            # The lowest index is the root, so that components are numbered in node order
+            parent[max(root_a,root_b)] = min(root_a,root_b)
+    roots = [find(parent,i) for i in range(num_nodes)]
+    _,labels = np.unique(np.array(roots,dtype=int),return_inverse=True)
+    return labels.reshape(-1)
+
+
+class GroupTracker:
+    '''
+    Keeps group ids stable from frame to frame.
+
+    Each frame's groups are matched to the previous frame's by how many members they share,
+    with the Hungarian algorithm, and take over the id of the group they are matched to.
+    Groups without a match, e.g. one side of a group that split, get a new id.
+    '''
+    def __init__(self,first_id=100000):
+        self.next_id = first_id
+        # Member id to group id, from the last frame
+        self.previous = {}
+
+    def new_id(self):
+        id = RandomID.random_id(self.next_id)
+        self.next_id += 1
+        return id
+
+    def update(self,node_ids,labels):
+        # Group id of each component in labels
+        num_groups = int(labels.max()) + 1 if len(labels) > 0 else 0
+        group_ids = [None]*num_groups
+
+        known = [i for i,id in enumerate(node_ids) if self.previous.get(id) is not None]
+        if len(known) > 0:
+            old_ids,old_indices = np.unique([self.previous[node_ids[i]] for i in known],return_inverse=True)
+            overlap = np.zeros((num_groups,len(old_ids)),dtype=int)
+            np.add.at(overlap,(labels[known],old_indices.reshape(-1)),1)
+            rows,cols = linear_sum_assignment(-overlap)
+            for r,c in zip(rows,cols):
+                if overlap[r,c] > 0:
+                    group_ids[r] = str(old_ids[c])
+
+        for g in range(num_groups):
+            if group_ids[g] is None:
+                group_ids[g] = self.new_id()
+        self.previous = {id:group_ids[labels[i]] for i,id in enumerate(node_ids)}
+        return group_ids
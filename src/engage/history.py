@@ -0,0 +1,278 @@
+import numpy as np
+from collections import deque
+
+class RingBuffer:
+    '''
+    Fixed-size history of arrays with a validity mask and timestamps.
+
+    Every sample is written twice, at i and i+size, so the last n samples are always
+    available in chronological order as a contiguous view without copying.
+    '''
+    def __init__(self,size,shape=(),dtype=float):
+        self.size = size
+        self.shape = tuple(shape)
+        # Validity is tracked per vector, i.e. over all but the last axis
+        valid_shape = self.shape[:-1] if len(self.shape) > 0 else ()
+        self.data = np.zeros((2*size,)+self.shape,dtype=dtype)
+        self.valid = np.zeros((2*size,)+valid_shape,dtype=bool)
+        self.times = np.zeros(2*size)
+        self.index = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def full(self):
+        return self.count == self.size
+
+    def clear(self):
+        self.valid[:] = False
+        self.index = 0
+        self.count = 0
+
+    def append(self,value,valid=True,time=0):
+        i = self.index
+        self.data[i] = value
+        self.data[i+self.size] = value
+        self.valid[i] = valid
+        self.valid[i+self.size] = valid
+        self.times[i] = time
+        self.times[i+self.size] = time
+        self.index = (i+1) % self.size
+        self.count = min(self.count+1,self.size)
+
+    def window(self,n=None):
+        # Start and end of the last n samples in the mirrored storage
+        if n is None or n > self.count:
+            n = self.count
+        end = self.index + self.size
+        return end-n,end
+
+    def values(self,n=None):
+        start,end = self.window(n)
+        return self.data[start:end]
+
+    def valid_mask(self,n=None):
+        start,end = self.window(n)
+        return self.valid[start:end]
+
+    def timestamps(self,n=None):
+        start,end = self.window(n)
+        return self.times[start:end]
+
+    def latest(self):
+        # Most recent sample and its validity, or None if nothing has been added
+        if self.count == 0:
+            return None,None
+        i = self.index - 1 + self.size
+        return self.data[i],self.valid[i]
+
+
+class SlidingRegression:
+    '''
+    Least-squares slope of a vector against time over the last horizon seconds.
+
+    Running sums are updated as samples enter and leave the horizon, so each update is O(1).
+    Times are kept relative to a reference that is periodically moved forward, and the sums
+    recomputed, to stop rounding errors from building up.
+    '''
+    def __init__(self,horizon,dims=3,refresh=256):
+        self.horizon = horizon
+        self.dims = dims
+        self.refresh = refresh
+        self.samples = deque()
+        self.reset()
+
+    def reset(self):
+        self.samples.clear()
+        self.reference = None
+        self.removals = 0
+        self.n = 0
+        self.sum_t = 0.0
+        self.sum_tt = 0.0
+        self.sum_x = np.zeros(self.dims)
+        self.sum_tx = np.zeros(self.dims)
+
+    def __len__(self):
+        return self.n
+
+    def append(self,time,value):
+        if self.reference is None:
+            self.reference = time
+        t = time - self.reference
+        value = np.array(value,dtype=float)
+        self.samples.append((t,value))
+        self.n += 1
+        self.sum_t += t
+        self.sum_tt += t*t
+        self.sum_x += value
+        self.sum_tx += t*value
+        self.evict(time)
+
+    def evict(self,time):
+        # Drop samples older than the horizon, e.g. when the tracked point is missing
+        if self.reference is None:
+            return
+        cutoff = time - self.reference - self.horizon
+        while self.samples and self.samples[0][0] < cutoff:
+            t,value = self.samples.popleft()
+            self.n -= 1
+            self.sum_t -= t
+            self.sum_tt -= t*t
+            self.sum_x -= value
+            self.sum_tx -= t*value
+            self.removals += 1
+        if not self.samples:
+            self.reset()
+        elif self.removals >= self.refresh:
+            self.rebase()
+
+    def rebase(self):
+        # Move the reference to the oldest sample and recompute the sums exactly
+        shift = self.samples[0][0]
+        self.reference += shift
+        self.samples = deque((t-shift,value) for t,value in self.samples)
+        times = np.array([t for t,_ in self.samples])
+        values = np.stack([value for _,value in self.samples])
+        self.sum_t = times.sum()
+        self.sum_tt = (times*times).sum()
+        self.sum_x = values.sum(axis=0)
+        self.sum_tx = times @ values
+        self.removals = 0
+
+    def span(self):
+        if not self.samples:
+            return 0
+        return self.samples[-1][0] - self.samples[0][0]
+
+    def slope(self):
+        if self.n < 2:
+            return None
+        denominator = self.n*self.sum_tt - self.sum_t*self.sum_t
+        if denominator <= 1e-12:
+            return None
+        return (self.n*self.sum_tx - self.sum_t*self.sum_x) / denominator
+
+
+class RollingStatistics:
+    '''
+    Sum, mean and variance of the values added in the last window_time seconds.
+
+    The sum is kept as a running total, exact for whole numbers like the +-1 engagement votes,
+    and the variance with Welford's method, both updated as values enter and leave the window
+    so each update is O(1) however many samples the window holds. The variance is recomputed
+    every so often to stop rounding errors from building up.
+    '''
+    def __init__(self,window_time,refresh=256):
+        self.window_time = window_time
+        self.refresh = refresh
+        self.samples = deque()
+        self.start = None
+        self.reset()
+
+    def reset(self):
+        self.samples.clear()
+        self.removals = 0
+        self.n = 0
+        self.total = 0.0
+        # Welford's running mean and sum of squared deviations
+        self.running_mean = 0.0
+        self.m2 = 0.0
+
+    def __len__(self):
+        return self.n
+
+    def full(self,time):
+        # True once values have been added for a whole window
+        return self.start is not None and time - self.start >= self.window_time
+
+    def append(self,time,value):
+        if self.start is None:
+            self.start = time
+        self.samples.append((time,value))
+        self.n += 1
+        self.total += value
+        delta = value - self.running_mean
+        self.running_mean += delta / self.n
+        self.m2 += delta * (value - self.running_mean)
+        self.evict(time)
+
+    def evict(self,time):
+        cutoff = time - self.window_time
+        while self.samples and self.samples[0][0] <= cutoff:
+            _,value = self.samples.popleft()
+            self.n -= 1
+            self.total -= value
+            if self.n == 0:
+                self.total = 0.0
+                self.running_mean = 0.0
+                self.m2 = 0.0
+                continue
+            delta = value - self.running_mean
+            self.running_mean -= delta / self.n
+            self.m2 -= delta * (value - self.running_mean)
+            self.removals += 1
+        if self.removals >= self.refresh:
+            self.recompute()
+
+    def recompute(self):
+        values = np.array([value for _,value in self.samples],dtype=float)
+        self.total = values.sum()
+        self.running_mean = values.mean() if self.n > 0 else 0.0
+        self.m2 = ((values - self.running_mean)**2).sum() if self.n > 0 else 0.0
+        self.removals = 0
+
+    def sum(self):
+        return self.total
+
+    def mean(self):
+        if self.n == 0:
+            return 0.0
+        return self.total / self.n
+
+    def variance(self):
+        # Population variance, as np.var, 0 without any values
+        if self.n == 0:
+            return 0.0
+        return max(0.0,self.m2 / self.n)
+
+
+class RollingCounts:
+    '''
+    How often each category was added in the last window_time seconds, updated in O(1) as
+    categories enter and leave the window.
+    '''
+    def __init__(self,window_time):
+        self.window_time = window_time
+        self.samples = deque()
+        self.counts = {}
+        self.start = None
+
+    def __len__(self):
+        return len(self.samples)
+
+    def full(self,time):
+        # True once categories have been added for a whole window
+        return self.start is not None and time - self.start >= self.window_time
+
+    def append(self,time,category):
+        if self.start is None:
+            self.start = time
+        self.samples.append((time,category))
+        self.counts[category] = self.counts.get(category,0) + 1
+        self.evict(time)
+
+    def evict(self,time):
+        cutoff = time - self.window_time
+        while self.samples and self.samples[0][0] <= cutoff:
+            _,category = self.samples.popleft()
+            self.counts[category] -= 1
+            if self.counts[category] == 0:
+                del self.counts[category]
+
+    def most_common(self):
+        # The most frequent category and its share of the window, over the few categories there are
+        if len(self.samples) == 0:
+            return None,0
+        category = max(self.counts,key=self.counts.get)
+        return category,self.counts[category] / len(self.samples)
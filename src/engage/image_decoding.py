@@ -0,0 +1,103 @@
+import numpy as np
+import cv2
+
+# Decoding of sensor_msgs/CompressedImage messages from image_transport's compressed
+# (colour) and compressedDepth (depth) plugins into OpenCV arrays
+
+# compressedDepth messages start with a ConfigHeader: int32 format, float32 depthQuantA, float32 depthQuantB
+DEPTH_HEADER_SIZE = 12
+
+def decode_compressed_rgbd(rgb_msg,depth_msg):
+    # Decode a synchronised colour and depth pair, returning a BGR image and depth in millimetres
+    return decode_compressed_colour(rgb_msg),decode_compressed_depth(depth_msg)
+
+def decode_compressed_colour(msg):
+    buffer = np.frombuffer(msg.data,dtype=np.uint8)
+    image = cv2.imdecode(buffer,cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Could not decode compressed image with format '{}'".format(msg.format))
+    # The format reads "<source encoding>; <codec> compressed <encoded encoding>", image_transport
+    # converts colour images to bgr8 before encoding, so only an rgb payload needs swapping
+    if "compressed rgb" in msg.format.split(";")[-1]:
+        image = cv2.cvtColor(image,cv2.COLOR_RGB2BGR)
+    return image
+
+def decode_compressed_depth(msg):
+    encoding = msg.format.split(";")[0].strip()
+    buffer = np.frombuffer(msg.data,dtype=np.uint8)
+    if len(buffer) <= DEPTH_HEADER_SIZE:
+        raise ValueError("compressedDepth message is too short")
+    depth_quant_a,depth_quant_b = np.frombuffer(buffer[4:DEPTH_HEADER_SIZE].tobytes(),dtype="<f4")
+    payload = buffer[DEPTH_HEADER_SIZE:]
+
+    if "compressedDepth rvl" in msg.format:
+        cols,rows = np.frombuffer(payload[0:8].tobytes(),dtype="<u4")
+        depth = decode_rvl(payload[8:],int(rows)*int(cols)).reshape(int(rows),int(cols))
+    else:
+        depth = cv2.imdecode(payload,cv2.IMREAD_UNCHANGED)
+        if depth is None:
+            raise ValueError("Could not decode compressedDepth image with format '{}'".format(msg.format))
+
+    if encoding == "32FC1":
+        # Inverse depth quantisation, zero marks missing depth
+        quantised = depth.astype(np.float32)
+        metres = np.zeros_like(quantised)
+        valid = quantised != 0
+        metres[valid] = depth_quant_a / (quantised[valid] - depth_quant_b)
+        depth = np.clip(metres*1000,0,np.iinfo(np.uint16).max).astype(np.uint16)
+    return depth
+
+def decode_rvl(buffer,num_pixels):
+    '''
+    Decode run length / variable length (RVL) compressed 16 bit depth (Wilson, 2017).
+
+    The stream alternates zero run lengths, non-zero run lengths and zigzag encoded deltas
+    between non-zero pixels, each a variable length integer made of 4 bit nibbles (3 payload
+    bits and a continuation bit) packed most significant nibble first into 32 bit words.
+    Nibbles and deltas are decoded with array operations, only the runs are walked in Python.
+    '''
+    words = np.frombuffer(np.asarray(buffer,dtype=np.uint8).tobytes()[:len(buffer)//4*4],dtype="<u4")
+    nibbles = ((words[:,np.newaxis] >> np.arange(28,-4,-4,dtype=np.uint32)) & 0xF).ravel()
+
+    # Group nibbles into variable length integers, low bits first
+    ends = (nibbles & 0x8) == 0
+    end_indices = np.flatnonzero(ends)
+    starts = np.concatenate([[0],end_indices[:-1]+1])
+    group = np.concatenate([[0],np.cumsum(ends)[:-1]])
+    position = np.arange(len(nibbles)) - starts[np.minimum(group,len(starts)-1)]
+    payload = (nibbles & 0x7).astype(np.int64) << (3*position)
+    values = np.add.reduceat(payload[:end_indices[-1]+1],starts) if len(end_indices) > 0 else np.zeros(0,dtype=np.int64)
+
+    # Walk the runs to find where each block of non-zero pixels comes from and goes to
+    run_values = values.tolist()
+    value_starts = []
+    pixel_starts = []
+    lengths = []
+    index = 0
+    pixel = 0
+    while pixel < num_pixels:
+        if index+1 >= len(run_values):
+            raise ValueError("RVL stream ended before all pixels were decoded")
+        zeros = run_values[index]
+        nonzeros = run_values[index+1]
+        pixel += zeros
+        value_starts.append(index+2)
+        pixel_starts.append(pixel)
+        lengths.append(nonzeros)
+        index += 2 + nonzeros
+        pixel += nonzeros
+
+    depth = np.zeros(num_pixels,dtype=np.uint16)
+    lengths = np.array(lengths,dtype=np.int64)
+    total = int(lengths.sum())
+    if total == 0:
+        return depth
+    offsets = np.arange(total) - np.repeat(np.cumsum(lengths)-lengths,lengths)
+    value_indices = np.repeat(np.array(value_starts),lengths) + offsets
+    pixel_indices = np.repeat(np.array(pixel_starts),lengths) + offsets
+
+    # Undo the zigzag encoding and accumulate the deltas
+    positive = values[value_indices]
+    deltas = (positive >> 1) ^ -(positive & 1)
+    depth[pixel_indices[pixel_indices < num_pixels]] = (np.cumsum(deltas) & 0xFFFF)[pixel_indices < num_pixels]
+    return depth
@@ -0,0 +1,251 @@
+import copy
+import numpy as np
+import cv2
+
+class ChangeDetector:
+    '''
+    Decides whether a frame differs enough from the last frame pose inference ran on.
+
+    Frames are compared as small grayscale thumbnails against that reference frame, rather
+    than the previous frame, so slow changes still add up. Inference is also forced at
+    least every max_skip_time seconds.
+    '''
+    def __init__(self,size=(80,60),pixel_threshold=15,changed_fraction=0.01,max_skip_time=1.0):
+        self.size = tuple(size)
+        self.pixel_threshold = pixel_threshold
+        self.changed_fraction = changed_fraction
+        self.max_skip_time = max_skip_time
+        self.reset()
+
+    def reset(self):
+        self.reference = None
+        self.reference_time = None
+
+    def thumbnail(self,frame):
+        # Shrink before converting, area interpolation also averages out sensor noise
+        small = cv2.resize(frame.bgr,self.size,interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small,cv2.COLOR_BGR2GRAY)
+
+    def changed(self,frame):
+        time = frame.time.to_sec()
+        thumbnail = self.thumbnail(frame)
+        if self.reference is None or abs(time - self.reference_time) >= self.max_skip_time:
+            changed = True
+        else:
+            difference = cv2.absdiff(thumbnail,self.reference)
+            changed = np.count_nonzero(difference > self.pixel_threshold) >= self.changed_fraction * difference.size
+        if changed:
+            self.reference = thumbnail
+            self.reference_time = time
+        return changed
+
+
+class KeyframeScheduler:
+    '''
+    Decides which frames pose inference runs on, the others have their poses propagated.
+
+    Inference runs at least every interval frames. With a latency budget (seconds per frame)
+    the interval is stretched to ceil(latency / budget), using a running average of the
+    measured inference latency, so the output can keep up with the camera. When inference
+    runs asynchronously the latency is recorded separately, once the inference has finished.
+    '''
+    def __init__(self,interval=1,latency_budget=0,smoothing=0.2):
+        self.interval = max(1,int(interval))
+        self.latency_budget = latency_budget
+        self.smoothing = smoothing
+        self.latency = None
+        self.frames_since_keyframe = None
+
+    def current_interval(self):
+        if self.latency_budget <= 0 or self.latency is None:
+            return self.interval
+        return max(self.interval,int(np.ceil(self.latency / self.latency_budget)))
+
+    def due(self):
+        if self.frames_since_keyframe is None:
+            return True
+        return self.frames_since_keyframe + 1 >= self.current_interval()
+
+    def keyframe(self,latency=None):
+        # Inference ran (or was deliberately skipped) on this frame
+        self.frames_since_keyframe = 0
+        if latency is not None:
+            self.record_latency(latency)
+
+    def record_latency(self,latency):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.smoothing * (latency - self.latency)
+
+    def skip(self):
+        self.frames_since_keyframe += 1
+
+
+class KeypointPropagator:
+    '''
+    Moves the 2D keypoints of the last poses onto frames that inference did not run on.
+
+    optical_flow tracks every keypoint from the previous frame with pyramidal Lucas-Kanade,
+    constant_velocity extrapolates each pose from its last two keyframes. Keypoints that
+    cannot be followed are marked missing (-1), like OpenDR does.
+    '''
+    methods = ["optical_flow","constant_velocity"]
+
+    def __init__(self,method="optical_flow",window=(21,21),levels=3):
+        if method not in self.methods:
+            raise ValueError("Unknown propagation method '{}', expected one of {}".format(method,self.methods))
+        self.method = method
+        self.window = tuple(window)
+        self.levels = levels
+        self.poses = []
+        self.previous_gray = None
+        # Pose id to (time, keypoints) of the last two keyframes
+        self.keyframes = {}
+
+    def update_keyframe(self,frame,poses):
+        time = frame.time.to_sec()
+        self.poses = list(poses)
+        if self.method == "optical_flow":
+            self.previous_gray = cv2.cvtColor(frame.bgr,cv2.COLOR_BGR2GRAY)
+        else:
+            keyframes = {}
+            for pose in self.poses:
+                keypoints = np.array(pose.data,dtype=float)
+                previous = self.keyframes.get(pose.id)
+                keyframes[pose.id] = (previous[-1] if previous is not None else None,(time,keypoints))
+            self.keyframes = keyframes
+
+    def propagate(self,frame):
+        if len(self.poses) == 0:
+            return []
+        if self.method == "optical_flow":
+            keypoints = self.optical_flow(frame)
+        else:
+            keypoints = self.constant_velocity(frame.time.to_sec())
+        # Keypoints that left the image are missing
+        height,width = frame.shape
+        poses = []
+        for pose,data in zip(self.poses,keypoints):
+            outside = (data[:,0] < 0) | (data[:,0] >= width) | (data[:,1] < 0) | (data[:,1] >= height)
+            data[outside] = -1
+            propagated = copy.copy(pose)
+            propagated.data = data
+            poses.append(propagated)
+        if self.method == "optical_flow":
+            # Chain frame to frame
+            self.poses = poses
+        return poses
+
+    def optical_flow(self,frame):
+        gray = cv2.cvtColor(frame.bgr,cv2.COLOR_BGR2GRAY)
+        keypoints = np.stack([np.array(pose.data,dtype=np.float32) for pose in self.poses])
+        valid = (keypoints[...,0] != -1) & (keypoints[...,1] != -1)
+        propagated = np.full(keypoints.shape,-1,dtype=np.float32)
+        if valid.any():
+            # One call for every keypoint of every pose
+            points = keypoints[valid].reshape(-1,1,2)
+            moved,status,_ = cv2.calcOpticalFlowPyrLK(
+                self.previous_gray,gray,points,None,winSize=self.window,maxLevel=self.levels)
+            tracked = status.ravel() == 1
+            propagated[valid] = np.where(tracked[:,np.newaxis],moved.reshape(-1,2),-1)
+        self.previous_gray = gray
+        return propagated
+
+    def constant_velocity(self,time):
+        propagated = []
+        for pose in self.poses:
+            previous,(keyframe_time,keypoints) = self.keyframes[pose.id]
+            keypoints = keypoints.copy()
+            if previous is not None and keyframe_time != previous[0]:
+                previous_time,previous_keypoints = previous
+                # Only keypoints seen in both keyframes have a velocity
+                both = (keypoints[:,0] != -1) & (previous_keypoints[:,0] != -1)
+                velocity = (keypoints - previous_keypoints) / (keyframe_time - previous_time)
+                keypoints[both] += velocity[both] * (time - keyframe_time)
+            propagated.append(keypoints)
+        return propagated
+
+
+class OperatingPointController:
+    '''
+    Keeps pose inference near a target time per frame by moving along a ladder of operating
+    points, each an input height and a number of refinement stages, from best to cheapest.
+
+    A running average of the measured latency is compared against the target: above it (by
+    more than the tolerance) the controller steps down the ladder, well below it it steps back
+    up. After every step it waits for settle_frames measurements before moving again. An
+    exported ONNX graph has a fixed input height and refinement stages, so with one attached
+    the ladder is only its own operating point and nothing is adapted.
+    '''
+    def __init__(self,target_time,base_height=256,refinement_stages=2,min_height=128,height_step=32,
+                 smoothing=0.2,tolerance=0.1,headroom=0.6,settle_frames=10):
+        self.target_time = target_time
+        self.smoothing = smoothing
+        self.tolerance = tolerance
+        self.headroom = headroom
+        self.settle_frames = settle_frames
+        self.ladder = self.build_ladder(base_height,refinement_stages,min_height,height_step)
+        self.level = 0
+        self.latency = None
+        self.frames_since_change = 0
+        self.learner = None
+        self.all_stages = None
+
+    @staticmethod
+    def build_ladder(base_height,refinement_stages,min_height,height_step):
+        # Drop refinement stages first, they cost more than they add, then shrink the input
+        ladder = [(base_height,stages) for stages in range(refinement_stages,-1,-1)]
+        height = base_height - height_step
+        while height >= min_height:
+            ladder.append((height,0))
+            height -= height_step
+        return ladder
+
+    def operating_point(self):
+        return self.ladder[self.level]
+
+    def attach(self,learner):
+        # Keep every refinement stage so that dropped ones can be put back
+        self.learner = learner
+        model = getattr(learner,"model",None)
+        if getattr(learner,"ort_session",None) is not None:
+            # The exported graph was traced at this input height with these refinement stages
+            print("The ONNX backend runs at a fixed input height and refinement stages, adaptive mode is disabled")
+            self.ladder = self.ladder[:1]
+            self.level = 0
+        elif model is not None and hasattr(model,"refinement_stages"):
+            self.all_stages = list(model.refinement_stages)
+            # Never ask for more stages than the model has
+            ladder = [(height,min(stages,len(self.all_stages))) for height,stages in self.ladder]
+            self.ladder = [point for i,point in enumerate(ladder) if point not in ladder[:i]]
+        self.apply()
+
+    def apply(self):
+        height,stages = self.operating_point()
+        self.learner.base_height = height
+        if self.all_stages is not None:
+            model = self.learner.model
+            model.refinement_stages = type(model.refinement_stages)(self.all_stages[:stages])
+
+    def record(self,latency):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.smoothing * (latency - self.latency)
+        self.frames_since_change += 1
+        if self.frames_since_change < self.settle_frames:
+            return
+
+        level = self.level
+        if self.latency > self.target_time * (1 + self.tolerance) and level < len(self.ladder) - 1:
+            level += 1
+        elif self.latency < self.target_time * self.headroom and level > 0:
+            level -= 1
+        if level != self.level:
+            self.level = level
+            self.frames_since_change = 0
+            # The old average says little about the new operating point
+            self.latency = None
+            if self.learner is not None:
+                self.apply()
@@ -0,0 +1,46 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+def neighbour_pairs(positions,valid,radius):
+    # Index pairs (i,j), i < j, of the valid positions at most radius apart, found with a KD-tree
+    indices = np.flatnonzero(valid)
+    if len(indices) < 2:
+        return np.zeros(0,dtype=int),np.zeros(0,dtype=int)
+    pairs = cKDTree(positions[indices]).query_pairs(radius,output_type="ndarray")
+    rows = indices[pairs[:,0]]
+    cols = indices[pairs[:,1]]
+    order = np.lexsort((cols,rows))
+    return rows[order],cols[order]
+
+
+class SparsePairs:
+    '''
+    Values of some of the pairs (i,j), i < j, of num_nodes nodes, e.g. only the pairs of bodies
+    close enough to engage. Pairs that are not stored count as 0, like the lower triangle of
+    the dense matrices.
+    '''
+    def __init__(self,num_nodes,rows,cols,values):
+        self.num_nodes = num_nodes
+        self.rows = rows
+        self.cols = cols
+        self.values = values
+
+    def __len__(self):
+        return len(self.values)
+
+    def above(self,threshold):
+        # Pairs whose value is over threshold
+        over = self.values > threshold
+        return self.rows[over],self.cols[over]
+
+    def node_max(self):
+        # Largest value of any pair each node is in, ignoring nan, as the max of its row and column
+        maxima = np.zeros(self.num_nodes)
+        np.fmax.at(maxima,self.rows,self.values)
+        np.fmax.at(maxima,self.cols,self.values)
+        return maxima
+
+    def dense(self):
+        matrix = np.zeros((self.num_nodes,self.num_nodes))
+        matrix[self.rows,self.cols] = self.values
+        return matrix
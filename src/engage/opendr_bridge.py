@@ -22,6 +22,8 @@ import numpy as np
 from rospy.rostime import Time
 from cv_bridge import CvBridge
 
+from engage.frame import Frame
+
 from std_msgs.msg import Header
 from sensor_msgs.msg import Image as ImageMsg
 
@@ -50,6 +52,16 @@ class ROSBridge:
         image = Image(np.asarray(cv_image, dtype=np.uint8))
         return image
 
+    def from_frame(self, frame: Frame) -> Image:
+        """
+        Returns the OpenDR image of a decoded frame, shared with the frame's other views rather than copied
+        :param frame: frame holding the decoded colour image
+        :type frame: engage.frame.Frame
+        :return: OpenDR image
+        :rtype: engine.data.Image
+        """
+        return frame.opendr()
+
     def to_ros_image(self,
                      image: Image,
                      encoding: str='passthrough',
@@ -0,0 +1,141 @@
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+class LatestSlot:
+    '''
+    Single item hand-off between threads. Putting an item while the previous one has not
+    been taken replaces it, so consumers always see the newest item and stale ones are
+    dropped (and counted) instead of queueing up.
+    '''
+    def __init__(self,name,on_drop=None):
+        self.name = name
+        self.on_drop = on_drop
+        self.condition = threading.Condition()
+        self.item = None
+        self.closed = False
+
+        # Statistics
+        self.received = 0
+        self.dropped = 0
+
+    def put(self,item):
+        with self.condition:
+            stale = self.item
+            if stale is not None:
+                self.dropped += 1
+            self.item = item
+            self.received += 1
+            self.condition.notify()
+        if stale is not None and self.on_drop is not None:
+            self.on_drop(stale)
+
+    def get(self,timeout=None):
+        # Wait for an item, returning None on timeout or once closed
+        with self.condition:
+            if self.item is None and not self.closed:
+                self.condition.wait(timeout)
+            item = self.item
+            self.item = None
+            return item
+
+    def depth(self):
+        return 0 if self.item is None else 1
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class PipelineStage(threading.Thread):
+    # Worker thread that processes items from one slot and hands results on to the next
+    def __init__(self,name,input_slot,process,output_slot=None):
+        super().__init__(name=name,daemon=True)
+        self.input_slot = input_slot
+        self.process = process
+        self.output_slot = output_slot
+        self.running = True
+
+        # Statistics
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.busy_time = 0
+        self.last_report = {"received":0,"dropped":0,"processed":0,"busy_time":0}
+
+    def run(self):
+        while self.running:
+            item = self.input_slot.get(timeout=0.1)
+            if item is None:
+                continue
+            start = time.perf_counter()
+            try:
+                result = self.process(item)
+            except Exception:
+                # A bad frame should not take the whole node down
+                traceback.print_exc()
+                result = None
+            with self.lock:
+                self.processed += 1
+                self.busy_time += time.perf_counter() - start
+            if self.output_slot is not None and result is not None:
+                self.output_slot.put(result)
+
+    def stop(self):
+        self.running = False
+        self.input_slot.close()
+
+    def statistics(self):
+        # Counts since the last call, so rates reflect the most recent period
+        with self.lock:
+            current = {
+                "received":self.input_slot.received,
+                "dropped":self.input_slot.dropped,
+                "processed":self.processed,
+                "busy_time":self.busy_time,
+            }
+        delta = {key:current[key]-self.last_report[key] for key in current}
+        self.last_report = current
+
+        stats = {
+            "name":self.name,
+            "queue_depth":self.input_slot.depth(),
+            "received":delta["received"],
+            "dropped":delta["dropped"],
+            "drop_rate":delta["dropped"]/delta["received"] if delta["received"] > 0 else 0,
+            "processing_time":delta["busy_time"]/delta["processed"] if delta["processed"] > 0 else 0,
+        }
+        return stats
+
+
+class StepTimer:
+    # Accumulates the time spent in named steps, reporting the mean per call since the last report
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.steps = []
+        self.totals = {}
+        self.counts = {}
+
+    @contextmanager
+    def time(self,step):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                if step not in self.totals:
+                    self.steps.append(step)
+                    self.totals[step] = 0
+                    self.counts[step] = 0
+                self.totals[step] += elapsed
+                self.counts[step] += 1
+
+    def statistics(self):
+        with self.lock:
+            stats = [(step,self.totals[step]/self.counts[step] if self.counts[step] > 0 else 0) for step in self.steps]
+            for step in self.steps:
+                self.totals[step] = 0
+                self.counts[step] = 0
+        return stats
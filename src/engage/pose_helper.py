@@ -1,20 +1,27 @@
 import rospy
 import numpy as np
-import math
-from tsmoothie.smoother import LowessSmoother
+import contextlib
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor,ProcessPoolExecutor
 import tf
 import tf2_ros
 
 from opendr.engine.target import Pose 
 
-from engage.utils import RandomID,VectorHelper
+from engage.utils import RandomID
+from engage import geometry
+from engage.history import SlidingRegression
+from engage.smoothing import create_smoother
 from engage.marker_visualisation import MarkerMaker
-from engage.msg import PoseArrayUncertain,PeoplePositions
+from engage.topic_pool import TopicHandles,HandlePool
+from engage.body_tracker import BodyTracker
+from engage.pipeline import StepTimer
+from engage.msg import PoseArrayUncertain,PeoplePositions,BodiesFrame
 
 from hri_msgs.msg import Skeleton2D, NormalizedPointOfInterest2D, IdsList
 from sensor_msgs.msg import JointState
 from image_geometry import PinholeCameraModel
-from visualization_msgs.msg import Marker 
+from visualization_msgs.msg import Marker,MarkerArray
 from geometry_msgs.msg import Vector3Stamped,TwistStamped,TransformStamped,Point
 from geometry_msgs.msg import Pose as GPose
 
@@ -67,9 +74,11 @@ class HRIPoseBody:
                  time,
                  visualise=False,
                  smoothing=False,
-                 window=40,
+                 velocity_horizon=1,
                  marker_pub=None,
                  max_confidence=30,
+                 publish_topics=True,
+                 handles=None,
                  camera_frame="camera",
                  world_frame="world"
                 ):
@@ -78,8 +87,9 @@ class HRIPoseBody:
         self.time = time
         self.visualise = visualise
         self.smoothing = smoothing
-        self.window = window
+        self.velocity_horizon = velocity_horizon
         self.max_confidence = max_confidence
+        self.publish_topics = publish_topics
         self.camera_frame = camera_frame
         self.world_frame = world_frame
 
@@ -87,127 +97,108 @@ class HRIPoseBody:
             self.colour = list(np.random.choice(range(256), size=3)/256)
             self.marker_pub = marker_pub
 
-        if smoothing:
-            self.smoother = LowessSmoother(smooth_fraction=0.4, iterations=1)
-            
+        # Smoother slots, assigned by the manager
+        self.pose_smoother_slot = None
+        self.normal_smoother_slot = None
+
         # Pose
         self.pose = None
         self.pose_confidence = 0
-        self.pose_history = []
-        for i in range(Pose.num_kpts):
-            self.pose_history.append([])
-        self.num_poses = 0
+        self.skeleton_array = np.zeros((Pose.num_kpts,3))
+        self.pose_3D_array = np.zeros((Pose.num_kpts,3))
+        self.pose_3D_valid = np.zeros(Pose.num_kpts,dtype=bool)
         self.position = Point()
 
         # Orientation
         self.body_normal = None
         self.face_normal = None
-        self.num_normals = 0
-        self.body_normal_history = []
-        self.face_normal_history = []
 
         # Velocity
         self.velocity = None
-        self.position_history = []
-        self.position_times = []
-        self.num_positions = 0
+        self.velocity_estimator = SlidingRegression(velocity_horizon)
 
         # Transforms
         self.face_trans = [0,0,0]
         self.face_rot = [0,0,0,0]
 
-        # Publishers
-        this_body_topic = "/humans/bodies/{}/".format(self.id)
-        self.pose_pub = rospy.Publisher(this_body_topic+"poses",PoseArrayUncertain,queue_size=1)
-        self.vel_pub = rospy.Publisher(this_body_topic+"velocity",TwistStamped,queue_size=1)
-        self.body_or_pub = rospy.Publisher(this_body_topic+"body_orientation",Vector3Stamped,queue_size=1)
-        self.face_or_pub = rospy.Publisher(this_body_topic+"face_orientation",Vector3Stamped,queue_size=1)
-        self.skeleton_pub = rospy.Publisher(this_body_topic+"skeleton2d",Skeleton2D,queue_size=1)
+        # Publishers, not needed when the manager only publishes the aggregated BodiesFrame.
+        # Handles from a pool are released by the manager, otherwise the body owns them
+        self.owns_handles = handles is None
+        if publish_topics:
+            if handles is None:
+                handles = HRIPoseBody.create_handles(self.id)
+            self.pose_pub = handles.publishers["poses"]
+            self.vel_pub = handles.publishers["velocity"]
+            self.body_or_pub = handles.publishers["body_orientation"]
+            self.face_or_pub = handles.publishers["face_orientation"]
+            self.skeleton_pub = handles.publishers["skeleton2d"]
+        self.handles = handles
+
+    @staticmethod
+    def create_handles(id):
+        handles = TopicHandles()
+        this_body_topic = "/humans/bodies/{}/".format(id)
+        handles.publisher("poses",this_body_topic+"poses",PoseArrayUncertain)
+        handles.publisher("velocity",this_body_topic+"velocity",TwistStamped)
+        handles.publisher("body_orientation",this_body_topic+"body_orientation",Vector3Stamped)
+        handles.publisher("face_orientation",this_body_topic+"face_orientation",Vector3Stamped)
+        handles.publisher("skeleton2d",this_body_topic+"skeleton2d",Skeleton2D)
+        return handles
 
     def close(self):
         # To be called upon deletion
-        self.pose_pub.unregister()
-        self.vel_pub.unregister()
-        self.body_or_pub.unregister()
-        self.face_or_pub.unregister()
-        self.skeleton_pub.unregister()
+        if self.handles is not None and self.owns_handles:
+            self.handles.close()
 
-    def update(self,pose,time,rgb_image,rgb_model,depth_model,depth_image,cam_transform):
+    def update(self,pose,time,image_shape,pose_3D,pose_3D_valid):
         self.pose = pose
         self.time = time
 
         # Update skeleton
-        self.update_skeleton(rgb_image,depth_image)
+        self.update_skeleton(image_shape)
 
         # Update 3D points
-        self.update_3D_pose(rgb_model,depth_model,depth_image,cam_transform)
-
-        # Update pose history
-        self.update_pose_history()
-
-        # Smoothing
-        if self.smoothing:
-            self.smooth_pose()
-
-        # Calculate orientations
-        self.update_orientations()
-
-        # Calculate velocity
-        self.update_velocity()
+        self.update_3D_pose(pose_3D,pose_3D_valid)
 
-        # Set face transform
-        self.update_face_transform()
+        # Smoothing, orientations, velocity and the face transform are
+        # updated by the manager so that they can be batched across bodies
 
-        
     '''
     Poses
     '''
 
-    def update_skeleton(self,rgb_image,depth_image):
+    def update_skeleton(self,image_shape):
         # Transform OpenDR pose into normalised 2D skeleton
+        keypoints = np.asarray(self.pose.data,dtype=float).reshape(Pose.num_kpts,2)
+        missing = (keypoints[:,0] == -1) | (keypoints[:,1] == -1)
+        self.skeleton_array[:,0] = keypoints[:,0] / image_shape[1]
+        self.skeleton_array[:,1] = keypoints[:,1] / image_shape[0]
+        self.skeleton_array[:,2] = self.pose.confidence
+        self.skeleton_array[missing] = [-1,-1,0]
+
         self.skeleton = Skeleton2D()
         self.skeleton.header.stamp = self.time
 
         self.skeleton.skeleton = [
-            NormalizedPointOfInterest2D(
-                kpt[0] / rgb_image.shape[1],
-                kpt[1] / rgb_image.shape[0],
-                self.pose.confidence
-            ) 
-            if (kpt[0] != -1 and kpt[1] != -1) else None for kpt in self.pose.data
+            NormalizedPointOfInterest2D(*self.skeleton_array[i]) if not missing[i] else None
+            for i in range(Pose.num_kpts)
         ]
 
-    def update_3D_pose(self,rgb_model,depth_model,depth_image,inversed_transform):
-        # Get coordinates in camera
-        camera_coords = [self.point_2D_to_camera(kpt,rgb_model,depth_model,depth_image) for kpt in self.skeleton.skeleton]
-        
-        # Get world coords
-        world_coords = []
-        for cam_coord in camera_coords:
-            if cam_coord is not None:
-                world_coord = inversed_transform.dot(np.append(cam_coord,[1]))[0:3]
-                
-                if sum(world_coord)==0:
-                    world_coord = None
-            else:
-                world_coord = None
-            world_coords.append(world_coord)
-        
-        self.pose_3D = world_coords
+    def update_3D_pose(self,pose_3D,pose_3D_valid):
+        # World coordinates are lifted for all bodies at once by the manager
+        self.pose_3D_array[:] = pose_3D
+        self.pose_3D_valid[:] = pose_3D_valid
+        self.update_pose_3D_list()
         self.pose_confidence = min(1,self.pose.confidence / self.max_confidence) # OpenDR weirdly only goes up to about 30
 
-    def update_pose_history(self):
-        self.num_poses += 1
-        overflow = False
-        if self.num_poses > self.window:
-            overflow = True
+    def set_pose_3D(self,pose_3D,pose_3D_valid):
+        # Replace the current pose, e.g. with a smoothed one
+        self.pose_3D_array[:] = pose_3D
+        self.pose_3D_valid[:] = pose_3D_valid
+        self.update_pose_3D_list()
 
-        for i in range(Pose.num_kpts):
-            self.pose_history[i].append(self.pose_3D[i])
-            if overflow:
-                self.pose_history[i] = self.pose_history[i][-self.window:]
-        if overflow:
-            self.num_poses = self.window
+    def update_pose_3D_list(self):
+        self.pose_3D = [self.pose_3D_array[i] if self.pose_3D_valid[i] else None for i in range(Pose.num_kpts)]
 
     def update_face_transform(self):
         # Try get the nose point
@@ -262,158 +253,58 @@ class HRIPoseBody:
     '''
     Orientations
     '''
-    def update_orientations(self):
-        self.body_normal = self.body_orientation()
-        self.face_normal = self.face_orientation()
-        self.update_normal_history()
+    def set_orientations(self,body_normal,face_normal):
+        # Normals computed elsewhere, e.g. for all bodies at once by the manager
+        self.body_normal = body_normal
+        self.face_normal = face_normal
 
-        if self.smoothing:
-            self.body_normal = self.smooth_vector(self.body_normal_history)
-            self.face_normal = self.smooth_vector(self.face_normal_history)
-
-    def body_orientation(self):
-        # Get the two shoulders used for the normal
-        points = []
-        for joint_name in ["r_sho","l_sho"]:
-            point = self.pose_3D[self.joints[joint_name]]
-            if point is None:
-                # The left and right shoulders are required for the body orientation
-                return None
-            points.append(point)
-
-        # Find a third point
-        l_hip = self.pose_3D[self.joints["l_hip"]]
-        r_hip = self.pose_3D[self.joints["r_hip"]]
-        if l_hip is not None and r_hip is not None:
-            waist = (l_hip+r_hip)/2
-            points.append(waist)
-            return -VectorHelper.get_normal(points)
-        elif self.pose_3D[self.joints["nose"]] is not None:
-            points.append(self.pose_3D[self.joints["nose"]])
-            return VectorHelper.get_normal(points)
-        else:
-            return None
-        
-    def face_orientation(self):
-        # Get the two eyes and nose used for the normañ
-        points = []
-        for joint_name in ["r_eye","l_eye","nose"]:
-            point = self.pose_3D[self.joints[joint_name]]
-            if point is None:
-                # The left and right eyes and the nose are required for the face orientation
-                return None
-            points.append(point.copy())
-
-        # Replace nose depth with average of other depths
-        points[-1][0] = (points[0][0]+points[1][0])/2
-        return -VectorHelper.get_normal(points)
-        
-    def update_normal_history(self):
-        self.num_normals += 1
-
-        self.body_normal_history.append(self.body_normal)
-        self.face_normal_history.append(self.face_normal)
-        if self.num_normals > self.window:
-            self.body_normal_history = self.body_normal_history[-self.window:]
-            self.face_normal_history = self.face_normal_history[-self.window:]
-            self.num_normals = self.window
-        
     '''
     Velocity
     '''
     def update_velocity(self,base_point="neck"):
         self.velocity = self.calculate_velocity(base_point=base_point)
 
+    def update_motion(self):
+        self.update_velocity()
+        self.update_face_transform()
+
 
     def calculate_velocity(self,base_point="neck"):
+        # Streaming least-squares slope of the base point over the last velocity_horizon seconds
+        time = self.time.to_sec()
         base = self.pose_3D[self.joints[base_point]]
         if base is None:
+            # Missing sample, just let old samples expire
+            self.velocity_estimator.evict(time)
             return None
-        
+        self.velocity_estimator.append(time,base)
 
-        if self.smoothing:
-            # Use a history of smoothed positions
-            self.num_positions += 1
-            self.position_history.append(base)
-            self.position_times.append(self.time.to_nsec())
-            if self.num_positions > self.window:
-                self.position_history = self.position_history[-self.window:]
-                self.position_times = self.position_times[-self.window:]
-                self.num_positions = self.window
-            
-            base_history = self.position_history
-            base_history_num = self.num_positions
-        else:
-            # Use a history of unsmoothed positions
-            base_history = self.pose_history[self.joints[base_point]]
-            base_history_num = self.num_poses
-            self.position_times.append(self.time.to_nsec())
-            if len(self.position_times) > self.window:
-                self.position_times = self.position_times[-self.window:]
-
-        if base_history_num == self.window:
-            num_vels = 0
-            vel_sum = np.zeros(3)
-            for i in range(1,base_history_num):
-                if base_history[i] is None or base_history[i-1] is None:
-                    continue
-                pos_dif = base_history[i]-base_history[i-1]
-                time_dif = self.position_times[i]-self.position_times[i-1]
-                time_dif = time_dif/1000000000 # To seconds
-                if time_dif != 0:
-                    vel_sum += pos_dif/time_dif
-                    num_vels += 1
-            return vel_sum/num_vels if num_vels != 0 else None
-        else:
+        # Wait until enough of the horizon is covered for a stable estimate
+        if self.velocity_estimator.span() < self.velocity_horizon/2:
             return None
-                
-
-            
-
-        
+        return self.velocity_estimator.slope()
 
-
-    '''
-    Projection
-    '''
-
-    def point_2D_to_camera(self,point,rgb_model,depth_model,depth_image):
-        if point is None:
-            return None
-        
-        px = min(math.floor(point.x * depth_image.shape[1]), depth_image.shape[1] - 1)
-        py = min(math.floor(point.y * depth_image.shape[0]), depth_image.shape[0] - 1)
-
-        x_d = int(((px - rgb_model.cx())
-               * depth_model.fx()
-               / rgb_model.fx())
-              + depth_model.cx())
-        y_d = int(((py - rgb_model.cy())
-                * depth_model.fy()
-                / rgb_model.fy())
-                + depth_model.cy())
-        z = depth_image[y_d][x_d]/1000
-
-        x = (x_d - depth_model.cx())*z/depth_model.fx()
-        y = (y_d - depth_model.cy())*z/depth_model.fy()
-
-
-        return np.array([-z,x,-y])
-    
     '''
     Visualise
     '''
     
     def visualise_pose(self):
+        # One message per marker
+        for marker in self.pose_markers():
+            self.marker_pub.publish(marker)
+
+    def pose_markers(self):
         # Visualise skeleton
-        self.visualise_skeleton()
+        markers = self.skeleton_markers()
         # Visualise normals
-        self.visualise_normal(self.pose_3D[self.joints["neck"]],self.body_normal,18,[0,1,1])
-        self.visualise_normal(self.pose_3D[self.joints["nose"]],self.face_normal,19,[1,0,1])
+        markers.append(self.normal_marker(self.pose_3D[self.joints["neck"]],self.body_normal,18,[0,1,1]))
+        markers.append(self.normal_marker(self.pose_3D[self.joints["nose"]],self.face_normal,19,[1,0,1]))
         # Visualise velocity
-        self.visualise_velocity()
+        markers.append(self.velocity_marker())
+        return [marker for marker in markers if marker is not None]
     
-    def visualise_skeleton(self):
+    def skeleton_markers(self):
+        markers = []
         for i in range(len(MarkerMaker.skeleton_pairs)):
             index_pair = MarkerMaker.skeleton_pairs_indices[i]
             line_marker = MarkerMaker.make_line_marker(
@@ -425,63 +316,38 @@ class HRIPoseBody:
                 frame_id=self.world_frame,
             )
             if line_marker is not None:
-                self.marker_pub.publish(line_marker)
+                markers.append(line_marker)
+        return markers
 
-    def visualise_normal(self,start,normal,marker_id,colour=[0,0,0]):
+    def normal_marker(self,start,normal,marker_id,colour=[0,0,0]):
         if start is None or normal is None:
-            return
+            return None
         
-        mk = MarkerMaker.make_line_marker(start,start+normal,self.id,marker_id=marker_id,colour=colour,frame_id=self.world_frame)
-        self.marker_pub.publish(mk)
+        return MarkerMaker.make_line_marker(start,start+normal,self.id,marker_id=marker_id,colour=colour,frame_id=self.world_frame)
 
-    def visualise_velocity(self):
-        self.visualise_normal(self.pose_3D[self.joints["neck"]],self.velocity,20,[0,1,0])
+    def velocity_marker(self):
+        return self.normal_marker(self.pose_3D[self.joints["neck"]],self.velocity,20,[0,1,0])
 
-    '''
-    Smoothing
-    '''
-    def smooth_pose(self):
-        if self.num_poses==self.window:
-            new_pose = []
-            for i in range(self.pose.num_kpts):
-                joint_history = [p for p in self.pose_history[i] if p is not None]
-                if len(joint_history)==0:
-                    new_pose.append(None)
-                elif len(joint_history)==1:
-                    new_pose.append(joint_history[0])
-                else:
-                    joint_history = np.stack(joint_history)
-                    self.smoother.smooth(joint_history.T)
-                    smoothed_pose = self.smoother.smooth_data[:,-1]
-                    new_pose.append(smoothed_pose)
-            self.pose_3D = new_pose
-
-    def smooth_vector(self,vector_history):
-        if len(vector_history)==self.window:
-            vec_hist = [v for v in vector_history if v is not None]
-            if len(vec_hist) == 0:
-                return None
-            elif len(vec_hist)==1:
-                return vec_hist[0]
-            else:
-                vec_hist_arr = np.stack(vec_hist)
-                self.smoother.smooth(vec_hist_arr.T)
-                return self.smoother.smooth_data[:,-1]
-        elif len(vector_history) == 0:
-            return None
-        else:
-            return vector_history[-1]
-        
     '''
     Publish
     '''
     def publish(self):
+        for pub,msg in self.messages():
+            pub.publish(msg)
+
+    def messages(self):
+        # The (publisher, message) pairs for this body's topics, built without publishing so that
+        # bodies can be built in parallel and still published in order
+        if not self.publish_topics:
+            return []
+        messages = []
+
         # Publish skeleton
         for i in range(Pose.num_kpts):
             if self.skeleton.skeleton[i] is None:
                 self.skeleton.skeleton[i] = NormalizedPointOfInterest2D(-1,-1,0)
         
-        self.skeleton_pub.publish(self.skeleton)
+        messages.append((self.skeleton_pub,self.skeleton))
 
         # Publish Pose
         pose = PoseArrayUncertain()
@@ -499,7 +365,7 @@ class HRIPoseBody:
                 this_pose.position.z = joint_pose[2]
                 poses.append(this_pose)
         pose.poses = poses
-        self.pose_pub.publish(pose)
+        messages.append((self.pose_pub,pose))
 
         # Publish Velocity
         velocity = TwistStamped()
@@ -508,7 +374,7 @@ class HRIPoseBody:
             velocity.twist.linear.x = self.velocity[0]
             velocity.twist.linear.y = self.velocity[1]
             velocity.twist.linear.z = self.velocity[2]
-        self.vel_pub.publish(velocity)
+        messages.append((self.vel_pub,velocity))
 
         # Publish Body Orientation
         body_normal = Vector3Stamped()
@@ -517,7 +383,7 @@ class HRIPoseBody:
             body_normal.vector.x = self.body_normal[0]
             body_normal.vector.y = self.body_normal[1]
             body_normal.vector.z = self.body_normal[2]
-        self.body_or_pub.publish(body_normal)
+        messages.append((self.body_or_pub,body_normal))
 
         # Publish Face Orientation
         face_normal = Vector3Stamped()
@@ -526,7 +392,8 @@ class HRIPoseBody:
             face_normal.vector.x = self.face_normal[0]
             face_normal.vector.y = self.face_normal[1]
             face_normal.vector.z = self.face_normal[2]
-        self.face_or_pub.publish(face_normal)
+        messages.append((self.face_or_pub,face_normal))
+        return messages
 
 
 
@@ -538,7 +405,21 @@ class HRIPoseManager:
                 body_timein=0.1,
                 visualise=True,
                 smoothing=True,
+                smoother="one_euro",
                 window=40,
+                hold_time=1,
+                velocity_horizon=1,
+                body_topics=True,
+                bodies_frame=True,
+                handle_retire_time=10,
+                batch_visualisation=False,
+                face_transforms=True,
+                tracking=True,
+                max_match_distance=0.5,
+                lost_time=3,
+                body_workers=0,
+                worker_type="thread",
+                time_steps=False,
                 camera_frame="camera",
                 world_frame="world"):
         # Parameters
@@ -547,34 +428,133 @@ class HRIPoseManager:
         self.visualise = visualise
         self.smoothing = smoothing
         self.window = window
+        self.velocity_horizon = velocity_horizon
+        self.body_topics = body_topics
         self.camera_frame = camera_frame
         self.world_frame = world_frame
         # Map from pose id to body id
         self.body_ids = {}
         # Dict of all bodies currently tracked
         self.bodies = {}
-        # Visualise
+        # Match poses to bodies in 3D rather than trusting OpenDR's ids, keeping bodies that
+        # disappear for lost_time seconds so that they and their histories come back with the person
+        self.tracker = None
+        if tracking:
+            self.tracker = BodyTracker(
+                max_distance=max_match_distance,
+                lost_distance=2*max_match_distance,
+                timeout=body_timeout,
+                lost_time=lost_time)
+        self.lost_bodies = {}
+        # Per-body publishers are kept for a while after a body times out, in case it comes back
+        self.topic_pool = HandlePool("pose",retire_time=handle_retire_time)
+        # Smoothing, with one smoother for the joints and one for the normals
+        if smoothing:
+            self.pose_smoother = create_smoother(smoother,Pose.num_kpts,window=window,hold_time=hold_time)
+            self.normal_smoother = create_smoother(smoother,2,window=window,hold_time=hold_time)
+        # Per-body updates and messages are run on body_workers threads. With the process worker type,
+        # the per-body fits of the LOWESS smoother also run in as many processes
+        self.body_pool = None
+        self.smoothing_pool = None
+        if body_workers > 0:
+            self.body_pool = ThreadPoolExecutor(max_workers=body_workers,thread_name_prefix="bodies")
+            if worker_type == "process":
+                # Forking this multithreaded process (rospy, tf, the pipeline stages) can deadlock the
+                # child, so workers come from a fork server, which only runs the module level fits
+                self.smoothing_pool = ProcessPoolExecutor(max_workers=body_workers,
+                                                          mp_context=multiprocessing.get_context("forkserver"))
+                if smoothing and hasattr(self.pose_smoother,"executor"):
+                    self.pose_smoother.executor = self.smoothing_pool
+            elif worker_type != "thread":
+                raise ValueError("Unknown worker type '{}', expected thread or process".format(worker_type))
+        # Time each step of processing a frame, to compare serial and parallel processing
+        self.step_timer = StepTimer() if time_steps else None
+        # Visualise, either every marker on its own or all of a frame's markers in one MarkerArray
+        self.batch_visualisation = batch_visualisation
+        self.marker_pub = None
+        self.marker_array_pub = None
         if visualise:
-            self.marker_pub = rospy.Publisher("/hri_engage/markers",Marker,queue_size=100)
+            if batch_visualisation:
+                self.marker_array_pub = rospy.Publisher("/hri_engage/marker_array",MarkerArray,queue_size=1)
+            else:
+                self.marker_pub = rospy.Publisher("/hri_engage/markers",Marker,queue_size=100)
 
         # Publishers
         self.body_pub = rospy.Publisher("/humans/bodies/tracked",IdsList,queue_size=1)
         self.position_pub = rospy.Publisher("/humans/bodies/positions",PeoplePositions,queue_size=1)
+        # All bodies in one message, alongside or instead of the per-body topics
+        self.bodies_frame_pub = None
+        if bodies_frame:
+            self.bodies_frame_pub = rospy.Publisher("/hri_engage/bodies_frame",BodiesFrame,queue_size=1)
 
         # Initial Camera Projection
         trans = [0,0,0]
         rot = [0,0,0]
         self.update_camera_transform(trans,rot)
 
-        # Transforms
-        self.face_tf_br = tf.TransformBroadcaster()
+        # Camera models and the cached RGB to depth pixel lookup
+        self.rgb_info = None
+        self.depth_info = None
+        # The RGB and depth PinholeCameraModels, replaced together
+        self.camera_models = None
+        self.pixel_lookup = None
+
+        # Transforms, batched into one message per frame by the tf2 broadcaster. The node's own
+        # transform listener subscribes to /tf, so whether to send them can't be left to the connections
+        self.face_transforms = face_transforms
+        if batch_visualisation:
+            self.face_tf_br = tf2_ros.TransformBroadcaster()
+        else:
+            self.face_tf_br = tf.TransformBroadcaster()
 
     def update_camera_model(self,rgb_info,depth_info):
-        self.depth_model = PinholeCameraModel()
-        self.rgb_model = PinholeCameraModel()
+        if self.camera_info_unchanged(rgb_info,depth_info):
+            # Keep the existing models and pixel lookup
+            return
 
-        self.depth_model.fromCameraInfo(depth_info)
-        self.rgb_model.fromCameraInfo(rgb_info)
+        self.rgb_info = rgb_info
+        self.depth_info = depth_info
+
+        # Built aside and swapped in once complete, as frames can be processed meanwhile
+        depth_model = PinholeCameraModel()
+        rgb_model = PinholeCameraModel()
+        depth_model.fromCameraInfo(depth_info)
+        rgb_model.fromCameraInfo(rgb_info)
+
+        # Precompute the RGB to depth pixel mapping for the advertised depth resolution
+        pixel_lookup = self.pixel_lookup_for(rgb_model,depth_model,depth_info.height,depth_info.width)
+        self.camera_models = (rgb_model,depth_model)
+        self.pixel_lookup = pixel_lookup
+
+    def camera_info_unchanged(self,rgb_info,depth_info):
+        if self.rgb_info is None or self.depth_info is None:
+            return False
+        for old_info,new_info in [(self.rgb_info,rgb_info),(self.depth_info,depth_info)]:
+            if old_info.width != new_info.width or old_info.height != new_info.height:
+                return False
+            if tuple(old_info.K) != tuple(new_info.K) or tuple(old_info.P) != tuple(new_info.P):
+                return False
+        return True
+
+    def update_pixel_lookup(self,height,width):
+        rgb_model,depth_model = self.camera_models
+        # Swapped in as one object, as the intrinsics can change while frames are being processed
+        self.pixel_lookup = self.pixel_lookup_for(rgb_model,depth_model,height,width)
+
+    @staticmethod
+    def pixel_lookup_for(rgb_model,depth_model,height,width):
+        # The mapping is separable, so one table per axis covers every pixel of the depth image
+        px = np.arange(width)
+        x_d = ((px - rgb_model.cx()) * depth_model.fx() / rgb_model.fx()) + depth_model.cx()
+        x_d = np.clip(x_d.astype(int),0,width-1)
+        x_ray = (x_d - depth_model.cx()) / depth_model.fx()
+
+        py = np.arange(height)
+        y_d = ((py - rgb_model.cy()) * depth_model.fy() / rgb_model.fy()) + depth_model.cy()
+        y_d = np.clip(y_d.astype(int),0,height-1)
+        y_ray = (y_d - depth_model.cy()) / depth_model.fy()
+
+        return ((height,width),x_d,x_ray,y_d,y_ray)
 
     def update_camera_transform(self,trans,rot):
         transform = tf.transformations.concatenate_matrices(
@@ -584,10 +564,15 @@ class HRIPoseManager:
         self.inversed_transform = tf.transformations.inverse_matrix(transform)
 
     def broadcast_transforms(self):
+        if not self.face_transforms:
+            return
+
+        transforms = []
+        stamp = rospy.Time.now()
         for body in self.bodies:
             t = TransformStamped()
 
-            t.header.stamp = rospy.Time.now()
+            t.header.stamp = stamp if self.batch_visualisation else rospy.Time.now()
             t.header.frame_id = self.world_frame
             t.child_frame_id = "{}_face_tf".format(body)
             t.transform.translation.x = self.bodies[body].face_trans[0]
@@ -598,7 +583,26 @@ class HRIPoseManager:
             t.transform.rotation.y = 0
             t.transform.rotation.z = 0
             t.transform.rotation.w = 1
-            self.face_tf_br.sendTransformMessage(t)
+            if self.batch_visualisation:
+                transforms.append(t)
+            else:
+                self.face_tf_br.sendTransformMessage(t)
+        if len(transforms) > 0:
+            self.face_tf_br.sendTransform(transforms)
+
+    def visualise_bodies(self):
+        if self.batch_visualisation:
+            if self.marker_array_pub.get_num_connections() == 0:
+                return
+            markers = MarkerArray()
+            for body in self.bodies:
+                markers.markers.extend(self.bodies[body].pose_markers())
+            self.marker_array_pub.publish(markers)
+        else:
+            if self.marker_pub.get_num_connections() == 0:
+                return
+            for body in self.bodies:
+                self.bodies[body].visualise_pose()
 
     def publish_bodies(self,time):
         tracked = IdsList()
@@ -616,55 +620,259 @@ class HRIPoseManager:
         pose_skel = [self.bodies[body].get_position() for body in self.bodies]
         pp.positions = [p[0] for p in pose_skel]
         pp.points2d = [p[1] for p in pose_skel]
-        print(pp)
         self.position_pub.publish(pp)
 
-    def process_poses(self,poses,time,rgb_image,depth_image):
+    def publish_bodies_frame(self,time,keyframe=True,operating_point=None):
+        bodies = list(self.bodies.values())
+        num_bodies = len(bodies)
+
+        def vectors(name):
+            # Flatten an optional per-body vector, zeros where it is unknown
+            values = np.zeros((num_bodies,3))
+            valid = np.zeros(num_bodies,dtype=np.uint8)
+            for i,body in enumerate(bodies):
+                vector = getattr(body,name)
+                if vector is not None:
+                    values[i] = vector
+                    valid[i] = 1
+            return values.ravel().tolist(),valid.tobytes()
+
+        frame = BodiesFrame()
+        frame.header.stamp = time
+        frame.header.frame_id = self.world_frame
+        frame.bodies = [body.id for body in bodies]
+        frame.num_keypoints = Pose.num_kpts
+        frame.keyframe = keyframe
+        if operating_point is not None:
+            frame.base_height,frame.refinement_stages = operating_point
+        if num_bodies > 0:
+            keypoints_valid = np.stack([body.pose_3D_valid for body in bodies])
+            keypoints = np.stack([body.pose_3D_array for body in bodies]) * keypoints_valid[...,np.newaxis]
+            frame.keypoints = keypoints.ravel().tolist()
+            frame.keypoints_valid = keypoints_valid.astype(np.uint8).tobytes()
+            frame.confidences = [body.pose_confidence for body in bodies]
+            frame.skeletons2d = np.stack([body.skeleton_array for body in bodies]).ravel().tolist()
+        frame.velocities,frame.velocities_valid = vectors("velocity")
+        frame.body_normals,frame.body_normals_valid = vectors("body_normal")
+        frame.face_normals,frame.face_normals_valid = vectors("face_normal")
+        self.bodies_frame_pub.publish(frame)
+
+    def add_body(self,body_id,time):
+        handles = None
+        if self.body_topics:
+            handles = self.topic_pool.acquire(body_id,lambda: HRIPoseBody.create_handles(body_id))
+        body = HRIPoseBody(
+            body_id,
+            time,
+            visualise=self.visualise,
+            smoothing=self.smoothing,
+            velocity_horizon=self.velocity_horizon,
+            marker_pub=self.marker_pub,
+            publish_topics=self.body_topics,
+            handles=handles,
+            camera_frame=self.camera_frame,
+            world_frame=self.world_frame
+        )
+        if self.smoothing:
+            body.pose_smoother_slot = self.pose_smoother.allocate()
+            body.normal_smoother_slot = self.normal_smoother.allocate()
+        self.bodies[body_id] = body
+        return body
+
+    def remove_body(self,body_id):
+        if body_id in self.bodies:
+            body = self.bodies.pop(body_id)
+        else:
+            body = self.lost_bodies.pop(body_id)
+        if self.smoothing:
+            self.pose_smoother.release(body.pose_smoother_slot)
+            self.normal_smoother.release(body.normal_smoother_slot)
+        body.close()
+        self.topic_pool.release(body_id)
+
+    def lose_body(self,body_id):
+        # Stop tracking the body, but keep it, its smoother slots and its topics in case it comes back
+        self.lost_bodies[body_id] = self.bodies.pop(body_id)
+
+    def revive_body(self,body_id):
+        self.bodies[body_id] = self.lost_bodies.pop(body_id)
+
+    def smooth_poses(self,bodies,time):
+        if len(bodies) == 0:
+            return
+        slots = [body.pose_smoother_slot for body in bodies]
+        poses = np.stack([body.pose_3D_array for body in bodies])
+        poses_valid = np.stack([body.pose_3D_valid for body in bodies])
+        smoothed,smoothed_valid = self.pose_smoother.smooth(slots,poses,poses_valid,time.to_sec())
+        for i,body in enumerate(bodies):
+            body.set_pose_3D(smoothed[i],smoothed_valid[i])
+
+    def smooth_normals(self,bodies,time):
+        if len(bodies) == 0:
+            return
+        slots = [body.normal_smoother_slot for body in bodies]
+        normals = np.zeros((len(bodies),2,3))
+        normals_valid = np.zeros((len(bodies),2),dtype=bool)
+        for i,body in enumerate(bodies):
+            for j,normal in enumerate([body.body_normal,body.face_normal]):
+                if normal is not None:
+                    normals[i,j] = normal
+                    normals_valid[i,j] = True
+        smoothed,smoothed_valid = self.normal_smoother.smooth(slots,normals,normals_valid,time.to_sec())
+        # Filtering unit vectors shortens them, so renormalise
+        smoothed = geometry.normalise(smoothed)
+        for i,body in enumerate(bodies):
+            body.body_normal = smoothed[i,0] if smoothed_valid[i,0] else None
+            body.face_normal = smoothed[i,1] if smoothed_valid[i,1] else None
+
+    def update_orientations(self,bodies):
+        # Body and face normals of every body in one pass
+        if len(bodies) == 0:
+            return
+        keypoints = np.stack([body.pose_3D_array for body in bodies])
+        keypoints_valid = np.stack([body.pose_3D_valid for body in bodies])
+        body_normals,body_normals_valid = geometry.body_normals(keypoints,keypoints_valid)
+        face_normals,face_normals_valid = geometry.face_normals(keypoints,keypoints_valid)
+        for i,body in enumerate(bodies):
+            body.set_orientations(
+                body_normals[i] if body_normals_valid[i] else None,
+                face_normals[i] if face_normals_valid[i] else None)
+
+    def project_poses(self,poses,image_shape,depth_image,inversed_transform):
+        # Lift the keypoints of every pose into the world frame at once
+        if len(poses) == 0:
+            return np.zeros((0,Pose.num_kpts,3)),np.zeros((0,Pose.num_kpts),dtype=bool)
+        keypoints = np.stack([np.asarray(pose.data,dtype=float).reshape(Pose.num_kpts,2) for pose in poses])
+        return self.project_keypoints(keypoints,image_shape,depth_image,inversed_transform)
+
+    def project_keypoints(self,keypoints,image_shape,depth_image,inversed_transform):
+        # keypoints is an (N,18,2) array of RGB pixel coordinates, with -1 marking missing keypoints
+        height,width = depth_image.shape[:2]
+        if self.pixel_lookup is None or self.pixel_lookup[0] != (height,width):
+            # Camera info disagrees with the images actually received
+            self.update_pixel_lookup(height,width)
+        _,lookup_x_d,lookup_x_ray,lookup_y_d,lookup_y_ray = self.pixel_lookup
+
+        valid = (keypoints[...,0] != -1) & (keypoints[...,1] != -1)
+
+        # Normalise against the RGB image and index into the depth image
+        px = np.floor(keypoints[...,0] / image_shape[1] * width)
+        py = np.floor(keypoints[...,1] / image_shape[0] * height)
+        px = np.where(valid,np.clip(px,0,width-1),0).astype(int)
+        py = np.where(valid,np.clip(py,0,height-1),0).astype(int)
+
+        # One gather from the depth image
+        z = depth_image[lookup_y_d[py],lookup_x_d[px]] / 1000
+        x = lookup_x_ray[px] * z
+        y = lookup_y_ray[py] * z
+        camera_coords = np.stack([-z,x,-y],axis=-1)
+
+        # One matrix multiply into the world frame
+        world_coords = camera_coords @ inversed_transform[0:3,0:3].T + inversed_transform[0:3,3]
+
+        # Mask out missing keypoints and invalid depth readings
+        valid &= z > 0
+        valid &= world_coords.sum(axis=-1) != 0
+
+        return world_coords,valid
+
+    def for_each_body(self,function,items):
+        # function applied to every item, on the body workers if there are any, results in order
+        if self.body_pool is None or len(items) < 2:
+            return [function(item) for item in items]
+        return list(self.body_pool.map(function,items))
+
+    def timed(self,step):
+        if self.step_timer is None:
+            return contextlib.nullcontext()
+        return self.step_timer.time(step)
+
+    def close(self):
+        if self.body_pool is not None:
+            self.body_pool.shutdown(wait=False)
+        if self.smoothing_pool is not None:
+            self.smoothing_pool.shutdown(wait=False)
+
+    def process_poses(self,poses,frame):
+        # frame is the engage.frame.Frame the poses were detected in
+        time = frame.time
         bodies_in_pose = []
         curr_transform = self.inversed_transform.copy()
 
-        # Start by updating the list of bodies
-        for pose in poses:
-            if pose.id not in self.body_ids:
-                # New body
-                self.body_ids[pose.id] = RandomID.random_id(pose.id)
-                self.bodies[self.body_ids[pose.id]] = HRIPoseBody(
-                    self.body_ids[pose.id],
-                    time,
-                    visualise=self.visualise,
-                    smoothing=self.smoothing,
-                    window=self.window,
-                    marker_pub=self.marker_pub,
-                    camera_frame=self.camera_frame,
-                    world_frame=self.world_frame
-                )
-            self.bodies[self.body_ids[pose.id]].update(
-                pose,
-                time,
-                rgb_image,
-                self.rgb_model,
-                self.depth_model,
-                depth_image,
-                curr_transform
-            )
-            bodies_in_pose.append(self.body_ids[pose.id])
+        # Lift every keypoint of every body in a single pass
+        with self.timed("lifting"):
+            poses_3D,poses_3D_valid = self.project_poses(poses,frame.shape,frame.depth,curr_transform)
+
+        # Find the body of each pose
+        with self.timed("tracking"):
+            if self.tracker is not None:
+                body_ids = self.tracker.assign(poses,poses_3D,poses_3D_valid,time.to_sec())
+            else:
+                body_ids = []
+                for pose in poses:
+                    if pose.id not in self.body_ids:
+                        self.body_ids[pose.id] = RandomID.random_id(pose.id)
+                    body_ids.append(self.body_ids[pose.id])
+
+            # Start by updating the list of bodies
+            for body_id in body_ids:
+                if body_id in self.lost_bodies:
+                    # Reappeared
+                    self.revive_body(body_id)
+                elif body_id not in self.bodies:
+                    # New body
+                    self.add_body(body_id,time)
+                bodies_in_pose.append(body_id)
+        updated_bodies = [self.bodies[body] for body in bodies_in_pose]
+
+        # Skeletons, 3D poses and pose histories
+        with self.timed("skeleton"):
+            self.for_each_body(
+                lambda i: updated_bodies[i].update(poses[i],time,frame.shape,poses_3D[i],poses_3D_valid[i]),
+                range(len(updated_bodies)))
+
+        # Smooth every joint of every body at once
+        if self.smoothing:
+            with self.timed("smoothing"):
+                self.smooth_poses(updated_bodies,time)
+
+        # Orientations
+        with self.timed("orientations"):
+            self.update_orientations(updated_bodies)
+            if self.smoothing:
+                self.smooth_normals(updated_bodies,time)
+
+        # Velocities and face transforms
+        with self.timed("velocities"):
+            self.for_each_body(HRIPoseBody.update_motion,updated_bodies)
         
         # Now, remove any bodies that have timed out
-        for body in list(self.bodies.keys()):
-            if body not in bodies_in_pose and abs(time - self.bodies[body].time) > self.body_timeout:
-                self.bodies[body].close()
-                del self.bodies[body]
+        if self.tracker is not None:
+            for body in self.tracker.lose(time.to_sec()):
+                self.lose_body(body)
+            for body in self.tracker.expire(time.to_sec()):
+                self.remove_body(body)
+        else:
+            for body in list(self.bodies.keys()):
+                if body not in bodies_in_pose and abs(time - self.bodies[body].time) > self.body_timeout:
+                    self.remove_body(body)
 
-        # Now publish the positions of each person
-        self.publish_positions(time)
+        # Unregister the topics of bodies that have been gone for a while
+        self.topic_pool.collect()
 
-        # Now publish the updated body list
-        self.publish_bodies(time)
+        with self.timed("publish"):
+            # Now publish the positions of each person
+            self.publish_positions(time)
 
-        # Now publish the bodies
-        for body in self.bodies:
-            self.bodies[body].publish()
+            # Now publish the updated body list
+            self.publish_bodies(time)
 
-        # Now publish the transforms
-        self.broadcast_transforms()
+            # Now publish the bodies, building the messages in parallel but publishing them in body order
+            for messages in self.for_each_body(HRIPoseBody.messages,list(self.bodies.values())):
+                for pub,msg in messages:
+                    pub.publish(msg)
+            if self.bodies_frame_pub is not None:
+                self.publish_bodies_frame(time,frame.keyframe,frame.operating_point)
 
+            # Now publish the transforms
+            self.broadcast_transforms()
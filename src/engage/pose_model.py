@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import hashlib
+import numpy as np
+import cv2
+import yaml
+
+from opendr.engine.data import Image as OpenDRImage
+from opendr.perception.pose_estimation import LightweightOpenPoseLearner
+
+# Creation of the OpenDR pose estimator, shared by the pose node and the calibration script,
+# and the pose profiles that calibration writes and the pose node loads
+
+backends = ["pytorch","onnx"]
+
+model_name = "openpose_default"
+# Pinned SHA-256 checksums of the published model files, shipped next to them with the package
+manifest_name = "checksums.json"
+
+# Settings a pose profile can hold, with the defaults used when it does not
+profile_defaults = {
+    "device":"auto",
+    "backend":"pytorch",
+    "threads":0,
+    "use_stride":False,
+    "half_precision":False,
+    "num_refinement_stages":2,
+    "base_height":256,
+}
+
+def resolve_device(device):
+    # auto picks the GPU when there is one
+    if device == "auto":
+        import torch
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    return device
+
+def create_pose_estimator(model_path,device="auto",backend="pytorch",threads=0,num_refinement_stages=2,
+                          use_stride=False,half_precision=False,base_height=256,download=True):
+    if backend not in backends:
+        raise ValueError("Unknown inference backend '{}', expected one of {}".format(backend,backends))
+    if backend == "onnx" and num_refinement_stages < 1:
+        # OpenDR names the outputs of the export as if there were refinement stages
+        raise ValueError("The onnx backend needs at least one refinement stage, got {}".format(num_refinement_stages))
+    device = resolve_device(device)
+    if device == "cpu":
+        # Half precision is only supported on the GPU
+        half_precision = False
+        if threads > 0:
+            import torch
+            torch.set_num_threads(threads)
+
+    pose_estimator = LightweightOpenPoseLearner(device=device,num_refinement_stages=num_refinement_stages,
+                                                mobilenet_use_stride=use_stride,half_precision=half_precision)
+    pose_estimator.base_height = base_height
+    if download:
+        ensure_model(pose_estimator,model_path)
+    pose_estimator.load(os.path.join(model_path,model_name))
+
+    if backend == "onnx":
+        # Exports the loaded model and runs it with onnxruntime from then on. The export is traced
+        # at base_height, only the width of the input can change afterwards
+        pose_estimator.optimize(do_constant_folding=True)
+        if threads > 0:
+            set_onnx_threads(pose_estimator,threads)
+    return pose_estimator
+
+def set_onnx_threads(pose_estimator,threads):
+    # OpenDR creates its onnxruntime session with the default options, which use every core,
+    # so reopen the exported model with a fixed intra-op thread count
+    import onnxruntime as ort
+    onnx_path = os.path.join(pose_estimator.temp_path,"onnx_model_temp.onnx")
+    if not os.path.exists(onnx_path):
+        print("Could not find the exported ONNX model at {}, using the default thread count".format(onnx_path))
+        return
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.inter_op_num_threads = 1
+    pose_estimator.ort_session = ort.InferenceSession(onnx_path,options)
+
+def file_checksum(path,chunk_size=1<<20):
+    digest = hashlib.sha256()
+    with open(path,"rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size),b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def model_files(model_dir):
+    # The metadata file, plus the weights it lists
+    metadata = model_name + ".json"
+    with open(os.path.join(model_dir,metadata)) as f:
+        return [metadata] + list(json.load(f)["model_paths"])
+
+def load_manifest(model_dir):
+    manifest_path = os.path.join(model_dir,manifest_name)
+    if not os.path.exists(manifest_path):
+        raise ValueError("No pinned checksums at {}".format(manifest_path))
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def check_model(model_dir):
+    '''
+    Checks the cached model files against the pinned checksum manifest, without using the network.
+
+    Returns None if the model can be loaded, otherwise the reason it cannot. Raises a ValueError
+    if the manifest is missing or has no checksum for a model file, which no download can fix.
+    '''
+    manifest = load_manifest(model_dir)
+    metadata = model_name + ".json"
+    if metadata not in manifest:
+        raise ValueError("No pinned checksum for {} in {}".format(metadata,os.path.join(model_dir,manifest_name)))
+    # The metadata first, so that it is verified before the weights it lists are read from it
+    for name in [metadata] + [name for name in manifest if name != metadata]:
+        path = os.path.join(model_dir,name)
+        if not os.path.exists(path):
+            return "missing {}".format(name)
+        if file_checksum(path) != manifest[name]:
+            return "checksum mismatch for {}".format(name)
+    for name in model_files(model_dir):
+        if name not in manifest:
+            raise ValueError("No pinned checksum for {} in {}, add its SHA-256 there".format(
+                name,os.path.join(model_dir,manifest_name)))
+    return None
+
+def ensure_model(pose_estimator,model_path):
+    # Only download the model if the cached copy is missing or corrupt
+    model_dir = os.path.join(model_path,model_name)
+    problem = check_model(model_dir)
+    if problem is None:
+        return False
+    print("Downloading the pose model to {} ({})".format(model_path,problem))
+    # Remove the cached copy so that all of it is downloaded again. The files are the ones pinned,
+    # the metadata may be the corrupt file
+    for name in load_manifest(model_dir):
+        path = os.path.join(model_dir,name)
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            print("Could not remove {} ({})".format(path,e))
+    pose_estimator.download(path=model_path,verbose=True)
+    problem = check_model(model_dir)
+    if problem is not None:
+        raise ValueError("The downloaded pose model does not match its pinned checksums ({})".format(problem))
+    return True
+
+def synthetic_image(width,height):
+    # Smooth noise, closer to a camera image than white noise
+    rng = np.random.default_rng(0)
+    small = rng.integers(0,256,(height//16,width//16,3),dtype=np.uint8)
+    return cv2.resize(small,(width,height),interpolation=cv2.INTER_CUBIC)
+
+def warm_up(pose_estimator,iterations=3,width=640,height=480):
+    # Pays for lazy initialisation and allocator growth before the first real frame
+    image = OpenDRImage(synthetic_image(width,height))
+    start = time.perf_counter()
+    for _ in range(iterations):
+        pose_estimator.infer(image)
+    return time.perf_counter() - start
+
+def load_profile(path):
+    with open(path) as f:
+        loaded = yaml.safe_load(f) or {}
+    profile = dict(profile_defaults)
+    profile.update({key:value for key,value in loaded.items() if key in profile_defaults})
+    return profile
+
+def save_profile(path,profile,measurements=None):
+    contents = {key:profile[key] for key in profile_defaults}
+    if measurements is not None:
+        contents["measurements"] = measurements
+    directory = os.path.dirname(path)
+    if directory != "":
+        os.makedirs(directory,exist_ok=True)
+    with open(path,"w") as f:
+        yaml.safe_dump(contents,f,sort_keys=False)
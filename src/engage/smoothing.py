@@ -0,0 +1,275 @@
+import numpy as np
+from abc import ABC,abstractmethod
+from functools import partial
+
+from engage.history import RingBuffer
+
+class PoseSmoother(ABC):
+    '''
+    Smooths a fixed number of 3D points for many bodies at once.
+
+    Each body owns a slot (a row in the state arrays), so every joint of every body in a
+    frame is smoothed with one set of array operations.
+    '''
+    # Names of the per-slot state arrays, resized together when the bank grows
+    state_arrays = ["estimate","initialised","last_seen"]
+
+    def __init__(self,num_points,window=40,hold_time=1.0,capacity=8):
+        self.num_points = num_points
+        self.window = window
+        self.hold_time = hold_time
+        self.capacity = 0
+        self.free_slots = []
+
+        self.estimate = np.zeros((0,num_points,3))
+        self.initialised = np.zeros((0,num_points),dtype=bool)
+        self.last_seen = np.zeros((0,num_points))
+        self.grow(capacity)
+
+    '''
+    Slots
+    '''
+    def allocate(self):
+        if len(self.free_slots) == 0:
+            self.grow(max(1,self.capacity))
+        slot = self.free_slots.pop()
+        self.initialised[slot] = False
+        return slot
+
+    def release(self,slot):
+        self.initialised[slot] = False
+        self.free_slots.append(slot)
+
+    def grow(self,extra):
+        for name in self.state_arrays:
+            array = getattr(self,name)
+            padding = np.zeros((extra,)+array.shape[1:],dtype=array.dtype)
+            setattr(self,name,np.concatenate([array,padding]))
+        # Hand out low slots first
+        self.free_slots = list(range(self.capacity+extra-1,self.capacity-1,-1)) + self.free_slots
+        self.capacity += extra
+
+    '''
+    Smoothing
+    '''
+    @abstractmethod
+    def smooth(self,slots,values,valid,time):
+        # slots: (N,) slot per body, values: (N,P,3) measurements, valid: (N,P), time: seconds.
+        # Returns the smoothed points and their validity
+        pass
+
+
+class FilterSmoother(PoseSmoother):
+    '''
+    Smoother that updates a running estimate of each point with every measurement.
+    Points that go missing keep their last estimate for up to hold_time seconds.
+    '''
+    def smooth(self,slots,values,valid,time):
+        slots = np.asarray(slots,dtype=int)
+        if len(slots) == 0:
+            return np.zeros((0,self.num_points,3)),np.zeros((0,self.num_points),dtype=bool)
+        initialised = self.initialised[slots]
+        dt = time - self.last_seen[slots]
+        update = valid & initialised & (dt > 0)
+        new = valid & ~initialised
+
+        estimate = self.filter(slots,values,update,new,dt)
+        estimate = np.where(new[...,np.newaxis],values,estimate)
+        self.estimate[slots] = estimate
+
+        last_seen = np.where(valid,time,self.last_seen[slots])
+        self.last_seen[slots] = last_seen
+        initialised = initialised | valid
+        self.initialised[slots] = initialised
+
+        smoothed_valid = initialised & (time - last_seen <= self.hold_time)
+        return estimate,smoothed_valid
+
+    @abstractmethod
+    def filter(self,slots,values,update,new,dt):
+        # Return the new estimates for the given slots, only changing points in update
+        pass
+
+    @staticmethod
+    def alpha(dt,cutoff):
+        # Smoothing factor of a first order low pass filter with the given cutoff frequency
+        tau = 1 / (2 * np.pi * cutoff)
+        return 1 / (1 + tau / np.maximum(dt,1e-6))
+
+
+class ExponentialSmoother(FilterSmoother):
+    # Time-aware exponential moving average
+    def __init__(self,num_points,time_constant=0.2,**kwargs):
+        self.time_constant = time_constant
+        super().__init__(num_points,**kwargs)
+
+    def filter(self,slots,values,update,new,dt):
+        estimate = self.estimate[slots]
+        alpha = 1 - np.exp(-np.maximum(dt,0) / self.time_constant)
+        alpha = np.where(update,alpha,0)[...,np.newaxis]
+        return estimate + alpha * (values - estimate)
+
+
+class OneEuroSmoother(FilterSmoother):
+    # One Euro filter (Casiez et al. 2012), with the cutoff driven by the speed of each point
+    state_arrays = PoseSmoother.state_arrays + ["derivative"]
+
+    def __init__(self,num_points,min_cutoff=1.0,beta=0.5,derivative_cutoff=1.0,**kwargs):
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.derivative_cutoff = derivative_cutoff
+        self.derivative = np.zeros((0,num_points,3))
+        super().__init__(num_points,**kwargs)
+
+    def filter(self,slots,values,update,new,dt):
+        estimate = self.estimate[slots]
+        derivative = self.derivative[slots]
+        safe_dt = np.where(update,dt,1)[...,np.newaxis]
+
+        # Low pass the derivative
+        raw_derivative = (values - estimate) / safe_dt
+        alpha_d = self.alpha(safe_dt,self.derivative_cutoff)
+        new_derivative = derivative + alpha_d * (raw_derivative - derivative)
+
+        # Low pass the value with a cutoff that rises with speed
+        cutoff = self.min_cutoff + self.beta * np.linalg.norm(new_derivative,axis=-1,keepdims=True)
+        alpha = self.alpha(safe_dt,cutoff)
+        new_estimate = estimate + alpha * (values - estimate)
+
+        mask = update[...,np.newaxis]
+        derivative = np.where(mask,new_derivative,derivative)
+        derivative[new] = 0
+        self.derivative[slots] = derivative
+        return np.where(mask,new_estimate,estimate)
+
+
+class KalmanSmoother(FilterSmoother):
+    # Constant velocity Kalman filter, independent per axis with a shared covariance per point
+    state_arrays = PoseSmoother.state_arrays + ["velocity","p00","p01","p11"]
+
+    def __init__(self,num_points,process_noise=1.0,measurement_noise=0.01,initial_velocity_variance=1.0,**kwargs):
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.initial_velocity_variance = initial_velocity_variance
+        self.velocity = np.zeros((0,num_points,3))
+        self.p00 = np.zeros((0,num_points))
+        self.p01 = np.zeros((0,num_points))
+        self.p11 = np.zeros((0,num_points))
+        super().__init__(num_points,**kwargs)
+
+    def filter(self,slots,values,update,new,dt):
+        position = self.estimate[slots]
+        velocity = self.velocity[slots]
+        p00,p01,p11 = self.p00[slots],self.p01[slots],self.p11[slots]
+        dt = np.where(update,dt,0)
+        q = self.process_noise
+
+        # Predict
+        position = position + velocity * dt[...,np.newaxis]
+        p00 = p00 + 2*dt*p01 + dt**2*p11 + q*dt**3/3
+        p01 = p01 + dt*p11 + q*dt**2/2
+        p11 = p11 + q*dt
+
+        # Update
+        innovation_variance = p00 + self.measurement_noise
+        k0 = p00 / innovation_variance
+        k1 = p01 / innovation_variance
+        residual = values - position
+        new_position = position + k0[...,np.newaxis] * residual
+        new_velocity = velocity + k1[...,np.newaxis] * residual
+        new_p00 = (1-k0) * p00
+        new_p01 = (1-k0) * p01
+        new_p11 = p11 - k1 * p01
+
+        # Only points with a measurement move, new points start at rest
+        mask = update[...,np.newaxis]
+        velocity = np.where(mask,new_velocity,self.velocity[slots])
+        velocity[new] = 0
+        self.velocity[slots] = velocity
+        self.p00[slots] = np.where(new,self.measurement_noise,np.where(update,new_p00,self.p00[slots]))
+        self.p01[slots] = np.where(new,0,np.where(update,new_p01,self.p01[slots]))
+        self.p11[slots] = np.where(new,self.initial_velocity_variance,np.where(update,new_p11,self.p11[slots]))
+        return np.where(mask,new_position,self.estimate[slots])
+
+
+class LowessSmoother(PoseSmoother):
+    '''
+    Reference mode: a full LOWESS fit over the window for every point on every frame.
+    This is O(window^2) per point and is kept for comparison with the streaming filters.
+    The fits of different bodies are independent, so they can be run on an executor
+    (e.g. a process pool) by setting executor.
+    '''
+    def __init__(self,num_points,smooth_fraction=0.4,iterations=1,**kwargs):
+        # Only needed for this mode
+        from tsmoothie.smoother import LowessSmoother as TSLowessSmoother
+        self.smooth_fraction = smooth_fraction
+        self.iterations = iterations
+        self.executor = None
+        self.histories = {}
+        super().__init__(num_points,**kwargs)
+
+    def allocate(self):
+        slot = super().allocate()
+        self.histories[slot] = RingBuffer(self.window,(self.num_points,3))
+        return slot
+
+    def release(self,slot):
+        super().release(slot)
+        del self.histories[slot]
+
+    def smooth(self,slots,values,valid,time):
+        smoothed = np.array(values,dtype=float)
+        smoothed_valid = np.array(valid,dtype=bool)
+        fits = []
+        for n,slot in enumerate(slots):
+            history = self.histories[slot]
+            history.append(values[n],valid[n],time)
+            if not history.full():
+                # Not enough data, use the raw points
+                continue
+            fits.append((n,history.values(),history.valid_mask()))
+        if len(fits) == 0:
+            return smoothed,smoothed_valid
+
+        rows,windows,windows_valid = zip(*fits)
+        fit = partial(lowess_latest,smooth_fraction=self.smooth_fraction,iterations=self.iterations)
+        if self.executor is not None and len(fits) > 1:
+            results = self.executor.map(fit,smoothed[list(rows)],windows,windows_valid)
+        else:
+            results = map(fit,smoothed[list(rows)],windows,windows_valid)
+        for n,(latest,latest_valid) in zip(rows,results):
+            smoothed[n] = latest
+            smoothed_valid[n] = latest_valid
+        return smoothed,smoothed_valid
+
+
+def lowess_latest(current,points,points_valid,smooth_fraction,iterations):
+    # Latest LOWESS estimate of each point of one body from its window of history.
+    # A module level function so that it can be run in another process
+    from tsmoothie.smoother import LowessSmoother as TSLowessSmoother
+    smoother = TSLowessSmoother(smooth_fraction=smooth_fraction,iterations=iterations)
+    latest = np.array(current,dtype=float)
+    latest_valid = np.zeros(len(latest),dtype=bool)
+    for i in range(len(latest)):
+        point_history = points[points_valid[:,i],i]
+        if len(point_history) == 1:
+            latest[i] = point_history[0]
+            latest_valid[i] = True
+        elif len(point_history) > 1:
+            smoother.smooth(point_history.T)
+            latest[i] = smoother.smooth_data[:,-1]
+            latest_valid[i] = True
+    return latest,latest_valid
+
+
+smoothers = {
+    "exponential":ExponentialSmoother,
+    "one_euro":OneEuroSmoother,
+    "kalman":KalmanSmoother,
+    "lowess":LowessSmoother,
+}
+
+def create_smoother(name,num_points,**kwargs):
+    if name not in smoothers:
+        raise ValueError("Unknown smoother '{}', expected one of {}".format(name,list(smoothers.keys())))
+    return smoothers[name](num_points,**kwargs)
@@ -0,0 +1,132 @@
+import time
+from collections import OrderedDict
+
+import rospy
+
+from engage.msg import TopicPoolStats
+
+class TopicHandles:
+    '''
+    The publishers and subscribers belonging to one body id.
+
+    Subscriber callbacks are routed through the handles to whichever object currently owns
+    them, so the same registrations can be handed to a new object for the same id.
+    '''
+    def __init__(self):
+        self.publishers = {}
+        self.registrations = []
+        self.owner = None
+
+    def publisher(self,name,topic,msg_type,queue_size=1):
+        self.publishers[name] = rospy.Publisher(topic,msg_type,queue_size=queue_size)
+        self.registrations.append(self.publishers[name])
+        return self.publishers[name]
+
+    def subscriber(self,subscriber):
+        # rospy Subscribers, or message_filters Subscribers which wrap one
+        self.registrations.append(getattr(subscriber,"sub",subscriber))
+        return subscriber
+
+    def forward(self,method):
+        # Callback calling the given method of the current owner, if there is one
+        def callback(*args):
+            owner = self.owner
+            if owner is not None:
+                getattr(owner,method)(*args)
+        return callback
+
+    def close(self):
+        for registration in self.registrations:
+            registration.unregister()
+        self.registrations = []
+        self.publishers = {}
+        self.owner = None
+
+
+class HandlePool:
+    '''
+    Reuses the topic handles of recently removed ids.
+
+    Released handles are kept idle for retire_time seconds (and at most max_idle of them), so an
+    id that reappears, e.g. after a short occlusion, gets its old registrations back instead of
+    making new calls to the master. Idle handles are only unregistered when collect is called.
+    '''
+    def __init__(self,name,retire_time=10,max_idle=50):
+        self.name = name
+        self.retire_time = retire_time
+        self.max_idle = max_idle
+        self.active = {}
+        # Insertion ordered, so the longest idle handles come first
+        self.idle = OrderedDict()
+
+        # Statistics
+        self.created = 0
+        self.reused = 0
+        self.retired = 0
+        self.last_report = {"created":0,"reused":0,"retired":0,"time":time.monotonic()}
+
+    def acquire(self,key,factory,owner=None):
+        if key in self.active:
+            handles = self.active[key]
+        elif key in self.idle:
+            handles,_ = self.idle.pop(key)
+            self.active[key] = handles
+            self.reused += 1
+        else:
+            handles = factory()
+            self.active[key] = handles
+            self.created += 1
+        handles.owner = owner
+        return handles
+
+    def release(self,key):
+        handles = self.active.pop(key,None)
+        if handles is None:
+            return
+        handles.owner = None
+        self.idle[key] = (handles,time.monotonic())
+
+    def collect(self):
+        # Retire handles that have been idle too long, or the oldest ones if there are too many
+        now = time.monotonic()
+        while len(self.idle) > 0:
+            key,(handles,released) = next(iter(self.idle.items()))
+            if now - released < self.retire_time and len(self.idle) <= self.max_idle:
+                break
+            del self.idle[key]
+            handles.close()
+            self.retired += 1
+
+    def close(self):
+        for handles in list(self.active.values()):
+            handles.close()
+        for handles,_ in self.idle.values():
+            handles.close()
+        self.active = {}
+        self.idle = OrderedDict()
+
+    def statistics(self):
+        # Totals, plus registration rates since the last call
+        now = time.monotonic()
+        period = max(now - self.last_report["time"],1e-6)
+        stats = {
+            "name":self.name,
+            "active":len(self.active),
+            "idle":len(self.idle),
+            "created":self.created,
+            "reused":self.reused,
+            "retired":self.retired,
+            "creation_rate":(self.created - self.last_report["created"]) / period,
+            "reuse_rate":(self.reused - self.last_report["reused"]) / period,
+            "retire_rate":(self.retired - self.last_report["retired"]) / period,
+        }
+        self.last_report = {"created":self.created,"reused":self.reused,"retired":self.retired,"time":now}
+        return stats
+
+    def message(self,stamp):
+        stats = self.statistics()
+        msg = TopicPoolStats()
+        msg.header.stamp = stamp
+        for key in ["name","active","idle","created","reused","retired","creation_rate","reuse_rate","retire_rate"]:
+            setattr(msg,key,stats[key])
+        return msg
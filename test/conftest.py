@@ -0,0 +1,9 @@
+import os
+import sys
+
+# The tests import the engage package from the source tree when it is not already importable,
+# e.g. from a sourced catkin workspace, which also has the generated messages
+try:
+    import engage
+except ImportError:
+    sys.path.insert(0,os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),"src"))
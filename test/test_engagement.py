@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+# The engagement manager lives with the ROS side of the node
+for module in ["rospy","tf","message_filters","hri_msgs","engage.msg"]:
+    pytest.importorskip(module)
+
+from engage.engage_helper import HRIEngagementManager
+from engage.neighbours import SparsePairs
+
+class Body:
+    # The attributes of HRIEngageBody the engagement calculation reads and writes
+    def __init__(self,id,position,body_norm,face_norm):
+        self.id = id
+        self.position = position
+        self.body_norm = body_norm
+        self.face_norm = face_norm
+        self.robot_engagements = []
+
+    def update_robot_engagement(self,engagement):
+        self.robot_engagements.append(engagement)
+
+def random_bodies(seed,num_bodies,spread=3):
+    # Some positions and orientations missing, as when keypoints are not detected
+    bodies = {}
+    for i in range(num_bodies):
+        rng = np.random.default_rng(seed*1000 + i)
+        position = rng.uniform(-spread,spread,3) if rng.random() > 0.2 else None
+        body_norm = rng.normal(size=3) if rng.random() > 0.2 else None
+        face_norm = rng.normal(size=3) if rng.random() > 0.2 else None
+        bodies[str(i)] = Body(str(i),position,body_norm,face_norm)
+    return bodies
+
+def engagement_manager(bodies,ignore_z,vectorised=True,spatial_index=False):
+    # Only the state the calculation uses, without publishers
+    manager = HRIEngagementManager.__new__(HRIEngagementManager)
+    manager.engagement_threshold = 0.55
+    manager.max_mutual_gaze_angle = np.pi/2
+    manager.ignore_z = ignore_z
+    manager.vectorised = vectorised
+    manager.spatial_index = spatial_index
+    manager.robot_position = np.array([0.3,0.1,1.2])
+    manager.robot_orientation = np.array([1,0.2,-0.1])
+    manager.bodies = bodies
+    return manager
+
+def robot_values(manager):
+    return [(body.distance_to_robot,body.mutual_gaze_robot,body.engagement_robot,body.robot_engagements)
+            for body in manager.bodies.values()]
+
+def assert_same(a,b):
+    if a is None or b is None:
+        assert a is None and b is None
+    else:
+        assert np.allclose(a,b,equal_nan=True)
+
+@pytest.mark.parametrize("ignore_z",[True,False])
+@pytest.mark.parametrize("seed",range(10))
+def test_arrays_match_loop(seed,ignore_z):
+    num_bodies = int(np.random.default_rng(seed).integers(0,8))
+    loop = engagement_manager(random_bodies(seed,num_bodies),ignore_z,vectorised=False)
+    arrays = engagement_manager(random_bodies(seed,num_bodies),ignore_z,vectorised=True)
+    for expected,actual in zip(loop.calculate_engagement(),arrays.calculate_engagement()):
+        assert np.allclose(expected,actual,equal_nan=True)
+    for expected,actual in zip(robot_values(loop),robot_values(arrays)):
+        for a,b in zip(expected,actual):
+            assert_same(a,b)
+
+@pytest.mark.parametrize("ignore_z",[True,False])
+@pytest.mark.parametrize("seed",range(10))
+def test_sparse_matches_arrays(seed,ignore_z):
+    num_bodies = int(np.random.default_rng(seed).integers(0,30))
+    dense = engagement_manager(random_bodies(seed,num_bodies),ignore_z)
+    sparse = engagement_manager(random_bodies(seed,num_bodies),ignore_z,spatial_index=True)
+    dense_results = dense.calculate_engagement()
+    sparse_results = sparse.calculate_engagement()
+    for expected,actual in zip(dense_results,sparse_results):
+        assert isinstance(actual,SparsePairs)
+        assert np.allclose(expected[actual.rows,actual.cols],actual.values,equal_nan=True)
+    # Every pair above the threshold is calculated
+    engagements = sparse_results[2]
+    rows,cols = np.nonzero(dense_results[2] > dense.engagement_threshold)
+    assert set(zip(rows.tolist(),cols.tolist())) <= set(zip(engagements.rows.tolist(),engagements.cols.tolist()))
+    for expected,actual in zip(robot_values(dense),robot_values(sparse)):
+        for a,b in zip(expected,actual):
+            assert_same(a,b)
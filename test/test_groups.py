@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from engage.groups import connected_components,GroupTracker
+
+def components_by_search(num_nodes,rows,cols):
+    # Reference labelling, by depth-first search from each node in order
+    neighbours = [[] for _ in range(num_nodes)]
+    for a,b in zip(rows,cols):
+        neighbours[a].append(b)
+        neighbours[b].append(a)
+    labels = -np.ones(num_nodes,dtype=int)
+    label = 0
+    for start in range(num_nodes):
+        if labels[start] >= 0:
+            continue
+        stack = [start]
+        labels[start] = label
+        while stack:
+            node = stack.pop()
+            for neighbour in neighbours[node]:
+                if labels[neighbour] < 0:
+                    labels[neighbour] = label
+                    stack.append(neighbour)
+        label += 1
+    return labels
+
+@pytest.mark.parametrize("seed",range(20))
+def test_connected_components_match_search(seed):
+    rng = np.random.default_rng(seed)
+    num_nodes = int(rng.integers(0,40))
+    num_edges = int(rng.integers(0,num_nodes+1)) if num_nodes > 0 else 0
+    rows = rng.integers(0,max(num_nodes,1),num_edges)
+    cols = rng.integers(0,max(num_nodes,1),num_edges)
+    labels = connected_components(num_nodes,rows,cols)
+    assert np.array_equal(labels,components_by_search(num_nodes,rows,cols))
+
+def test_group_ids_follow_members():
+    tracker = GroupTracker()
+    first = tracker.update(["a","b","c","d"],np.array([0,0,1,1]))
+    assert first[0] != first[1]
+    # Same members in a different order
+    second = tracker.update(["c","d","a","b"],np.array([0,0,1,1]))
+    assert second == [first[1],first[0]]
+
+def test_group_split_and_join():
+    tracker = GroupTracker()
+    ids = tracker.update(["a","b","c"],np.array([0,0,0]))
+    # The larger part keeps the id, the other gets a new one
+    split = tracker.update(["a","b","c"],np.array([0,0,1]))
+    assert split[0] == ids[0]
+    assert split[1] not in ids
+    # Joining again keeps one of the two ids
+    joined = tracker.update(["a","b","c"],np.array([0,0,0]))
+    assert joined[0] in split
+
+def test_new_people_get_new_groups():
+    tracker = GroupTracker()
+    ids = tracker.update(["a"],np.array([0]))
+    later = tracker.update(["x","y"],np.array([0,1]))
+    assert len(set(later)) == 2 and ids[0] not in later
+    assert tracker.update([],np.zeros(0,dtype=int)) == []
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from engage.history import RollingStatistics,RollingCounts
+
+def window_values(samples,time,window_time):
+    return np.array([value for sample_time,value in samples if sample_time > time - window_time],dtype=float)
+
+@pytest.mark.parametrize("refresh",[3,256])
+def test_rolling_statistics_match_numpy(refresh):
+    # Irregular frame times, so the window holds a varying number of samples
+    rng = np.random.default_rng(0)
+    times = np.cumsum(rng.uniform(0.01,0.2,2000))
+    values = rng.normal(5,3,len(times))
+    statistics = RollingStatistics(1.0,refresh=refresh)
+    samples = []
+    for time,value in zip(times,values):
+        statistics.append(time,value)
+        samples.append((time,value))
+        expected = window_values(samples,time,1.0)
+        assert len(statistics) == len(expected)
+        assert statistics.sum() == pytest.approx(expected.sum())
+        assert statistics.mean() == pytest.approx(expected.mean())
+        assert statistics.variance() == pytest.approx(np.var(expected),abs=1e-9)
+
+def test_rolling_statistics_votes_exact():
+    # +-1 engagement votes keep an exact sum, so a mean of 0 is not pushed either side of a threshold
+    statistics = RollingStatistics(0.5,refresh=1000)
+    for n in range(5000):
+        statistics.append(n*0.05,1 if n % 2 == 0 else -1)
+        assert statistics.sum() in (-1,0,1)
+
+def test_rolling_statistics_empty_and_full():
+    statistics = RollingStatistics(1.0)
+    assert statistics.mean() == 0 and statistics.variance() == 0
+    assert not statistics.full(0)
+    statistics.append(0,2)
+    assert not statistics.full(0.5)
+    assert statistics.full(1.0)
+    statistics.append(5,4)
+    assert len(statistics) == 1 and statistics.mean() == 4
+
+def test_rolling_counts():
+    counts = RollingCounts(1.0)
+    assert counts.most_common() == (None,0)
+    for n,category in enumerate(["a","b","b","a","a","c"]):
+        counts.append(n*0.3,category)
+    # Only the last four samples (0.6 to 1.5) are in the window
+    assert len(counts) == 4
+    assert counts.most_common() == ("a",0.5)
@@ -0,0 +1,112 @@
+import types
+import numpy as np
+import cv2
+import pytest
+
+from engage.image_decoding import decode_compressed_colour,decode_compressed_depth,decode_rvl,DEPTH_HEADER_SIZE
+
+def colour_image():
+    # Distinct red and blue channels, so a swap shows up
+    image = np.zeros((32,48,3),dtype=np.uint8)
+    image[...,0] = 200
+    image[...,1] = np.arange(48,dtype=np.uint8)[np.newaxis,:]
+    image[...,2] = 30
+    return image
+
+def compressed_message(image,format):
+    ok,data = cv2.imencode(".png",image)
+    assert ok
+    return types.SimpleNamespace(format=format,data=data.tobytes())
+
+def test_colour_converted_to_bgr_before_encoding():
+    # image_transport's compressed plugin encodes rgb8 sources as bgr8
+    bgr = colour_image()
+    msg = compressed_message(bgr,"rgb8; png compressed bgr8")
+    assert np.array_equal(decode_compressed_colour(msg),bgr)
+
+def test_colour_encoded_as_rgb():
+    bgr = colour_image()
+    rgb = cv2.cvtColor(bgr,cv2.COLOR_BGR2RGB)
+    msg = compressed_message(rgb,"rgb8; png compressed rgb8")
+    assert np.array_equal(decode_compressed_colour(msg),bgr)
+
+def test_colour_without_encoding_left_alone():
+    bgr = colour_image()
+    msg = compressed_message(bgr,"png")
+    assert np.array_equal(decode_compressed_colour(msg),bgr)
+
+def encode_rvl(depth):
+    # Reference encoder, after Wilson (2017)
+    words = []
+    nibbles = []
+    def write(value):
+        while True:
+            nibble = value & 0x7
+            value >>= 3
+            if value:
+                nibble |= 0x8
+            nibbles.append(nibble)
+            if not value:
+                break
+    pixels = depth.ravel().tolist()
+    previous = 0
+    i = 0
+    while i < len(pixels):
+        zeros = 0
+        while i < len(pixels) and pixels[i] == 0:
+            zeros += 1
+            i += 1
+        nonzeros = []
+        while i < len(pixels) and pixels[i] != 0:
+            nonzeros.append(pixels[i])
+            i += 1
+        write(zeros)
+        write(len(nonzeros))
+        for value in nonzeros:
+            delta = value - previous
+            write((delta << 1) ^ (delta >> 31))
+            previous = value
+    nibbles += [0]*(-len(nibbles) % 8)
+    for start in range(0,len(nibbles),8):
+        word = 0
+        for nibble in nibbles[start:start+8]:
+            word = (word << 4) | nibble
+        words.append(word)
+    return np.array(words,dtype="<u4").tobytes()
+
+def random_depth(rows=24,cols=40,seed=0):
+    rng = np.random.default_rng(seed)
+    depth = rng.integers(300,5000,(rows,cols)).astype(np.uint16)
+    depth[rng.random((rows,cols)) < 0.3] = 0
+    depth[:,:5] = 0
+    return depth
+
+@pytest.mark.parametrize("seed",range(5))
+def test_rvl_round_trip(seed):
+    depth = random_depth(seed=seed)
+    buffer = np.frombuffer(encode_rvl(depth),dtype=np.uint8)
+    assert np.array_equal(decode_rvl(buffer,depth.size).reshape(depth.shape),depth)
+
+def test_rvl_all_zero():
+    depth = np.zeros((4,4),dtype=np.uint16)
+    buffer = np.frombuffer(encode_rvl(depth),dtype=np.uint8)
+    assert np.array_equal(decode_rvl(buffer,depth.size),depth.ravel())
+
+def depth_message(format,payload):
+    header = np.array([0],dtype="<i4").tobytes() + np.array([0,0],dtype="<f4").tobytes()
+    assert len(header) == DEPTH_HEADER_SIZE
+    return types.SimpleNamespace(format=format,data=header + payload)
+
+def test_compressed_depth_rvl():
+    depth = random_depth()
+    rows,cols = depth.shape
+    payload = np.array([cols,rows],dtype="<u4").tobytes() + encode_rvl(depth)
+    msg = depth_message("16UC1; compressedDepth rvl",payload)
+    assert np.array_equal(decode_compressed_depth(msg),depth)
+
+def test_compressed_depth_png():
+    depth = random_depth()
+    ok,data = cv2.imencode(".png",depth)
+    assert ok
+    msg = depth_message("16UC1; compressedDepth png",data.tobytes())
+    assert np.array_equal(decode_compressed_depth(msg),depth)